@@ -0,0 +1,89 @@
+'''
+Script for compressing the files of a dataset.
+
+compress   - rewrite raw documents, clean documents and stored results with
+             gzip or zstd (the codec of the dataset in settings.COMPRESSION
+             by default, otherwise gzip)
+decompress - store them uncompressed again
+bench      - measure how fast documents and results are read
+
+Compressed files are recognized on their own when they are read,
+settings.COMPRESSION only decides how newly stored results are written.
+'''
+import time
+import argparse
+
+from txtexeval.extractor import extractor_list
+from txtexeval.data import get_dataset_loader_cls, get_result_storage_cls
+from txtexeval.data import get_compression, compress_dataset
+from txtexeval.util import check_local_path
+from txtexeval.util.compression import CODECS
+
+def _mb(size):
+    return size / 1024. / 1024.
+
+def compress(dataset_name, codec, level):
+    started = time.time()
+    files, before, after = compress_dataset(dataset_name, codec, level)
+    print '%i files: %.1f MB -> %.1f MB (%.2fx) in %.1fs' % (files, _mb(before), _mb(after),
+        before / float(after or 1), time.time() - started)
+    configured = get_compression(dataset_name)
+    if configured != codec:
+        print 'note: new results of this dataset are stored with %s (settings.COMPRESSION)' \
+            % (configured or 'no compression')
+
+def _report(name, count, size, elapsed):
+    elapsed = elapsed or 1e-9
+    print '%-20s %6i files %8.1f MB %8.1f MB/s %8.0f files/s' % (name, count, _mb(size),
+        _mb(size) / elapsed, count / elapsed)
+
+def bench(dataset_name):
+    '''Read every document and stored result once and report the throughput'''
+    loader = get_dataset_loader_cls()(dataset_name)
+    for name, read in (('raw', lambda d: d.get_raw_html().encode('utf-8')),
+                       ('clean', lambda d: d.get_clean())):
+        count = size = 0
+        started = time.time()
+        for doc in loader:
+            size += len(read(doc))
+            count += 1
+        _report(name, count, size, time.time() - started)
+    storage_cls = get_result_storage_cls()
+    for ex in extractor_list:
+        ids = storage_cls.existing_ids(dataset_name, ex)
+        if not ids:
+            continue
+        storage = storage_cls(dataset_name, ex)
+        size = 0
+        started = time.time()
+        for id in ids:
+            size += len(storage._read_result(id))
+        _report(ex.SLUG, len(ids), size, time.time() - started)
+
+def parse_args(args):
+    '''Sys argument parsing trough argparse'''
+    parser = argparse.ArgumentParser(description = 'Tool for compressing dataset files')
+    parser.add_argument('action', choices = ('compress', 'decompress', 'bench'), help = 'compress or decompress all files of the dataset, bench measures the read throughput')
+    parser.add_argument('dataset_name', help = 'name of the dataset')
+    parser.add_argument('-c','--codec', choices = CODECS, help = 'compression codec (default: settings.COMPRESSION or gzip)')
+    parser.add_argument('-l','--level', type = int, help = 'compression level')
+    return parser.parse_args(args)
+
+def main(args):
+    pargs = parse_args(args)
+    if not check_local_path(pargs.dataset_name):
+        print 'error: this dataset does not exist'
+        return
+    print '[STARTED]'
+    if pargs.action == 'bench':
+        bench(pargs.dataset_name)
+    elif pargs.action == 'compress':
+        codec = pargs.codec or get_compression(pargs.dataset_name) or 'gzip'
+        compress(pargs.dataset_name, codec, pargs.level)
+    else:
+        compress(pargs.dataset_name, None, None)
+    print '[DONE]'
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv[1:])
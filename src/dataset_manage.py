@@ -8,6 +8,7 @@ of the directory that settings.PATH_LOCAL_DATA points to.
 |   |-- testdataset
 |   |   |-- clean
 |   |   |   `-- example.txt
+|   |   |-- corpus.pack --> raw and clean documents packed by the pack type
 |   |   |-- meta.yaml ----> this is where the output will reside
 |   |   `-- raw
 |   |       `-- example.html
@@ -28,6 +29,7 @@ import chardet
 from BeautifulSoup import BeautifulSoup
 
 from txtexeval.util import check_local_path, get_local_path
+from txtexeval.data import CorpusPack, DataError
 
 # module logger
 logger = logging.getLogger()
@@ -336,7 +338,7 @@ class CleanevalProcessor(BaseProcessor):
 def parse_args(args):               
     # sys argument parsing using argparse
     parser = argparse.ArgumentParser(description = 'Tool for generating meta data files and cleanup preprocessing regarding datasets')
-    parser.add_argument('dataset_type', choices = ('cleaneval','gnews'), help = 'dataset type e.g. cleaneval' )
+    parser.add_argument('dataset_type', choices = ('cleaneval','gnews','pack'), help = 'dataset type e.g. cleaneval, pack builds the corpus pack of a dataset with meta data' )
     parser.add_argument('dataset_name', help = 'name of the dataset')
     parser.add_argument('-p','--path', help = 'path to the meta data output file and .log file (uses the default path if not provided)')
     parser.add_argument('-v','--verbose', action = 'store_true', help = 'print log to console')
@@ -392,6 +394,16 @@ def main(args):
             print e
             sys.exit(-1)
             
+    elif pargs.dataset_type == 'pack':
+        try:
+            print '[PACKING]'
+            count = CorpusPack.build(pargs.dataset_name)
+            print '%i documents packed' % count
+        except (DataError, IOError) as e:
+            print 'PACKING ERROR:'
+            print e
+            sys.exit(-1)
+            
     print '[DONE]'
     
     
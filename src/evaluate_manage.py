@@ -1,58 +1,243 @@
 '''
 Script for generating evaluation results
+
+Results of documents whose extraction result and gold standard did not 
+change since the last run are taken from the evaluation manifest 
+(see EvaluationManifest), --full evaluates everything again.
+
+--evaluator bow screens extractors with the bag of words evaluator, its 
+results are saved apart from the ones of the text evaluator as 
+<dataset_name>-bow.
 '''
 import os
+import hashlib
 import logging
+import multiprocessing
 
 import argparse
 
 import settings
 from txtexeval.extractor import extractor_list, get_extractor_cls
-from txtexeval.data import LocalDatasetLoader, LocalResultStorage
+from txtexeval.data import get_dataset_loader_cls, get_result_storage_cls
 from txtexeval.data import DataError
-from txtexeval.evaluation import TextBasedResults, TextOnlyEvaluator
-from txtexeval.evaluation import from_document_factory, dataset_format_map
+from txtexeval.evaluation import TextBasedResults, TextOnlyEvaluator, EvaluationManifest
+from txtexeval.evaluation import BowEvaluator, evaluator_map
+from txtexeval.evaluation import GoldTokenCache, get_gold_cache, dataset_format_map
+from txtexeval.matching import get_matcher, matcher_map
 
 logger = logging.getLogger()
 
-def single_evaluation(extractor_cls, results, dataset_type, dataset_name):
+def evaluate_document(extractor_cls, storage, doc, gold, matcher = None, manifest = None):
+    '''
+    Evaluate the stored result of a single document against its gold 
+    standard from a GoldTokenCache, None if there is no result. With a 
+    manifest the result of unchanged inputs is reused.
+    '''
+    logger.debug('doc: %s', doc.id)
+    try:
+        result_string = storage.fetch_result(doc)
+    except DataError:
+        logger.info('no stored result for %s at %s extractor',
+                    doc.id, extractor_cls.NAME)
+        return None
+    if manifest is not None:
+        fingerprint = (hashlib.sha1(result_string).hexdigest(), gold.key(doc))
+        result = manifest.lookup(extractor_cls.SLUG, doc.id, fingerprint)
+        if result is not None:
+            return result
+    format_result = extractor_cls.formatted_result(result_string)
+    evaluator = TextOnlyEvaluator(
+                retrieved = format_result,
+                relevant = gold.format(doc),
+                id = doc.id,
+                matcher = matcher)
+    result = evaluator.get_eval_results()
+    if manifest is not None:
+        manifest.record(extractor_cls.SLUG, doc.id, fingerprint, result)
+    return result
+
+def single_evaluation(extractor_cls, results, dataset_type, dataset_name, matcher = None,
+                      gold = None, manifest = None):
     logger.info('started evaluating extractor %s', extractor_cls.NAME)
     results.set_extractor(extractor_cls.SLUG)
-    storage = LocalResultStorage(dataset_name, extractor_cls)
+    if manifest is not None:
+        manifest.begin(extractor_cls.SLUG)
+    storage = get_result_storage_cls()(dataset_name, extractor_cls)
+    gold = gold or GoldTokenCache(dataset_type)
     
-    loader = LocalDatasetLoader(dataset_name)
+    loader = get_dataset_loader_cls()(dataset_name)
     for doc in loader:
+        result = evaluate_document(extractor_cls, storage, doc, gold, matcher, manifest)
+        if result is not None:
+            results.add_result(result)
+
+# state of an evaluation worker process
+_worker = {}
+
+def _init_evaluation_worker(extractor_classes, dataset_type, dataset_name, matcher_name,
+                            manifest):
+    _worker.update(matcher_name = matcher_name, gold = get_gold_cache(dataset_type),
+                   manifest = manifest,
+                   storages = [(extractor_cls, get_result_storage_cls()(dataset_name, extractor_cls))
+                               for extractor_cls in extractor_classes])
+
+def _evaluate_doc(doc):
+    # a fresh matcher per document, stateful ones are merged by the parent
+    matcher = get_matcher(_worker['matcher_name'])
+    gold = _worker['gold']
+    manifest = _worker['manifest']
+    results = [evaluate_document(extractor_cls, storage, doc, gold, matcher, manifest)
+               for extractor_cls, storage in _worker['storages']]
+    # the gold standard is tokenized once for all extractors, workers don't 
+    # see the document again; new sequences are committed as they are 
+    # stored, so workers never hold the lock of the shared store
+    gold.forget(doc)
+    # the parent keeps the manifest of the run
+    records, reused = [], 0
+    if manifest is not None:
+        records, reused = manifest.take_records(), manifest.reused
+        manifest.reused = 0
+    return results, matcher if hasattr(matcher, 'merge') else None, records, reused
+
+def parallel_evaluation(extractor_classes, results, dataset_type, dataset_name,
+                        workers, matcher_name = None, matcher = None, manifest = None):
+    '''
+    Evaluate documents on a pool of worker processes, each document against
+    all extractors. Results are added in the order of single_evaluation, 
+    so the saved results are the same as the ones of a serial run.
+    Documents are streamed from the loader to the workers, which only get
+    the manifest entries of the evaluated extractors.
+    '''
+    if workers < 1:
+        raise ValueError('at least one worker is required')
+    loader = get_dataset_loader_cls()(dataset_name)
+    chunksize = max(1, len(loader) // (workers * 8))
+    worker_manifest = None
+    if manifest is not None:
+        worker_manifest = manifest.subset([e.SLUG for e in extractor_classes])
+    pool = multiprocessing.Pool(workers, _init_evaluation_worker,
+                                (extractor_classes, dataset_type, dataset_name, matcher_name,
+                                 worker_manifest))
+    if manifest is not None:
+        for extractor_cls in extractor_classes:
+            manifest.begin(extractor_cls.SLUG)
+    try:
+        # per document a list with a result (or None) for each extractor
+        doc_results = []
+        for doc_result, worker_matcher, records, reused in pool.imap(
+                _evaluate_doc, iter(loader), chunksize):
+            doc_results.append(doc_result)
+            if worker_matcher is not None and matcher is not None:
+                matcher.merge(worker_matcher)
+            for record in records:
+                manifest.record(*record)
+            if reused:
+                manifest.reused += reused
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    for i, extractor_cls in enumerate(extractor_classes):
+        logger.info('evaluated extractor %s', extractor_cls.NAME)
+        results.set_extractor(extractor_cls.SLUG)
+        for doc_result in doc_results:
+            if doc_result[i] is not None:
+                results.add_result(doc_result[i])
+
+def bow_evaluation(extractor_classes, results, dataset_type, dataset_name, gold = None):
+    '''
+    Evaluate the results of all extractors with BowEvaluator, scoring every
+    document against all extractors in a single batch
+    '''
+    gold = gold or GoldTokenCache(dataset_type)
+    storages = [get_result_storage_cls()(dataset_name, extractor_cls)
+                for extractor_cls in extractor_classes]
+    doc_results = dict((extractor_cls.SLUG, []) for extractor_cls in extractor_classes)
+    for doc in get_dataset_loader_cls()(dataset_name):
         logger.debug('doc: %s', doc.id)
-        format_clean = from_document_factory(doc, slug = dataset_type)
-        try:
-            result_string = storage.fetch_result(doc)
-        except DataError:
-            logger.info('no stored result for %s at %s extractor',
-                        doc.id, extractor_cls.NAME)
+        evaluated = []
+        formats = []
+        for extractor_cls, storage in zip(extractor_classes, storages):
+            try:
+                result_string = storage.fetch_result(doc)
+            except DataError:
+                logger.info('no stored result for %s at %s extractor',
+                            doc.id, extractor_cls.NAME)
+                continue
+            evaluated.append(extractor_cls.SLUG)
+            formats.append(extractor_cls.formatted_result(result_string))
+        if not formats:
             continue
-        else:
-            format_result = extractor_cls.formatted_result(result_string)
-            evaluator = TextOnlyEvaluator(
-                        retrieved = format_result,
-                        relevant = format_clean,
-                        id = doc.id)
-            results.add_result(evaluator.get_eval_results())
+        for slug, result in zip(evaluated, BowEvaluator.batch_results(gold.format(doc),
+                                                                      formats, doc.id)):
+            doc_results[slug].append(result)
+    for extractor_cls in extractor_classes:
+        results.set_extractor(extractor_cls.SLUG)
+        for result in doc_results[extractor_cls.SLUG]:
+            results.add_result(result)
 
-def local_evaluate(dataset_type, dataset_name, update_ext_slug = None):
+def local_evaluate(dataset_type, dataset_name, update_ext_slug = None, matcher_name = None,
+                   workers = 1, full = False, evaluator = 'text'):
+    if evaluator == 'bow':
+        return local_bow_evaluate(dataset_type, dataset_name, update_ext_slug)
     results = TextBasedResults()
+    matcher = get_matcher(matcher_name)
+    # parity is about checking every document, entries of the extractors
+    # that are not evaluated are kept either way
+    manifest = EvaluationManifest(dataset_name, (dataset_type, type(matcher).__name__,
+                                                 GoldTokenCache.VERSION),
+                                  reuse = not full and not hasattr(matcher, 'merge'))
+    manifest.load()
     
     if update_ext_slug:
         results.load(dataset_name)
-        ex_cls = get_extractor_cls(update_ext_slug)
-        single_evaluation(ex_cls, results, dataset_type, dataset_name)
+        extractor_classes = [get_extractor_cls(update_ext_slug)]
     else:
-        for extractor_cls in extractor_list:
-            single_evaluation(extractor_cls, results, dataset_type, dataset_name)
+        extractor_classes = list(extractor_list)
+    if workers > 1:
+        parallel_evaluation(extractor_classes, results, dataset_type, dataset_name,
+                            workers, matcher_name, matcher, manifest)
+    else:
+        gold = get_gold_cache(dataset_type)
+        try:
+            for extractor_cls in extractor_classes:
+                single_evaluation(extractor_cls, results, dataset_type, dataset_name,
+                                  matcher, gold, manifest)
+        finally:
+            gold.close()
+        logger.info('tokenized %d gold standard documents', gold.parsed)
+    logger.info('reused %d results of the evaluation manifest', manifest.reused)
+    manifest.save()
+    
+    if hasattr(matcher, 'summary'):
+        logger.info(matcher.summary())
+        print matcher.summary()
 
-    results.dataset_len = len(LocalDatasetLoader(dataset_name))
+    results.dataset_len = len(get_dataset_loader_cls()(dataset_name))
     results.save(dataset_name)     
     results.print_results()
     
+def local_bow_evaluate(dataset_type, dataset_name, update_ext_slug = None):
+    results_name = '%s-bow' % dataset_name
+    results = TextBasedResults()
+    if update_ext_slug:
+        results.load(results_name)
+        extractor_classes = [get_extractor_cls(update_ext_slug)]
+    else:
+        extractor_classes = list(extractor_list)
+    gold = get_gold_cache(dataset_type)
+    try:
+        bow_evaluation(extractor_classes, results, dataset_type, dataset_name, gold)
+    finally:
+        gold.close()
+    
+    results.dataset_len = len(get_dataset_loader_cls()(dataset_name))
+    results.save(results_name)
+    print 'bag of words results (saved as %s)' % results_name
+    results.print_results()
+    
 def parse_args(args):
     '''Sys argument parsing trough argparse'''
     parser = argparse.ArgumentParser(description = 'Tool for for generating evaluation results')
@@ -60,6 +245,10 @@ def parse_args(args):
     parser.add_argument('dataset_name', help = 'name of the dataset')
     parser.add_argument('-v','--verbose', action = 'store_true', help = 'print log to console')
     parser.add_argument('-u','--update', choices = [e.SLUG for e in extractor_list], help = 'update the results for a single extractor')
+    parser.add_argument('-m','--matcher', choices = [m[0] for m in matcher_map], help = 'how matching words are counted: lcs (exact), difflib (as in earlier evaluations) or parity (lcs, reporting divergence from difflib); default: settings.MATCHER or lcs')
+    parser.add_argument('-w','--workers', type = int, default = 1, help = 'number of processes evaluating documents in parallel')
+    parser.add_argument('-e','--evaluator', choices = [e[0] for e in evaluator_map], default = 'text', help = 'text (word sequences) or bow (bag of words, fast screening; --matcher, --workers and the manifest do not apply)')
+    parser.add_argument('-f','--full', action = 'store_true', help = 'evaluate all documents, not only the ones that changed since the last run')
     return parser.parse_args(args)
     
 def logging_setup(verbose):
@@ -82,7 +271,8 @@ def main(args):
     pargs = parse_args(args)
     logging_setup(pargs.verbose)
     print '[STARTED]'
-    local_evaluate(pargs.dataset_type, pargs.dataset_name, pargs.update)
+    local_evaluate(pargs.dataset_type, pargs.dataset_name, pargs.update, pargs.matcher,
+                   pargs.workers, pargs.full, pargs.evaluator)
     print '[DONE]'
     
 if __name__ == '__main__':
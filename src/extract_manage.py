@@ -1,48 +1,160 @@
 '''
 Script for extracting article text from dataset instances
 '''
-import time
 import logging
 
 import argparse
 
-from txtexeval.extractor import get_extractor_cls, extractor_list
-from txtexeval.data import LocalDatasetLoader, LocalResultStorage
-from txtexeval.util import get_local_path
+from txtexeval.extractor import get_extractor_cls, get_rate_limiter, is_request_based, extractor_list
+from txtexeval.data import get_dataset_loader_cls, get_result_storage_cls
+from txtexeval.data import DocumentFilter, ExtractionSummary, FAILURE_CATEGORIES, Shard
+from txtexeval.runner import get_runner, FanOutRunner
+from txtexeval.util import get_local_path, RateLimiter
 
 logger = logging.getLogger()
 
-def local_extract(dataset_name, extractor_slug, timeout, retry_failed, skip_existing):
+def _get_limiter(ex, timeout):
+    if timeout:
+        # the old fixed pause is expressed as a rate of one request per timeout
+        limiter = RateLimiter(rate = 1. / timeout)
+    else:
+        limiter = get_rate_limiter(ex)
+    logger.info('rate limit for %s: %r', ex.NAME, limiter)
+    return limiter
+
+def _report_progress(name, total, todo):
+    msg = '%s: %i to do / %i already done' % (name, todo, total - todo)
+    logger.info(msg)
+    print msg
+
+def _journal_mode(retry_failed, skip_existing, resume):
+    if resume:
+        return 'resume'
+    elif retry_failed or skip_existing:
+        # a partial run - keep the outcomes of the documents it leaves out
+        return 'append'
+    return 'new'
+
+def _shard_size(dataset_name, shard):
+    # number of documents in the shard
+    return get_dataset_loader_cls()(dataset_name, shard = shard).count_accepted()
+
+def local_extract(dataset_name, extractor_slug, timeout, retry_failed, skip_existing,
+                  workers = 1, use_async = False, resume = False, failed_categories = None,
+                  shard = None):
     # init storage and loader
     ex = get_extractor_cls(extractor_slug)
     
     failed_slug = extractor_slug if retry_failed else None
     skip_slug = extractor_slug if skip_existing else None
+    resume_slug = extractor_slug if resume else None
+    
+    loader = get_dataset_loader_cls()(dataset_name, 
+                                      load_failed=failed_slug, 
+                                      skip_existing=skip_slug,
+                                      resume=resume_slug,
+                                      failed_categories=failed_categories,
+                                      shard=shard)
+    if shard:
+        _report_progress('%s (shard %s)' % (ex.NAME, shard), 
+                         _shard_size(dataset_name, shard), loader.count_accepted())
+    elif retry_failed or skip_existing or resume:
+        _report_progress(ex.NAME, len(loader), loader.count_accepted())
+    storage = get_result_storage_cls()(dataset_name, ex, 
+                                 journal_mode = _journal_mode(retry_failed, skip_existing, resume),
+                                 shard = shard)
     
-    loader = LocalDatasetLoader(dataset_name, 
-                                load_failed=failed_slug, 
-                                skip_existing=skip_slug)
-    storage = LocalResultStorage(dataset_name, ex)
+    if use_async and not is_request_based(ex):
+        logger.warning('%s does not support non-blocking extraction - using threads', ex.NAME)
+        use_async = False
+    if workers > 1 and not use_async and not ex.CONCURRENT:
+        logger.warning('%s does not support concurrent extraction - using a single worker', ex.NAME)
+        workers = 1
+    runner = get_runner(storage, workers, _get_limiter(ex, timeout), use_async)
     
     logger.info('started extracting content from %s dataset using %s', dataset_name, ex.NAME)
-    for doc in loader:
-        storage.push_result(doc)
-        if timeout:
-            time.sleep(timeout)
-        
-    storage.dump_summary()
+    try:
+        runner.run(loader)
+    finally:
+        # also written when the run is interrupted
+        storage.dump_summary()
     logger.info('finished with %s dataset', dataset_name)
     
+def local_extract_many(dataset_name, extractor_slugs, timeout, retry_failed, 
+                       skip_existing, workers = 1, resume = False, failed_categories = None,
+                       shard = None):
+    '''Run several extractors in a single pass over the dataset'''
+    extractors = [get_extractor_cls(slug) for slug in extractor_slugs]
+    
+    # documents are filtered per extractor, the loader yields all of them
+    # (or all of the shard)
+    loader = get_dataset_loader_cls()(dataset_name, shard = shard)
+    summary = ExtractionSummary(dataset_name, shard = shard)
+    filters = [DocumentFilter(dataset_name,
+                              load_failed = ex.SLUG if retry_failed else None,
+                              skip_existing = ex.SLUG if skip_existing else None,
+                              resume = ex.SLUG if resume else None,
+                              failed_categories = failed_categories,
+                              shard = shard)
+               for ex in extractors]
+    if retry_failed or skip_existing or resume or shard:
+        total = 0
+        todo = [0] * len(extractors)
+        for doc in loader:
+            total += 1
+            for i, f in enumerate(filters):
+                todo[i] += f.accepts(doc)
+        for ex, count in zip(extractors, todo):
+            name = '%s (shard %s)' % (ex.NAME, shard) if shard else ex.NAME
+            _report_progress(name, total, count)
+    journal_mode = _journal_mode(retry_failed, skip_existing, resume)
+    storage_cls = get_result_storage_cls()
+    storages = [storage_cls(dataset_name, ex, summary, journal_mode, shard) for ex in extractors]
+    limiters = [_get_limiter(ex, timeout) for ex in extractors]
+    runner = FanOutRunner(storages, workers, limiters, filters)
+    
+    logger.info('started extracting content from %s dataset using %s', dataset_name,
+                ', '.join([ex.NAME for ex in extractors]))
+    try:
+        runner.run(loader)
+    finally:
+        for storage in storages:
+            storage.dump_summary()
+    logger.info('finished with %s dataset', dataset_name)
+    
+def extractor_slugs(value):
+    '''Argparse type: an extractor slug, a comma separated list of slugs or all'''
+    ex_list = [e.SLUG for e in extractor_list]
+    if value == 'all':
+        return ex_list
+    slugs = value.split(',')
+    for slug in slugs:
+        if slug not in ex_list:
+            raise argparse.ArgumentTypeError('invalid extractor: %r (choose from all, %s)'
+                                             % (slug, ', '.join(ex_list)))
+    return slugs
+    
+def shard_arg(value):
+    '''Argparse type: a shard given as i/N'''
+    try:
+        return Shard.parse(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    
 def parse_args(args):
     '''Sys argument parsing trough argparse'''
-    ex_list = [e.SLUG for e in extractor_list]    
     parser = argparse.ArgumentParser(description = 'Tool for extracting article text from dataset instances')
-    parser.add_argument('extractor', choices = ex_list, help = 'extractor slug')
+    parser.add_argument('extractor', type = extractor_slugs, help = 'extractor slug, comma separated list of slugs or all (runs them in a single pass)')
     parser.add_argument('dataset_name', help = 'name of the dataset')
     parser.add_argument('-v','--verbose', action = 'store_true', help = 'print log to console')
-    parser.add_argument('-t','--timeout', type=int, default=0, help='wait x seconds between extraction operations')
+    parser.add_argument('-t','--timeout', type=int, default=0, help='start at most one extraction every x seconds (overrides the rate limit settings)')
     parser.add_argument('-rf','--retry_failed', action = 'store_true', help = 'retry to extract text from instances that failed')
+    parser.add_argument('-rc','--retry_category', action = 'append', choices = FAILURE_CATEGORIES, help = 'retry only failures of this category (implies --retry_failed, can be repeated)')
+    parser.add_argument('-w','--workers', type=int, default=1, help='number of documents extracted concurrently')
+    parser.add_argument('-a','--async', dest='use_async', action = 'store_true', help = 'send requests without blocking from a single thread (--workers sets the number of requests in flight; a single extractor only)')
     parser.add_argument('-se','--skip_existing', action = 'store_true', help = 'skip all documents that already have their result stored in the database/filesystem')
+    parser.add_argument('-r','--resume', action = 'store_true', help = 'continue an interrupted run where it stopped (use the same options as the interrupted run)')
+    parser.add_argument('-s','--shard', type = shard_arg, help = 'extract only shard i of N (given as i/N); merge the shards with result_manage.py merge')
     return parser.parse_args(args)
     
 def logging_setup(verbose, output_path):
@@ -62,11 +174,24 @@ def logging_setup(verbose, output_path):
 
 def main(args):
     pargs = parse_args(args)
-    logging_setup(pargs.verbose, get_local_path(pargs.dataset_name,'result','result.log'))
+    if pargs.retry_category:
+        pargs.retry_failed = True
+    # shards running on other machines keep their own log
+    log_name = 'result%s.log' % (pargs.shard.suffix if pargs.shard else '')
+    logging_setup(pargs.verbose, get_local_path(pargs.dataset_name,'result',log_name))
     
     print '[STARTED]'
-    local_extract(pargs.dataset_name, pargs.extractor, 
-                  pargs.timeout, pargs.retry_failed, pargs.skip_existing)
+    if len(pargs.extractor) == 1:
+        local_extract(pargs.dataset_name, pargs.extractor[0], 
+                      pargs.timeout, pargs.retry_failed, pargs.skip_existing,
+                      pargs.workers, pargs.use_async, pargs.resume, pargs.retry_category,
+                      pargs.shard)
+    else:
+        if pargs.use_async:
+            logger.warning('--async is not supported with several extractors - using threads')
+        local_extract_many(pargs.dataset_name, pargs.extractor,
+                           pargs.timeout, pargs.retry_failed, pargs.skip_existing,
+                           pargs.workers, pargs.resume, pargs.retry_category, pargs.shard)
     print '[DONE]'
     
 if __name__ == '__main__':
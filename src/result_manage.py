@@ -0,0 +1,57 @@
+'''
+Script for converting stored extraction results between storage backends and
+merging the output of sharded extraction runs.
+
+pack   - copy results from result/<slug>/<id>.<FORMAT> files into the packed
+         result/<slug>.sqlite container
+unpack - copy results from the packed container back into one file per
+         document
+merge  - combine the summary fragments and packed containers written by
+         sharded extraction runs (extract_manage.py --shard) into summary.yaml
+         and result/<slug>.sqlite
+'''
+import argparse
+
+from txtexeval.extractor import extractor_list, get_extractor_cls
+from txtexeval.data import LocalResultStorage, PackedResultStorage, convert_results
+from txtexeval.data import merge_shards
+from txtexeval.util import check_local_path
+
+def convert(action, dataset_name, extractor_slugs):
+    if action == 'pack':
+        source_cls, target_cls = LocalResultStorage, PackedResultStorage
+        source_name = '%s'
+    else:
+        source_cls, target_cls = PackedResultStorage, LocalResultStorage
+        source_name = '%s.sqlite'
+    for slug in extractor_slugs:
+        ex = get_extractor_cls(slug)
+        if not check_local_path(dataset_name, 'result', source_name % slug):
+            continue
+        count = convert_results(dataset_name, ex, source_cls, target_cls)
+        print '%s: %i results' % (ex.NAME, count)
+
+def parse_args(args):
+    '''Sys argument parsing trough argparse'''
+    parser = argparse.ArgumentParser(description = 'Tool for converting stored results between storage backends')
+    parser.add_argument('action', choices = ('pack', 'unpack', 'merge'), help = 'pack: files to a single container, unpack: container to files, merge: combine the output of sharded runs')
+    parser.add_argument('dataset_name', help = 'name of the dataset')
+    parser.add_argument('-e','--extractor', choices = [e.SLUG for e in extractor_list], help = 'convert the results of a single extractor (default: all)')
+    return parser.parse_args(args)
+
+def main(args):
+    pargs = parse_args(args)
+    if not check_local_path(pargs.dataset_name):
+        print 'error: this dataset does not exist'
+        return
+    slugs = [pargs.extractor] if pargs.extractor else [e.SLUG for e in extractor_list]
+    print '[STARTED]'
+    if pargs.action == 'merge':
+        print '%i summary fragments merged' % merge_shards(pargs.dataset_name)
+    else:
+        convert(pargs.action, pargs.dataset_name, slugs)
+    print '[DONE]'
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv[1:])
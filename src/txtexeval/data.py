@@ -1,12 +1,26 @@
 import os
+import re
+import time
+import mmap
+import struct
+import json
+import sqlite3
+import marshal
+import hashlib
+import shutil
+import tempfile
 import urlparse
 import codecs
 import logging
+import threading
+from collections import namedtuple, OrderedDict
 
 import yaml
 
 import settings
 from .util import check_local_path, get_local_path
+from .util.cache import BlobCache
+from .util import compression
 from .extractor import extractor_list, get_extractor_cls
 from .extractor import  ExtractorError, ContentExtractorError
 
@@ -15,6 +29,50 @@ logger = logging.getLogger(__name__)
 class DataError(Exception):
     pass
 
+# outcome of a single extraction: either result or error is set, both are 
+# None when the extractor does not implement the extract method; latency is
+# the number of seconds the extraction took (optional), cached is set when
+# the result comes from the extraction cache
+ExtractionOutcome = namedtuple('ExtractionOutcome', 'result error latency cached')
+ExtractionOutcome.__new__.__defaults__ = (None, False)
+
+def run_extractor(extractor):
+    '''Call extractor.extract() and turn the result into an ExtractionOutcome'''
+    started = time.time()
+    try:
+        result = extractor.extract()
+    except DataError as e:
+        err_msg = 'Data related error: %r' % e
+    except ContentExtractorError as e:
+        err_msg = 'Content extractor related error: %r' % e
+    except ExtractorError as e:
+        # failure_category tells the errors apart by these prefixes
+        if e.status:
+            err_msg = 'Extractor related error (HTTP %s): %r' % (e.status, e)
+        elif e.timeout:
+            err_msg = 'Extractor related error (timeout): %r' % e
+        else:
+            err_msg = 'Extractor related error: %r' % e
+    except NotImplementedError:
+        logger.debug('extraction method is not implemented - do nothing')
+        return ExtractionOutcome(None, None)
+    except Exception as e:
+        err_msg = 'Unknown error: %r' % e
+    else:
+        return ExtractionOutcome(result, None, time.time() - started)
+    return ExtractionOutcome(None, err_msg, time.time() - started)
+
+def get_compression(dataset_name):
+    '''
+    Codec new files of a dataset are compressed with, configured through 
+    settings.COMPRESSION (None stores them uncompressed). Reading does not 
+    depend on it - compressed files are recognized on their own.
+    '''
+    codec = dict(getattr(settings, 'COMPRESSION', {})).get(dataset_name)
+    if codec is not None and codec not in compression.CODECS:
+        raise DataError('unknown compression codec for %s: %s' % (dataset_name, codec))
+    return codec
+
 def verify_local_dataset(init):
     def wrapper(self, dataset, *args, **kwargs):
         if not check_local_path(dataset):
@@ -32,41 +90,259 @@ class BaseDatasetLoader(object):
     def __iter__(self):
         raise NotImplementedError
 
+class Shard(namedtuple('Shard', 'index count')):
+    '''
+    Part index (1 based) of a dataset split into count parts. Documents are
+    assigned by a stable hash of their id, so every machine running a shard
+    of the same dataset agrees on the partition.
+    '''
+    
+    __slots__ = ()
+    
+    @classmethod
+    def parse(cls, value):
+        '''Create a shard from an "i/N" string'''
+        try:
+            index, count = [int(part) for part in value.split('/')]
+        except ValueError:
+            raise ValueError('a shard is given as i/N: %r' % value)
+        if not 1 <= index <= count:
+            raise ValueError('shard index must be between 1 and %d: %r' % (count, value))
+        return cls(index, count)
+    
+    def accepts(self, id):
+        digest = hashlib.md5(_id_string(id)).hexdigest()
+        return int(digest[:8], 16) % self.count == self.index - 1
+    
+    @property
+    def suffix(self):
+        '''Suffix of the journal, summary and container files a shard writes'''
+        return '.shard-%d-of-%d' % self
+    
+    def __str__(self):
+        return '%d/%d' % self
+
+def _shard_suffix(shard):
+    return shard.suffix if shard else ''
+
+# suffix of the files written by a shard
+_shard_re = re.compile(r'\.shard-(\d+)-of-(\d+)$')
+
+class DocumentFilter(object):
+    '''
+    Decides which documents an extraction run should process for a single 
+    extractor: with skip_existing documents that already have a stored 
+    result are left out, with load_failed only documents that failed in the
+    previous run are kept (only those whose failure is in failed_categories
+    if given) and with resume documents the last (interrupted) run already
+    recorded in the extraction journal are left out. With a shard only the
+    documents of that shard are kept.
+    '''
+    
+    def __init__(self, dataset_name, load_failed = None, skip_existing = None,
+                 resume = None, failed_categories = None, shard = None):
+        self._shard = shard
+        if skip_existing:
+            # a single listing of the result store instead of a stat per document
+            self._existing = get_result_storage_cls().existing_ids(
+                                dataset_name, get_extractor_cls(skip_existing))
+        else:
+            self._existing = None
+        if load_failed:
+            self._failed_ids = ExtractionSummary(dataset_name) \
+                                .get_failed_ids(load_failed, failed_categories)
+        else:
+            self._failed_ids = None
+        if resume:
+            self._done = ExtractionJournal(dataset_name, resume, 
+                                           shard = shard).last_run_ids()
+        else:
+            self._done = None
+            
+    def accepts(self, document):
+        if self._shard is not None and not self._shard.accepts(document.id):
+            return False
+        elif self._done != None and document.id in self._done:
+            return False
+        elif self._existing != None and \
+        _id_string(document.id) in self._existing:
+            return False
+        elif self._failed_ids != None and \
+        document.id not in self._failed_ids:
+            return False
+        return True
+
+def _id_string(id):
+    # ids from meta.yaml may be numbers, stored results are named by string
+    return id if isinstance(id, basestring) else str(id)
+
+# compact representation of a single meta.yaml entry
+MetaRecord = namedtuple('MetaRecord', 'id raw clean url raw_encoding clean_encoding')
+
+def iter_meta_yaml(f):
+    '''
+    Yield the entries of a meta.yaml file one at a time. A block style list
+    (what dataset_manage writes) is cut into items on the "- " lines at the
+    start of a line and every item is parsed on its own, so memory use does
+    not grow with the size of the dataset. Anything else is parsed at once.
+    '''
+    loader = getattr(yaml, 'CLoader', yaml.Loader)
+    first = f.readline()
+    if not (first.startswith('- ') or first.rstrip() == '-'):
+        for entry in yaml.load(first + f.read(), Loader = loader) or []:
+            yield entry
+        return
+    chunk = [first]
+    for line in f:
+        if line.startswith('- ') or line.rstrip() == '-':
+            yield yaml.load(''.join(chunk), Loader = loader)[0]
+            chunk = []
+        chunk.append(line)
+    yield yaml.load(''.join(chunk), Loader = loader)[0]
+
+class MetaIndex(object):
+    '''
+    Compiled form of a dataset's meta.yaml kept in meta.idx next to it. 
+    
+    The index is a header followed by one marshalled MetaRecord tuple per 
+    document, so the document count is known without reading the records
+    and iteration reads them one at a time. It is rebuilt whenever 
+    meta.yaml changes: the stored mtime and size are checked first and the
+    sha1 of meta.yaml decides when they differ (e.g. after a copy). With an
+    unchanged sha1 only the header is rewritten.
+    '''
+    
+    _magic = 'txtexeval-meta'
+    _version = 1
+    
+    def __init__(self, dataset_name):
+        self.yaml_path = get_local_path(dataset_name, 'meta.yaml')
+        self.path = get_local_path(dataset_name, 'meta.idx')
+        self._from_yaml = False # set if the index could not be written
+        self._header = self._load_header()
+        if self._header is None:
+            self._header = self.compile()
+            
+    def _stat(self):
+        st = os.stat(self.yaml_path)
+        return st.st_mtime, st.st_size
+    
+    def _hash(self):
+        sha = hashlib.sha1()
+        with open(self.yaml_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), ''):
+                sha.update(chunk)
+        return sha.hexdigest()
+            
+    def _load_header(self):
+        # return the header of an up to date index or None
+        try:
+            with open(self.path, 'rb') as f:
+                header = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(header, tuple) or len(header) != 6 or \
+           header[:2] != (self._magic, self._version):
+            return None
+        magic, version, mtime, size, sha1, count = header
+        if (mtime, size) == self._stat():
+            return header
+        if sha1 == self._hash():
+            # same content, just a newer timestamp - the records are valid
+            return self._rewrite_header(header)
+        return None
+    
+    def _rewrite_header(self, header):
+        # write the current mtime and size in front of the existing records
+        mtime, size = self._stat()
+        header = header[:2] + (mtime, size) + header[4:]
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(self.path, 'rb') as old:
+                marshal.load(old)
+                with open(tmp_path, 'wb') as f:
+                    marshal.dump(header, f)
+                    shutil.copyfileobj(old, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            # the index stays readable, the sha1 is checked again next time
+            logger.warning('failed to update %s: %s', self.path, e)
+        return header
+    
+    def compile(self, sha1 = None):
+        '''Parse meta.yaml and write the index, return its header'''
+        mtime, size = self._stat()
+        sha1 = sha1 or self._hash()
+        try:
+            # records are streamed into a temporary file first, the header
+            # with the document count is written in front of them afterwards
+            count = 0
+            with tempfile.TemporaryFile() as body:
+                with open(self.yaml_path, 'r') as f:
+                    for entry in iter_meta_yaml(f):
+                        marshal.dump(tuple(entry.get(field) for field in MetaRecord._fields), body)
+                        count += 1
+                body.seek(0)
+                header = (self._magic, self._version, mtime, size, sha1, count)
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    marshal.dump(header, f)
+                    shutil.copyfileobj(body, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            # e.g. a read-only dataset - records are parsed from meta.yaml
+            logger.warning('failed to write %s: %s', self.path, e)
+            self._from_yaml = True
+            with open(self.yaml_path, 'r') as f:
+                count = sum(1 for entry in iter_meta_yaml(f))
+            header = (self._magic, self._version, mtime, size, sha1, count)
+        return header
+    
+    def __len__(self):
+        return self._header[5]
+    
+    @property
+    def sha1(self):
+        '''sha1 of the meta.yaml the index was compiled from'''
+        return self._header[4]
+    
+    def __iter__(self):
+        '''Yield a MetaRecord per document, in meta.yaml order'''
+        if self._from_yaml:
+            with open(self.yaml_path, 'r') as f:
+                for entry in iter_meta_yaml(f):
+                    yield MetaRecord(*[entry.get(field) for field in MetaRecord._fields])
+            return
+        with open(self.path, 'rb') as f:
+            marshal.load(f)
+            for i in xrange(len(self)):
+                yield MetaRecord(*marshal.load(f))
+
 class LocalDatasetLoader(BaseDatasetLoader):
     '''Dataset loader using local filesystem'''
     
     @verify_local_dataset
-    def __init__(self, dataset_name, load_failed = None, skip_existing = None):     
+    def __init__(self, dataset_name, load_failed = None, skip_existing = None,
+                 resume = None, failed_categories = None, shard = None):     
         self.dataset = dataset_name   
-        self._skip_existing = skip_existing
         
         # load meta data
-        meta_filepath = get_local_path( dataset_name, 'meta.yaml')
-        with open(meta_filepath, 'r') as f:
-            self.meta_yaml = yaml.load(f.read())
-            self._len = len(self.meta_yaml)
+        self._meta = MetaIndex(dataset_name)
+        self._len = len(self._meta)
             
-        if load_failed:
-            self._failed_list = ExtractionSummary(self.dataset) \
-                                .get_failed_ids(load_failed) 
-        else:
-            self._failed_list = None
+        self._filter = DocumentFilter(dataset_name, load_failed, skip_existing, resume,
+                                      failed_categories, shard)
+            
+    def _make_document(self, index, record):
+        return LocalDocument.from_record(self.dataset, record)
             
     def __iter__(self):
         '''DataInstance generator'''
-        for dict in self.meta_yaml:
-            document = LocalDocument(self.dataset, **dict)
+        for index, record in enumerate(self._meta):
+            document = self._make_document(index, record)
             
             # check if all conditions for yielding a document are set
-            yield_ = True
-            if self._skip_existing != None and \
-            document.check_existing_clean(self._skip_existing):
-                yield_ = False
-            elif self._failed_list != None and \
-            dict['id'] not in self._failed_list:
-                yield_ = False
-                
-            if yield_:
+            if self._filter.accepts(document):
                 yield document
             else: 
                 logger.debug('skipping document %s', document.id)
@@ -75,10 +351,46 @@ class LocalDatasetLoader(BaseDatasetLoader):
     def __len__(self):
         return self._len
     
+    def count_accepted(self):
+        '''Number of documents the loader will yield (reads the metadata once)'''
+        return sum(1 for document in self)
+    
+
+class PackedDatasetLoader(LocalDatasetLoader):
+    '''
+    Dataset loader reading documents from the corpus pack of the dataset
+    (see CorpusPack, built with dataset_manage.py pack). The pack has to be
+    rebuilt whenever meta.yaml or the documents change.
+    '''
+    
+    def __init__(self, dataset_name, *args, **kwargs):
+        super(PackedDatasetLoader, self).__init__(dataset_name, *args, **kwargs)
+        self._pack = get_corpus_pack(dataset_name)
+        if self._pack.sha1 != self._meta.sha1 or len(self._pack) != self._len:
+            raise DataError('the corpus pack of %s is out of date' % dataset_name)
+        
+    def _make_document(self, index, record):
+        return PackedDocument.from_pack(self._pack, index, record)
+    
+# dataset loaders selectable through settings.DATASET_LOADER
+dataset_loader_map = (
+    ('files', LocalDatasetLoader),
+    ('packed', PackedDatasetLoader),
+)
+
+def get_dataset_loader_cls(name = None):
+    '''Return the loader class for a backend name (settings.DATASET_LOADER by default)'''
+    name = name or getattr(settings, 'DATASET_LOADER', 'files')
+    for backend, cls in dataset_loader_map:
+        if backend == name:
+            return cls
+    raise DataError('unknown dataset loader: %s' % name)
 
 class BaseDocument(object):
     # same goes for document instances
     
+    __slots__ = ()
+    
     def get_raw_html(self):
         pass
     
@@ -94,8 +406,13 @@ class BaseDocument(object):
 class LocalDocument(BaseDocument):
     '''Evaluation data representation using local filesystem'''
     
+    # millions of documents may pass through a run, keep them small
+    __slots__ = ('dataset', 'id', 'raw_filename', 'clean_filename', 'url',
+                 'raw_encoding', 'clean_encoding', '_raw_html')
+    
     def __init__(self, dataset, **kwargs):
         self.dataset = dataset
+        self._raw_html = None
         
         # instance attributes
         self.id = kwargs.pop('id')
@@ -105,10 +422,33 @@ class LocalDocument(BaseDocument):
         self.raw_encoding = kwargs.pop('raw_encoding')
         self.clean_encoding = kwargs.pop('clean_encoding')
         
+    @classmethod
+    def from_record(cls, dataset, record):
+        '''Create a document from a MetaRecord'''
+        document = cls.__new__(cls)
+        document.dataset = dataset
+        document._raw_html = None
+        (document.id, document.raw_filename, document.clean_filename, document.url,
+         document.raw_encoding, document.clean_encoding) = record
+        return document
+        
     def get_raw_html(self):
-        file_path = get_local_path(self.dataset,'raw',self.raw_filename)
-        with codecs.open(file_path,'r', encoding = self.raw_encoding, errors = 'ignore') as f:
-            return f.read()
+        # read only once, several extractors may share one document instance
+        if self._raw_html is None:
+            file_path = get_local_path(self.dataset,'raw',self.raw_filename)
+            data = compression.read_file(file_path, get_compression(self.dataset))
+            self._raw_html = codecs.decode(data, self.raw_encoding, 'ignore')
+        return self._raw_html
+    
+    def __getstate__(self):
+        # documents are pickled for worker processes, the html stays behind
+        return (self.dataset, self.id, self.raw_filename, self.clean_filename, 
+                self.url, self.raw_encoding, self.clean_encoding)
+    
+    def __setstate__(self, state):
+        (self.dataset, self.id, self.raw_filename, self.clean_filename, 
+         self.url, self.raw_encoding, self.clean_encoding) = state
+        self._raw_html = None
     
     def get_url(self):
         if self.url: 
@@ -119,93 +459,582 @@ class LocalDocument(BaseDocument):
         
     def get_url_local(self):
         # file:///home/tomaz/workspace/diploma/txt-ex-eval-data/datasets/cleaneval-final/raw/100.html
+        # (browsers can not open compressed raw files)
         return 'file://' + settings.PATH_LOCAL_DATA + '/datasets/' \
              + self.dataset + '/raw/' + self.raw_filename
         
     def get_clean(self):
         file_path = get_local_path(self.dataset,'clean',self.clean_filename)
-        with open(file_path, 'r') as f:
-            return f.read()
+        return compression.read_file(file_path, get_compression(self.dataset))
         
     def check_existing_clean(self, extractor_slug):
         ex_cls = get_extractor_cls(extractor_slug)
-        return check_local_path(self.dataset,'result',extractor_slug,
-                                '%s.%s' %(self.id, ex_cls.FORMAT))
+        file_path = get_local_path(self.dataset,'result',extractor_slug,
+                                   '%s.%s' %(self.id, ex_cls.FORMAT))
+        return any(os.path.exists(p) for p in compression.candidate_paths(file_path))
+    
+class CorpusPack(object):
+    '''
+    Raw and clean documents of a dataset concatenated into a single file,
+    datasets/<name>/corpus.pack, that is read through mmap. 
+    
+    The file starts with a header (magic, version, document count and the 
+    sha1 of the meta.yaml it was built from) followed by a table of 
+    (raw offset, raw length, clean offset, clean length) entries in 
+    meta.yaml order and the payloads themselves. Payloads are stored 
+    uncompressed, so a document is a slice of the mapped file.
+    '''
+    
+    _magic = 'txtexeval-pack'
+    _version = 1
+    _header = struct.Struct('<14sHQ40s')
+    _entry = struct.Struct('<QIQI')
+    
+    def __init__(self, dataset_name):
+        self.dataset = dataset_name
+        self.path = get_local_path(dataset_name, 'corpus.pack')
+        try:
+            with open(self.path, 'rb') as f:
+                self.inode = os.fstat(f.fileno()).st_ino
+                self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        except (IOError, ValueError, mmap.error) as e:
+            raise DataError('failed to open the corpus pack of %s: %s' % (dataset_name, e))
+        if len(self._map) < self._header.size:
+            raise DataError('%s is not a corpus pack' % self.path)
+        magic, version, self.count, self.sha1 = self._header.unpack_from(self._map)
+        if (magic, version) != (self._magic, self._version):
+            raise DataError('%s is not a corpus pack' % self.path)
+        
+    def entry(self, index):
+        return self._entry.unpack_from(self._map, self._header.size + index * self._entry.size)
+    
+    def raw(self, index):
+        offset, length = self.entry(index)[:2]
+        return self._map[offset:offset + length]
+    
+    def clean(self, index):
+        offset, length = self.entry(index)[2:]
+        return self._map[offset:offset + length]
+    
+    def __len__(self):
+        return self.count
+    
+    @classmethod
+    def build(cls, dataset_name):
+        '''Write the corpus pack of a dataset, return the number of documents'''
+        meta = MetaIndex(dataset_name)
+        path = get_local_path(dataset_name, 'corpus.pack')
+        tmp_path = path + '.tmp'
+        table = []
+        codec = get_compression(dataset_name)
+        with open(tmp_path, 'wb') as f:
+            # the table is written once the offsets are known
+            offset = cls._header.size + len(meta) * cls._entry.size
+            f.seek(offset)
+            for record in meta:
+                entry = []
+                for folder, filename in (('raw', record.raw), ('clean', record.clean)):
+                    data = compression.read_file(get_local_path(dataset_name, folder, filename), codec)
+                    f.write(data)
+                    entry.extend((offset, len(data)))
+                    offset += len(data)
+                table.append(cls._entry.pack(*entry))
+            f.seek(0)
+            f.write(cls._header.pack(cls._magic, cls._version, len(table), meta.sha1))
+            f.write(''.join(table))
+        os.rename(tmp_path, path)
+        return len(table)
+    
+# open corpus packs of this process by path
+_packs = {}
+_packs_lock = threading.Lock()
+
+def get_corpus_pack(dataset_name, check = True):
+    '''
+    Return the shared CorpusPack of a dataset, reopened if the file was 
+    rebuilt since (unless check is False)
+    '''
+    path = get_local_path(dataset_name, 'corpus.pack')
+    with _packs_lock:
+        pack = _packs.get(path)
+        if pack is not None and check:
+            try:
+                current = os.stat(path).st_ino
+            except OSError:
+                current = None
+            if current != pack.inode:
+                pack = None
+        if pack is None:
+            pack = _packs[path] = CorpusPack(dataset_name)
+        return pack
+    
+class PackedDocument(LocalDocument):
+    '''LocalDocument whose raw and clean content is sliced from a CorpusPack'''
+    
+    __slots__ = ('_pack', '_index')
+    
+    @classmethod
+    def from_pack(cls, pack, index, record):
+        document = cls.from_record(pack.dataset, record)
+        document._pack = pack
+        document._index = index
+        return document
+    
+    def get_raw_html(self):
+        if self._raw_html is None:
+            self._raw_html = codecs.decode(self._pack.raw(self._index), 
+                                           self.raw_encoding, 'ignore')
+        return self._raw_html
+    
+    def get_clean(self):
+        return self._pack.clean(self._index)
+    
+    def __getstate__(self):
+        return super(PackedDocument, self).__getstate__() + (self._index,)
+    
+    def __setstate__(self, state):
+        super(PackedDocument, self).__setstate__(state[:-1])
+        self._index = state[-1]
+        # workers map the pack once and share it between documents
+        self._pack = get_corpus_pack(self.dataset, check = False)
+        
+        
+class ExtractionJournal(object):
+    '''
+    Append-only log of per-document outcomes of a single extractor, kept in
+    result/<slug>.journal with one json record per line:
+    
+        {"id": ..., "ok": true|false, "reason": ..., "latency": ...}
+    
+    Records are written as soon as a document is stored and fsync-ed in 
+    batches (every sync_every records or sync_interval seconds), so a crash
+    loses at most the last batch. A {"run": <timestamp>} line marks the 
+    start of an extraction run. The latest record of a document wins, which
+    makes the failure list in summary.yaml derivable from the journal.
+    
+    mode        - 'new' truncates the journal, 'append' starts a new run after
+                  the existing records and 'resume' continues the last run
+    before_sync - called before records are synced (e.g. to flush the 
+                  results they refer to)
+    shard       - runs of a Shard keep their own result/<slug>.shard-i-of-N.journal
+    '''
+    
+    def __init__(self, dataset_name, extractor_slug, mode = 'new',
+                 sync_every = 100, sync_interval = 1., before_sync = None, shard = None):
+        if mode not in ('new', 'append', 'resume'):
+            raise ValueError('unknown journal mode: %s' % mode)
+        self.path = get_local_path(dataset_name, 'result', '%s%s.journal' 
+                                   % (extractor_slug, _shard_suffix(shard)))
+        self.mode = mode
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._before_sync = before_sync
+        self._file = None
+        self._unsynced = 0
+        self._last_sync = time.time()
+        self._lock = threading.Lock()
+        
+    def exists(self):
+        return os.path.exists(self.path)
+        
+    def records(self):
+        '''Iterate over the records, run markers included'''
+        if not self.exists():
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # the tail of a record that was never synced
+                    logger.warning('skipping a damaged record in %s', self.path)
+                    
+    def latest(self):
+        '''Return an OrderedDict id -> latest record of the document'''
+        latest = OrderedDict()
+        for record in self.records():
+            if 'id' in record:
+                latest.pop(record['id'], None)
+                latest[record['id']] = record
+        return latest
+        
+    def failures(self):
+        '''Failure list in the summary.yaml format'''
+        # json gives us unicode, summary.yaml holds plain strings
+        def native(value):
+            return value.encode('utf-8') if isinstance(value, unicode) else value
+        return [{'id': native(r['id']), 'reason': native(r['reason']),
+                 'category': failure_category(r['reason'])}
+                for r in self.latest().itervalues() if not r['ok']]
+        
+    def last_run_ids(self):
+        '''Set of document ids recorded since the last run marker'''
+        ids = set()
+        for record in self.records():
+            if 'run' in record:
+                ids = set()
+            else:
+                ids.add(record['id'])
+        return ids
+        
+    def _repair_tail(self):
+        '''Cut off the partial record a crash may have left at the end'''
+        if not self.exists():
+            return
+        with open(self.path, 'r+b') as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            position = end
+            while position > 0:
+                step = min(4096, position)
+                f.seek(position - step)
+                chunk = f.read(step)
+                newline = chunk.rfind('\n')
+                if newline != -1:
+                    position = position - step + newline + 1
+                    break
+                position -= step
+            if position < end:
+                logger.warning('dropping a partial record at the end of %s', self.path)
+                f.truncate(position)
         
+    def _open(self):
+        if self.mode == 'new':
+            self._file = open(self.path, 'w')
+        else:
+            self._repair_tail()
+            self._file = open(self.path, 'a')
+        if self.mode != 'resume' or self._file.tell() == 0:
+            self._file.write(json.dumps({'run': time.time()}) + '\n')
+        
+    def append(self, id, ok, reason = None, latency = None):
+        line = json.dumps({'id': id, 'ok': ok, 'reason': reason, 'latency': latency})
+        with self._lock:
+            if self._file is None:
+                self._open()
+            self._file.write(line + '\n')
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every or \
+               time.time() - self._last_sync >= self.sync_interval:
+                self._sync()
+                
+    def _sync(self):
+        if self._before_sync:
+            self._before_sync()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.time()
+        
+    def sync(self):
+        '''Force the buffered records to disk'''
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+        
+# categories of failure reasons, see failure_category
+FAILURE_CATEGORIES = ('network', 'client-error', 'server-error', 'content-error', 
+                      'timeout', 'unknown')
+
+_HTTP_STATUS_RE = re.compile(r'Extractor related error \(HTTP (\d+)\)')
+
+def failure_category(reason):
+    '''
+    Classify a failure reason recorded by run_extractor. HTTP errors are 
+    classified by the status code of the response (4xx client-error, others
+    server-error), the remaining extractor errors are network errors unless
+    they timed out.
+    '''
+    reason = reason or ''
+    status = _HTTP_STATUS_RE.match(reason)
+    if reason.startswith('Content extractor related error'):
+        return 'content-error'
+    elif status:
+        return 'client-error' if 400 <= int(status.group(1)) < 500 else 'server-error'
+    elif 'timed out' in reason or 'timeout' in reason.lower():
+        return 'timeout'
+    elif reason.startswith('Extractor related error'):
+        return 'network'
+    return 'unknown'
+
+class FailureIndex(object):
+    '''
+    Failures of a single extractor keyed by document id. Membership tests
+    are O(1) and the ids can be narrowed down to some reason categories.
+    '''
+    
+    def __init__(self, fails = ()):
+        self._fails = OrderedDict()
+        for f in fails:
+            self.add(f['id'], f.get('reason'), f.get('category'))
+            
+    def add(self, id, reason = None, category = None):
+        self._fails[id] = (reason, category or failure_category(reason))
+        
+    def __contains__(self, id):
+        return id in self._fails
+    
+    def __len__(self):
+        return len(self._fails)
+    
+    def ids(self, categories = None):
+        '''Set of failed ids, only those in the given categories if set'''
+        if categories is None:
+            return set(self._fails)
+        return set(id for id, (reason, category) in self._fails.iteritems()
+                   if category in categories)
+        
+    def counts(self):
+        '''Number of failures per category'''
+        counts = dict((c, 0) for c in FAILURE_CATEGORIES)
+        for reason, category in self._fails.itervalues():
+            counts[category] += 1
+        return counts
+    
+    def to_list(self):
+        '''Failure list in the summary.yaml format'''
+        return [{'id': id, 'reason': reason, 'category': category}
+                for id, (reason, category) in self._fails.iteritems()]
         
 class ExtractionSummary(object):
+    '''
+    Failures of every extractor on a dataset, kept in result/summary.yaml.
+    
+    A shard writes a summary fragment, result/summary.shard-i-of-N.yaml, 
+    holding only the extractors it ran. merge_shards combines the fragments
+    into summary.yaml.
+    
+    Hits and misses of the extraction cache in the last run of an extractor
+    are kept under CACHE_STATS_KEY.
+    '''
+    
+    CACHE_STATS_KEY = 'extraction_cache'
     
     @verify_local_dataset
-    def __init__(self, dataset_name, extractor_slug = None):
-        self._summary_path = get_local_path(dataset_name,'result', 'summary.yaml')
+    def __init__(self, dataset_name, extractor_slug = None, shard = None):
+        self._summary_path = get_local_path(dataset_name,'result', 
+                                            'summary%s.yaml' % _shard_suffix(shard))
         
         if os.path.exists(self._summary_path):
             with open(self._summary_path,'r') as f:
                 self._summary_structure = yaml.load(f.read())
         else:
             self._summary_structure = {} 
-            for e in extractor_list:
-                self._summary_structure[e.SLUG] = []
+            if shard is None:
+                for e in extractor_list:
+                    self._summary_structure[e.SLUG] = []
                 
+        # a journal newer than the summary belongs to a run that never got
+        # to dump its summary (e.g. it crashed)
+        summary_mtime = os.path.getmtime(self._summary_path) \
+                        if os.path.exists(self._summary_path) else 0
+        for e in extractor_list:
+            journal = ExtractionJournal(dataset_name, e.SLUG, shard = shard)
+            if journal.exists() and os.path.getmtime(journal.path) > summary_mtime:
+                self._summary_structure[e.SLUG] = journal.failures()
+        
+        # add_fail may be called from several extraction threads
+        self._lock = threading.Lock()
         self.set_extractor(extractor_slug)
         
     def set_extractor(self, extractor_slug):
         if extractor_slug:
             self.extractor_slug = extractor_slug
-            self._summary_structure[self.extractor_slug] = []
+            self.reset_extractor(extractor_slug)
         else:
             self.extractor_slug = None
+            
+    def reset_extractor(self, extractor_slug):
+        '''Clear the list of fails for a single extractor'''
+        with self._lock:
+            self._summary_structure[extractor_slug] = []
+        
+    @property
+    def path(self):
+        return self._summary_path
+        
+    def extractor_slugs(self):
+        '''Slugs of the extractors the summary holds failures of'''
+        with self._lock:
+            return sorted(slug for slug in self._summary_structure 
+                          if slug != self.CACHE_STATS_KEY)
+        
+    def set_fails(self, extractor_slug, fails):
+        '''Replace the list of fails for a single extractor'''
+        with self._lock:
+            self._summary_structure[extractor_slug] = list(fails)
+        
+    def set_cache_stats(self, extractor_slug, hits, misses):
+        with self._lock:
+            stats = self._summary_structure.setdefault(self.CACHE_STATS_KEY, {})
+            stats[extractor_slug] = {'hits': hits, 'misses': misses}
+            
+    def get_cache_stats(self, extractor_slug):
+        '''Return (hits, misses) of the extraction cache or None'''
+        with self._lock:
+            stats = self._summary_structure.get(self.CACHE_STATS_KEY, {}).get(extractor_slug)
+        return (stats['hits'], stats['misses']) if stats else None
+        
+    def get_failures(self, extractor_slug):
+        '''FailureIndex of a single extractor'''
+        with self._lock:
+            return FailureIndex(self._summary_structure[extractor_slug])
         
-    def get_failed_ids(self, extractor_slug):
+    def get_failed_ids(self, extractor_slug, categories = None):
+        '''Set of failed ids, optionally only those in the given categories'''
         if self.extractor_slug:
             raise DataError('extractor_slug set - list of fails was reinitialized')
-        return [f['id'] for f in self._summary_structure[extractor_slug]]
+        return self.get_failures(extractor_slug).ids(categories)
         
-    def add_fail(self, id, reason = None):
-        if self.extractor_slug == None:
+    def add_fail(self, id, reason = None, extractor_slug = None):
+        '''
+        Record a failure for the current extractor. A summary shared by 
+        several storages has no current extractor, so they pass their slug.
+        '''
+        extractor_slug = extractor_slug or self.extractor_slug
+        if extractor_slug == None:
             raise DataError('extractor not set')
         
-        self._summary_structure[self.extractor_slug].append({
-            'id': id,
-            'reason': reason
-        })
+        with self._lock:
+            self._summary_structure[extractor_slug].append({
+                'id': id,
+                'reason': reason,
+                'category': failure_category(reason)
+            })
         
     def serialize(self):
+        with self._lock:
+            dump = yaml.dump(self._summary_structure, default_flow_style=False )
         with open(self._summary_path, 'w') as out:
-            out.write(yaml.dump(self._summary_structure, default_flow_style=False ))
+            out.write(dump)
     
     def short_summary(self, extractor_slug = None):
-        if extractor_slug:
-            return 'extraction summary: %i failed' \
-               % len(self._summary_structure[extractor_slug])
-        elif self.extractor_slug: 
-            return 'extraction summary: %i failed' \
-               % len(self._summary_structure[self.extractor_slug])
-        else:
+        extractor_slug = extractor_slug or self.extractor_slug
+        if extractor_slug == None:
             raise DataError('extractor not set')
+        failures = self.get_failures(extractor_slug)
+        counts = failures.counts()
+        return 'extraction summary: %i failed (%s)' % (len(failures), 
+            ', '.join(['%s: %i' % (c, counts[c]) for c in FAILURE_CATEGORIES]))
         
+_extraction_cache = None
+_extraction_cache_lock = threading.Lock()
+
+def get_extraction_cache():
+    '''
+    Return the process wide cache of extraction results, configured through
+    settings.EXTRACTION_CACHE_SIZE (megabytes, 0 disables the cache) and
+    settings.EXTRACTION_CACHE_PATH. Returns None if the cache is disabled.
+    Processes and shards share the file, so it should not be on NFS (see 
+    BlobCache).
+    '''
+    global _extraction_cache
+    with _extraction_cache_lock:
+        size = getattr(settings, 'EXTRACTION_CACHE_SIZE', 0)
+        if not size:
+            return None
+        path = getattr(settings, 'EXTRACTION_CACHE_PATH', None) or \
+            os.path.join(settings.PATH_LOCAL_DATA, 'extraction-cache.sqlite')
+        # settings may point somewhere else since the cache was opened
+        if _extraction_cache is not None and _extraction_cache.path != path:
+            _extraction_cache.close()
+            _extraction_cache = None
+        if _extraction_cache is None:
+            _extraction_cache = BlobCache(path, int(size * 1024 * 1024))
+        return _extraction_cache
+
+def close_extraction_cache():
+    global _extraction_cache
+    with _extraction_cache_lock:
+        if _extraction_cache is not None:
+            _extraction_cache.close()
+            _extraction_cache = None
+
+def extraction_cache_key(document, extractor_cls):
+    '''
+    Cache key of a document for an extractor: the hash of the raw html (and
+    its encoding) together with the extractor SLUG and VERSION. Identical
+    documents share their results across datasets.
+    '''
+    digest = hashlib.sha1(document.get_raw_html().encode('utf-8'))
+    digest.update('\0%s' % getattr(document, 'raw_encoding', ''))
+    return '%s:%s:%s' % (digest.hexdigest(), extractor_cls.SLUG, extractor_cls.VERSION)
+
 class BaseResultStorage(object):
-    
+
     def __init__(self, dataset_name, extractor_class):
         self.dataset =  dataset_name
         self.extractor_cls = extractor_class
-        
+
     def push_result(self, document):
         pass
-    
+
+    def cached_outcome(self, document):
+        '''Return an ExtractionOutcome if the result is known beforehand'''
+        return None
+
     def fetch_result(self, document): 
         pass
     
 class LocalResultStorage(BaseResultStorage):
+    '''
+    Stores results in result/<slug>/<id>.<FORMAT> (compressed and with the
+    suffix of the codec if the dataset is, see get_compression) and records
+    every outcome in the extraction journal (see ExtractionJournal for 
+    journal_mode). 
+    
+    Subclasses keep the results elsewhere by overriding _open_results,
+    _write_result, _read_result, _result_ids and flush.
+
+    Results of extractors with a VERSION are looked up in the extraction
+    cache (see get_extraction_cache) before the extractor runs. The storage
+    of a shard keeps its own journal and summary fragment (see Shard).
+    '''
     
     @verify_local_dataset
-    def __init__(self, dataset_name, extractor_class):
+    def __init__(self, dataset_name, extractor_class, summary = None,
+                 journal_mode = 'new', shard = None):
         super(LocalResultStorage, self).__init__(dataset_name, extractor_class)
         
         # with dataset name out of the way, we must now check the existance of
-        # the result folder for the given extractor
+        # the result container for the given extractor
         self._result_dir = get_local_path( self.dataset,'result')
-        
+        self._codec = get_compression(self.dataset)
+        self.shard = shard
+        self._open_results()
+            
+        # create an object to be serialized into a .yaml file
+        # we need this to store a summary of the extraction process for the 
+        # whole dataset; storages that run side by side must share one 
+        # summary or they would overwrite each other's fails on dump
+        if summary is None:
+            self._summary = ExtractionSummary(self.dataset, self.extractor_cls.SLUG, shard)
+        else:
+            self._summary = summary
+            self._summary.reset_extractor(self.extractor_cls.SLUG)
+            
+        # opened on the first stored outcome; results are flushed before the
+        # journal claims they are on disk
+        self._journal = ExtractionJournal(self.dataset, self.extractor_cls.SLUG,
+                                          journal_mode, before_sync = self.flush,
+                                          shard = shard)
+
+        if self.extractor_cls.VERSION is not None:
+            self._cache = get_extraction_cache()
+        else:
+            self._cache = None
+        self._stats_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _open_results(self):
         self._extractor_result_dir = os.path.join(
             self._result_dir,
             self.extractor_cls.SLUG)
@@ -213,48 +1042,328 @@ class LocalResultStorage(BaseResultStorage):
         if not os.path.exists( self._extractor_result_dir ):
             os.mkdir(self._extractor_result_dir)
             
-        # create an object to be serialized into a .yaml file
-        # we need this to store a summary of the extraction process for the 
-        # whole dataset
-        self._summary = ExtractionSummary(self.dataset, self.extractor_cls.SLUG)
+    def _result_path(self, id):
+        return os.path.join(self._extractor_result_dir, 
+                            '%s.%s' % (id, self.extractor_cls.FORMAT))
+            
+    def _write_result(self, id, result):
+        compression.write_file(self._result_path(id), result, self._codec)
+            
+    def _read_result(self, id):
+        # return None if there is no result
+        try:
+            return compression.read_file(self._result_path(id), self._codec)
+        except IOError:
+            return None
+        
+    def _result_ids(self):
+        return list(self.existing_ids(self.dataset, self.extractor_cls))
+    
+    @classmethod
+    def existing_ids(cls, dataset_name, extractor_cls):
+        '''Set of ids with a stored result, read with a single directory listing'''
+        suffix = '.' + extractor_cls.FORMAT
+        try:
+            names = os.listdir(get_local_path(dataset_name, 'result', extractor_cls.SLUG))
+        except OSError:
+            return set()
+        names = [compression.strip_suffix(name) for name in names]
+        return set(name[:-len(suffix)] for name in names if name.endswith(suffix))
+    
+    def flush(self):
+        '''Make sure every result written so far is on disk'''
+        pass
         
     def push_result(self, document):
-        extractor = self.extractor_cls(document)
+        self.store_result(document, self.extract_result(document))
+        
+    def extract_result(self, document, extractor = None):
+        '''
+        Run the extractor on a document and return an ExtractionOutcome. 
+        This method does not touch the storage, so it is safe to call it 
+        from several threads at once. A prepared extractor instance can be
+        passed in by runners that fetch the response themselves.
+        '''
+        outcome = self.cached_outcome(document)
+        if outcome is not None:
+            return outcome
+        if extractor is None:
+            extractor = self.extractor_cls(document)
+        return run_extractor(extractor)
+
+    def cached_outcome(self, document):
+        '''Return the outcome stored in the extraction cache or None'''
+        if self._cache is None:
+            return None
         try:
-            result = extractor.extract()
-        except DataError as e:
-            err_msg = 'Data related error: %r' % e
-            logger.warning(err_msg)
-            self._summary.add_fail(document.id, err_msg)
-        except ContentExtractorError as e:
-            err_msg = 'Content extractor related error: %r' % e
-            logger.warning(err_msg)
-            self._summary.add_fail(document.id, err_msg)
-        except ExtractorError as e:
-            err_msg = 'Extractor related error: %r' % e
-            logger.warning(err_msg)
-            self._summary.add_fail(document.id, err_msg)
-        except NotImplementedError:
-            logger.debug('extraction method is not implemented - do nothing')
-            pass
-        except Exception as e:
-            err_msg = 'Unknown error: %r' % e
-            logger.warning(err_msg)
-            self._summary.add_fail(document.id, err_msg)
-        else:
+            result = self._cache.get(extraction_cache_key(document, self.extractor_cls))
+        except sqlite3.Error as e:
+            # another process may hold the cache, extract instead
+            logger.warning('extraction cache lookup of %s failed: %r', document.id, e)
+            result = None
+        with self._stats_lock:
+            if result is None:
+                self.cache_misses += 1
+                return None
+            self.cache_hits += 1
+        return ExtractionOutcome(result, None, cached = True)
+
+    def store_result(self, document, outcome):
+        '''Write the result or record the failure held by an ExtractionOutcome'''
+        if outcome.error:
+            logger.warning(outcome.error)
+            self._summary.add_fail(document.id, outcome.error, self.extractor_cls.SLUG)
+            self._journal.append(document.id, False, outcome.error, outcome.latency)
+        elif outcome.result is not None:
             logger.debug('extracted content from %s', document.id)
-            output_file = '%s.%s' % (document.id,self.extractor_cls.FORMAT)
-            with open(os.path.join(self._extractor_result_dir, output_file), 'w') as out:
-                out.write(result)
+            self._write_result(document.id, outcome.result)
+            self._journal.append(document.id, True, None, outcome.latency)
+            if self._cache is not None and not outcome.cached:
+                try:
+                    self._cache.put(extraction_cache_key(document, self.extractor_cls),
+                                    outcome.result)
+                except sqlite3.Error as e:
+                    logger.warning('could not cache the result of %s: %r', document.id, e)
                 
     def fetch_result(self, document):
-        result_file = '%s.%s' % (document.id,self.extractor_cls.FORMAT)
-        result_file_path = os.path.join(self._extractor_result_dir, result_file)
-        if not os.path.exists(result_file_path):
-            raise DataError('result file %s does not exist' % result_file)
-        with open(result_file_path,'r') as f:
-            return f.read()
+        result = self._read_result(document.id)
+        if result is None:
+            raise DataError('result %s.%s does not exist' % (document.id, self.extractor_cls.FORMAT))
+        return result
         
     def dump_summary(self):
-        logger.info(self._summary.short_summary())
-        self._summary.serialize()
\ No newline at end of file
+        '''Close the journal and write summary.yaml derived from it'''
+        self._journal.close()
+        self.flush()
+        if self._journal.mode != 'new' and self._journal.exists():
+            self._summary.set_fails(self.extractor_cls.SLUG, self._journal.failures())
+        logger.info('%s %s', self.extractor_cls.NAME,
+                    self._summary.short_summary(self.extractor_cls.SLUG))
+        if self._cache is not None:
+            try:
+                self._cache.flush()
+            except sqlite3.Error as e:
+                logger.warning('could not flush the extraction cache: %r', e)
+            logger.info('%s extraction cache: %i hits, %i misses', self.extractor_cls.NAME,
+                        self.cache_hits, self.cache_misses)
+            self._summary.set_cache_stats(self.extractor_cls.SLUG, self.cache_hits,
+                                          self.cache_misses)
+        self._summary.serialize()
+        
+class PackedResultStorage(LocalResultStorage):
+    '''
+    Keeps all results of an extractor in a single SQLite file 
+    result/<slug>.sqlite instead of one file per document. Writes are 
+    committed in batches of batch_size results and lookups go through the
+    primary key index. Results of compressed datasets are stored compressed.
+    A shard writes to its own result/<slug>.shard-i-of-N.sqlite, which 
+    merge_shards folds into the main container.
+    '''
+    
+    batch_size = 500
+    
+    def _open_results(self):
+        self._db_path = os.path.join(self._result_dir, '%s%s.sqlite' 
+                                     % (self.extractor_cls.SLUG, _shard_suffix(self.shard)))
+        # the connection is shared by the threads of a FanOutRunner
+        self._db = sqlite3.connect(self._db_path, check_same_thread = False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS results '
+                         '(id TEXT PRIMARY KEY, content BLOB)')
+        self._db.commit()
+        self._db_lock = threading.Lock()
+        self._pending = 0
+        
+    def _write_result(self, id, result):
+        with self._db_lock:
+            self._db.execute('INSERT OR REPLACE INTO results VALUES (?, ?)',
+                             (unicode(id), sqlite3.Binary(compression.compress(result, self._codec))))
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self._commit()
+                
+    def _read_result(self, id):
+        with self._db_lock:
+            row = self._db.execute('SELECT content FROM results WHERE id = ?', 
+                                   (unicode(id),)).fetchone()
+        return compression.decompress(str(row[0])) if row else None
+    
+    def _result_ids(self):
+        with self._db_lock:
+            return [row[0].encode('utf-8') for row in self._db.execute('SELECT id FROM results')]
+        
+    @classmethod
+    def existing_ids(cls, dataset_name, extractor_cls):
+        '''Set of ids with a stored result, containers of shards included'''
+        ids = set()
+        for path in _packed_containers(dataset_name, extractor_cls.SLUG):
+            db = sqlite3.connect(path)
+            try:
+                ids.update(row[0].encode('utf-8') for row in db.execute('SELECT id FROM results'))
+            finally:
+                db.close()
+        return ids
+        
+    def _commit(self):
+        self._db.commit()
+        self._pending = 0
+        
+    def flush(self):
+        with self._db_lock:
+            self._commit()
+            
+    def close(self):
+        self.flush()
+        self._db.close()
+        
+def _packed_containers(dataset_name, slug):
+    # paths of the main container and the containers of shards
+    paths = [get_local_path(dataset_name, 'result', '%s.sqlite' % slug)]
+    paths.extend(path for path, shard in _shard_files(dataset_name, slug, '.sqlite'))
+    return [path for path in paths if os.path.exists(path)]
+
+def _shard_files(dataset_name, prefix, extension):
+    # (path, Shard) of the <prefix>.shard-i-of-N<extension> files in result/
+    result_dir = get_local_path(dataset_name, 'result')
+    files = []
+    for name in sorted(os.listdir(result_dir)):
+        if not (name.startswith(prefix + '.shard-') and name.endswith(extension)):
+            continue
+        match = _shard_re.match(name[len(prefix):-len(extension)])
+        if match:
+            files.append((os.path.join(result_dir, name), Shard(*map(int, match.groups()))))
+    return sorted(files, key = lambda f: f[1])
+
+# result storage backends selectable through settings.RESULT_STORAGE
+result_storage_map = (
+    ('files', LocalResultStorage),
+    ('packed', PackedResultStorage),
+)
+
+def get_result_storage_cls(name = None):
+    '''Return the storage class for a backend name (settings.RESULT_STORAGE by default)'''
+    name = name or getattr(settings, 'RESULT_STORAGE', 'files')
+    for backend, cls in result_storage_map:
+        if backend == name:
+            return cls
+    raise DataError('unknown result storage: %s' % name)
+
+def merge_shards(dataset_name):
+    '''
+    Fold the output of sharded runs into the files of an unsharded one: 
+    packed shard containers are copied into result/<slug>.sqlite and the 
+    summary fragments replace the failures of the documents their shard
+    processed in summary.yaml. Shards without a fragment (e.g. they crashed)
+    are merged from their journals. Merged shard files are removed. Returns
+    the number of merged shards.
+    '''
+    for ex in extractor_list:
+        containers = _shard_files(dataset_name, ex.SLUG, '.sqlite')
+        if not containers:
+            continue
+        db = sqlite3.connect(get_local_path(dataset_name, 'result', '%s.sqlite' % ex.SLUG))
+        try:
+            db.execute('CREATE TABLE IF NOT EXISTS results '
+                       '(id TEXT PRIMARY KEY, content BLOB)')
+            for path, shard in containers:
+                db.execute('ATTACH DATABASE ? AS shard', (path,))
+                db.execute('INSERT OR REPLACE INTO results SELECT id, content FROM shard.results')
+                db.commit()
+                db.execute('DETACH DATABASE shard')
+        finally:
+            db.close()
+        for path, shard in containers:
+            os.remove(path)
+    
+    # shards that crashed before dump_summary only left their journal
+    shards = set(shard for path, shard in _shard_files(dataset_name, 'summary', '.yaml'))
+    for ex in extractor_list:
+        shards.update(shard for path, shard in _shard_files(dataset_name, ex.SLUG, '.journal'))
+    
+    summary = ExtractionSummary(dataset_name)
+    merged = []
+    cache_stats = {}
+    for shard in sorted(shards):
+        # the fragment, with failures recovered from newer journals
+        fragment = ExtractionSummary(dataset_name, shard = shard)
+        for slug in fragment.extractor_slugs():
+            # the journal of the shard knows the documents that succeeded
+            journal = ExtractionJournal(dataset_name, slug, shard = shard)
+            fails = fragment.get_failures(slug).to_list()
+            processed = set(journal.latest())
+            processed.update(fail['id'] for fail in fails)
+            kept = [fail for fail in summary.get_failures(slug).to_list() 
+                    if fail['id'] not in processed]
+            summary.set_fails(slug, kept + fails)
+            merged.append(journal.path)
+            # cache statistics of the shards add up
+            stats = fragment.get_cache_stats(slug)
+            if stats:
+                total = cache_stats.setdefault(slug, [0, 0])
+                total[0] += stats[0]
+                total[1] += stats[1]
+        merged.append(fragment.path)
+    for slug, (hits, misses) in cache_stats.iteritems():
+        summary.set_cache_stats(slug, hits, misses)
+    summary.serialize()
+    for path in merged:
+        if os.path.exists(path):
+            os.remove(path)
+    return len(shards)
+
+def convert_results(dataset_name, extractor_cls, source_cls, target_cls):
+    '''Copy every stored result of an extractor between two backends'''
+    source = source_cls(dataset_name, extractor_cls)
+    target = target_cls(dataset_name, extractor_cls)
+    count = 0
+    for id in source._result_ids():
+        target._write_result(id, source._read_result(id))
+        count += 1
+    target.flush()
+    return count
+
+def _recompress_packed(path, codec, level = None):
+    # rewrite the results held by a PackedResultStorage file
+    db = sqlite3.connect(path)
+    before = after = 0
+    try:
+        for id, content in list(db.execute('SELECT id, content FROM results')):
+            content = str(content)
+            new = compression.compress(compression.decompress(content), codec, level)
+            db.execute('UPDATE results SET content = ? WHERE id = ?',
+                       (sqlite3.Binary(new), id))
+            before += len(content)
+            after += len(new)
+        db.commit()
+        db.execute('VACUUM')
+    finally:
+        db.close()
+    return before, after
+
+def compress_dataset(dataset_name, codec, level = None):
+    '''
+    Rewrite the raw documents, clean documents and stored results of a
+    dataset with codec (None stores them uncompressed). Returns the number
+    of files rewritten and their total size before and after.
+    '''
+    compression.check_codec(codec)
+    paths = []
+    for folder in ('raw', 'clean'):
+        directory = get_local_path(dataset_name, folder)
+        paths.extend(os.path.join(directory, name) for name in sorted(os.listdir(directory)))
+    result_dir = get_local_path(dataset_name, 'result')
+    packed = []
+    for name in sorted(os.listdir(result_dir)):
+        path = os.path.join(result_dir, name)
+        if os.path.isdir(path):
+            paths.extend(os.path.join(path, n) for n in sorted(os.listdir(path)))
+        elif name.endswith('.sqlite'):
+            packed.append(path)
+    before = after = 0
+    for path in paths:
+        before += os.path.getsize(path)
+        after += os.path.getsize(compression.recompress_file(path, codec, level))
+    for path in packed:
+        sizes = _recompress_packed(path, codec, level)
+        before += sizes[0]
+        after += sizes[1]
+    return len(paths) + len(packed), before, after
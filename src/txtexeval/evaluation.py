@@ -2,13 +2,15 @@ import os
 import re
 import pickle
 import string
-import difflib
 import math
+import hashlib
 import logging
 
 from BeautifulSoup import BeautifulSoup
 
 import settings
+from .matching import LCSMatcher, bow_match_counts
+from .util.cache import BlobCache
 
 logger = logging.getLogger(__name__)
 
@@ -203,8 +205,107 @@ class TextBasedResults(object):
             print 'fail:              %d' % rcontents.fail
             print 'dataset_len=%d' % self.dataset_len
                                              
+class EvaluationManifest(object):
+    '''
+    Records for every extractor and document the fingerprint of the inputs
+    it was evaluated on (hashes of the result and the gold standard) 
+    together with its Result, so a later run only evaluates documents whose
+    inputs changed. Fingerprints are only comparable between runs with the
+    same setup (dataset type, matcher, ...), the file keeps the entries of
+    every setup apart.
+    
+    With reuse set to False nothing is looked up, but the entries of the
+    evaluated extractors are still replaced on save.
+    '''
+    
+    def __init__(self, dataset_name, setup, reuse = True):
+        self.dataset_name = dataset_name
+        self.setup = setup
+        self.reuse = reuse
+        # slug -> {document id: (fingerprint, Result)}
+        self._entries = {}
+        self._fresh = {}
+        # setup -> entries of the other setups in the file
+        self._others = {}
+        self.reused = 0
+    
+    @property
+    def path(self):
+        return os.path.join(settings.PATH_LOCAL_DATA, 'results-cache',
+                            '%s.manifest.pickle' % self.dataset_name)
+        
+    def load(self):
+        try:
+            f = open(self.path, 'rb')
+        except IOError as e:
+            logger.info('no evaluation manifest found: %s', repr(e))
+            return
+        with f:
+            setups = pickle.load(f)['setups']
+        self._entries = setups.pop(self.setup, {})
+        self._others = setups
+        
+    def save(self):
+        '''Replace the entries of the extractors evaluated in this run and pickle the manifest'''
+        self._entries.update(self._fresh)
+        self._fresh = {}
+        setups = dict(self._others)
+        setups[self.setup] = self._entries
+        logger.info('saving evaluation manifest to: %s', self.path)
+        with open(self.path, 'wb') as f:
+            pickle.dump(dict(setups = setups), f, pickle.HIGHEST_PROTOCOL)
+            
+    def subset(self, slugs):
+        '''
+        Copy holding only what a run over the given extractors looks up:
+        their entries of this setup (none without reuse)
+        '''
+        manifest = EvaluationManifest(self.dataset_name, self.setup, self.reuse)
+        if self.reuse:
+            manifest._entries = dict((slug, self._entries[slug]) for slug in slugs
+                                     if slug in self._entries)
+        return manifest
+        
+    def begin(self, slug):
+        '''Start recording the entries of an extractor'''
+        self._fresh[slug] = {}
+        
+    def lookup(self, slug, id, fingerprint):
+        '''Return the Result recorded for unchanged inputs or None'''
+        if not self.reuse:
+            return None
+        entry = self._entries.get(slug, {}).get(id)
+        if entry is None or entry[0] != fingerprint:
+            return None
+        self.reused += 1
+        self.record(slug, id, *entry)
+        return entry[1]
+    
+    def record(self, slug, id, fingerprint, result):
+        self._fresh.setdefault(slug, {})[id] = (fingerprint, result)
+        
+    def take_records(self):
+        '''Return and forget the entries recorded so far as (slug, id, fingerprint, result)'''
+        records = [(slug, id) + entry for slug, entries in self._fresh.iteritems()
+                   for id, entry in entries.iteritems()]
+        self._fresh = {}
+        return records
+    
 # evaluators    
 
+def _result(rel_union_ret, ret_len, rel_len, id = None):
+    '''Result of an evaluation from the number of words retrieved, relevant and both'''
+    precision = float(rel_union_ret) / float(ret_len) \
+                if ret_len > 0 else float('inf')
+    recall = float(rel_union_ret) / float(rel_len) \
+                if rel_len > 0 else float('inf')
+                
+    # nan when prec or recall are inf 
+    f1_score = (2. * precision * recall)/(precision + recall) \
+                if precision + recall > 0 else float('inf')
+    
+    return Result(precision, recall, f1_score, id)
+
 class BaseEvaluator():
     '''Outline for evaluators'''
     
@@ -218,29 +319,52 @@ class BaseEvaluator():
         pass
     
 class TextOnlyEvaluator(BaseEvaluator):
+    '''
+    Precision and recall of the retrieved word sequence, the words both 
+    sequences share are counted by a matcher from txtexeval.matching 
+    (exact LCS by default).
+    '''
+    
+    _default_matcher = LCSMatcher()
+    
+    def __init__(self, retrieved, relevant, id = None, matcher = None):
+        BaseEvaluator.__init__(self, retrieved, relevant, id)
+        self.matcher = matcher or self._default_matcher
     
     def get_eval_results(self):
         
-        s = difflib.SequenceMatcher()
         rel = self.relevant.get_word_seq()
         ret = self.retrieved.get_word_seq()
         
-        s.set_seqs(rel, ret)
-        matches = s.get_matching_blocks()[:-1]
-        
-        rel_union_ret = sum(i.size for i in matches) if len(matches) > 0 else 0
-        
-        precision = float(rel_union_ret) / float(len(ret)) \
-                    if len(ret) > 0 else float('inf')
-        recall = float(rel_union_ret) / float(len(rel)) \
-                    if len(rel) > 0 else float('inf')
-                    
-        # nan when prec or recall are inf 
-        f1_score = (2. * precision * recall)/(precision + recall) \
-                    if precision + recall > 0 else float('inf')
+        rel_union_ret = self.matcher.count(rel, ret, self.id)
+        return _result(rel_union_ret, len(ret), len(rel), self.id)
         
-        return Result(precision, recall, f1_score, self.id)
+class BowEvaluator(BaseEvaluator):
+    '''
+    Precision and recall of the retrieved bag of words, the words both share
+    are counted as a multiset intersection and word order is ignored. The 
+    count is never lower than the one of TextOnlyEvaluator, which makes it 
+    a fast screening measure rather than a replacement.
+    '''
+    
+    def get_eval_results(self):
+        return self.batch_results(self.relevant, [self.retrieved], self.id)[0]
+    
+    @staticmethod
+    def batch_results(relevant, retrieved_formats, id = None):
+        '''Evaluate several retrieved formats against one relevant format at once'''
+        rel = relevant.get_bow()
+        rets = [r.get_bow() for r in retrieved_formats]
+        rel_len = sum(rel.itervalues())
+        return [_result(matched, sum(ret.itervalues()), rel_len, id)
+                for matched, ret in zip(bow_match_counts(rel, rets), rets)]
         
+# evaluators selectable in evaluate_manage
+evaluator_map = (
+    ('text', TextOnlyEvaluator),
+    ('bow', BowEvaluator),
+)
+
 #formats
     
 class BaseResultFormat(object):
@@ -263,6 +387,18 @@ class TextResultFormat(BaseResultFormat):
     def get_bow(self):
         return _bow(_tokenize_text(self._text))
     
+class TokenSequenceFormat(BaseResultFormat):
+    '''Format for text that has already been tokenized'''
+    
+    def __init__(self, word_seq):
+        self._word_seq = word_seq
+        
+    def get_word_seq(self):
+        return self._word_seq
+    
+    def get_bow(self):
+        return _bow(self._word_seq)
+    
 class CleanEvalFormat(BaseResultFormat):
     '''Format specific for cleaneval dataset'''
     
@@ -343,4 +479,88 @@ def from_document_factory(document, slug):
     '''
     map_ = dict(dataset_format_map)
     cls = map_[slug]
-    return cls.from_document(document)
\ No newline at end of file
+    return cls.from_document(document)
+
+class GoldTokenCache(object):
+    '''
+    Tokenized gold standard of the documents of an evaluation run. Every
+    clean document is parsed and tokenized once, no matter how many 
+    extractors are evaluated against it.
+    
+    With a BlobCache as store the word sequences are also kept on disk, 
+    keyed by the hash of the clean document, its encoding and the dataset
+    type, so later runs don't parse unchanged documents again.
+    '''
+    
+    # bump when the formats or _tokenize_text change their output
+    VERSION = '1'
+    
+    def __init__(self, dataset_type, store = None):
+        self.dataset_type = dataset_type
+        self._format_cls = dict(dataset_format_map)[dataset_type]
+        self._store = store
+        self._word_seqs = {}
+        self._keys = {}
+        self.parsed = 0
+        
+    def key(self, document):
+        '''Hash of the gold standard of a document, computed once per run'''
+        key = self._keys.get(document.id)
+        if key is None:
+            digest = hashlib.sha1(document.get_clean())
+            digest.update('\0%s' % getattr(document, 'clean_encoding', ''))
+            key = '%s:%s:%s' % (digest.hexdigest(), self.dataset_type, self.VERSION)
+            self._keys[document.id] = key
+        return key
+        
+    def word_seq(self, document):
+        '''Return the tokenized gold standard of a document'''
+        word_seq = self._word_seqs.get(document.id)
+        if word_seq is not None:
+            return word_seq
+        key = None
+        if self._store is not None:
+            key = self.key(document)
+            content = self._store.get(key)
+            if content is not None:
+                # tokens never contain whitespace
+                word_seq = content.split(' ') if content else []
+        if word_seq is None:
+            word_seq = self._format_cls.from_document(document).get_word_seq()
+            self.parsed += 1
+            if key is not None:
+                self._store.put(key, ' '.join(word_seq))
+        self._word_seqs[document.id] = word_seq
+        return word_seq
+    
+    def forget(self, document):
+        '''Drop the word sequence of a document from memory'''
+        self._word_seqs.pop(document.id, None)
+        self._keys.pop(document.id, None)
+    
+    def format(self, document):
+        '''Return the gold standard of a document as a result format'''
+        return TokenSequenceFormat(self.word_seq(document))
+    
+    def flush(self):
+        if self._store is not None:
+            self._store.flush()
+            
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+def get_gold_cache(dataset_type):
+    '''
+    Return a GoldTokenCache for an evaluation run. It is persisted to disk if
+    settings.GOLD_CACHE_SIZE (megabytes, 0 disables persistence) is set, at
+    settings.GOLD_CACHE_PATH.
+    '''
+    store = None
+    size = getattr(settings, 'GOLD_CACHE_SIZE', 0)
+    if size:
+        path = getattr(settings, 'GOLD_CACHE_PATH', None) or \
+            os.path.join(settings.PATH_LOCAL_DATA, 'gold-cache.sqlite')
+        store = BlobCache(path, int(size * 1024 * 1024))
+    return GoldTokenCache(dataset_type, store)
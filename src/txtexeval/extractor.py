@@ -1,24 +1,30 @@
 import urllib
 import json
 import logging
-import time
-
-import readability
-import justext
-from selenium import webdriver
-from selenium.webdriver import FirefoxProfile
-from selenium.common.exceptions import NoSuchElementException
+import threading
+from collections import OrderedDict
 
 import settings
-from .util import Request, html_to_text
-from .util.zemanta.client import ClientManager
+from .util import Request, RateLimiter, html_to_text
+from .util.browser import DriverPool
 from .evaluation import TextResultFormat, CleanEvalFormat
 
+# readability, justext, selenium and the thrift client are imported by the 
+# extractors that use them, so importing this module stays cheap
+
 logging.getLogger('selenium').setLevel(logging.WARN)
 
 class ExtractorError(Exception):
-    '''Extractor failed on the network layer'''
-    pass
+    '''
+    Extractor failed on the network layer. status is the HTTP status code 
+    of the failed response (None if there was none) and timeout is set when
+    the request timed out.
+    '''
+    
+    def __init__(self, msg, status = None, timeout = False):
+        super(ExtractorError, self).__init__(msg)
+        self.status = status
+        self.timeout = timeout
 
 class ContentExtractorError(ExtractorError):
     '''
@@ -37,7 +43,8 @@ def return_content(extract):
         response = extract(self)
         # check for any network related errors
         if not response.success():
-            raise ExtractorError(response.err_msg) 
+            raise ExtractorError(response.err_msg, response.status_code, 
+                                 response.timed_out)
         return response.content
     return wrapper
 
@@ -66,9 +73,31 @@ class BaseExtractor(object):
     SLUG = ''# unique slug name ([a-z_]+)
     FORMAT = ''# txt|html|json|xml
     
+    # set to False if instances can not run extract() from several 
+    # threads at once (e.g. they share a single connection or browser)
+    CONCURRENT = True
+    
+    # keyword arguments for the RateLimiter (rate, burst, max_in_flight)
+    # shared by all instances; settings.RATE_LIMITS takes precedence
+    RATE_LIMIT = None
+    
+    # set to True if extract() does its work in the calling process, runners
+    # then use worker processes instead of threads
+    CPU_BOUND = False
+    
+    # set for extractors whose output depends on the raw html alone, their
+    # results are then kept in the extraction cache under (raw html, SLUG, 
+    # VERSION); change it whenever extract() starts producing other output
+    VERSION = None
+    
     def __init__(self, data_instance):
         self.data_instance = data_instance
         
+    @classmethod
+    def warm_up(cls):
+        '''Load anything that should be shared between extract calls'''
+        pass
+        
     def extract(self):
         '''Returns unformatted extractor resposne'''
         pass
@@ -85,6 +114,32 @@ class _ContentCheckMin(object):
         if js['status'] == "ERROR":
             raise ContentExtractorError(js['errorMsg'].encode('utf-8','ignore'))
         
+class _RequestMin(object):
+    '''
+    Mixin for extractors that send a single HTTP request. Subclasses build
+    the Request in request() and let extract() call fetch(), which gives 
+    non-blocking runners the chance to send the request themselves and hand
+    the response back through feed_response().
+    '''
+    
+    _http_method = 'POST'
+    _response = None
+    
+    def request(self):
+        raise NotImplementedError
+    
+    def prepared_request(self):
+        '''Return the (method, url, body, headers) tuple fetch() would send'''
+        return self.request().prepare(self._http_method)
+    
+    def fetch(self):
+        if self._response is None:
+            self._response = self.request().send(self._http_method)
+        return self._response
+    
+    def feed_response(self, response):
+        self._response = response
+        
 class _FormattedResultMin(object):
     
     @classmethod
@@ -93,7 +148,7 @@ class _FormattedResultMin(object):
         return TextResultFormat(js['result'].encode('utf8','ignore'))
 
 
-class TTRDefaultExtractor(_ContentCheckMin,BaseExtractor):
+class TTRDefaultExtractor(_ContentCheckMin,_RequestMin,BaseExtractor):
     '''Boilerpipe default extractor '''
     
     NAME = 'TTR'
@@ -102,9 +157,7 @@ class TTRDefaultExtractor(_ContentCheckMin,BaseExtractor):
     
     _extractor_type = 'default'
     
-    @check_content_status
-    @return_content
-    def extract(self):
+    def request(self):
         html = self.data_instance.get_raw_html()
         req = Request(
             settings.TTR_API_ENDPOINT,
@@ -114,7 +167,12 @@ class TTRDefaultExtractor(_ContentCheckMin,BaseExtractor):
             },
             headers = {'Content-Type':'application/x-www-form-urlencoded'}
         )
-        return req.post()
+        return req
+    
+    @check_content_status
+    @return_content
+    def extract(self):
+        return self.fetch()
     
     @classmethod
     def formatted_result(cls, result_string):
@@ -124,7 +182,7 @@ class TTRDefaultExtractor(_ContentCheckMin,BaseExtractor):
 
 
        
-class BoilerpipeDefaultExtractor(_FormattedResultMin,_ContentCheckMin,BaseExtractor):
+class BoilerpipeDefaultExtractor(_FormattedResultMin,_ContentCheckMin,_RequestMin,BaseExtractor):
     '''Boilerpipe default extractor '''
     
     NAME = 'Boilerpipe DEF'
@@ -133,9 +191,7 @@ class BoilerpipeDefaultExtractor(_FormattedResultMin,_ContentCheckMin,BaseExtrac
     
     _extractor_type = 'default'
     
-    @check_content_status
-    @return_content
-    def extract(self):
+    def request(self):
         html = self.data_instance.get_raw_html()
         req = Request(
             settings.BOILERPIPE_API_ENDPOINT,
@@ -145,7 +201,12 @@ class BoilerpipeDefaultExtractor(_FormattedResultMin,_ContentCheckMin,BaseExtrac
             },
             headers = {'Content-Type':'application/x-www-form-urlencoded'}
         )
-        return req.post()
+        return req
+    
+    @check_content_status
+    @return_content
+    def extract(self):
+        return self.fetch()
         
     
 class BoilerpipeArticleExtractor(BoilerpipeDefaultExtractor):
@@ -166,32 +227,34 @@ class BoilerpipeArticleSentencesExtractor(BoilerpipeDefaultExtractor):
     
     _extractor_type = 'sentence'
     
-class GooseExtractor(_FormattedResultMin,_ContentCheckMin,BaseExtractor):
+class GooseExtractor(_FormattedResultMin,_ContentCheckMin,_RequestMin,BaseExtractor):
     '''Goose project extractor'''
     
     NAME = 'Goose'
     SLUG = 'goose'
     FORMAT = 'json'
     
-    @return_content
-    def extract(self):
+    def request(self):
         html = self.data_instance.get_raw_html()
         req = Request(
             settings.GOOSE_API_ENDPOINT,
             data = dict(rawHtml = html.encode(self.data_instance.raw_encoding,'ignore')),
             headers = {'Content-Type':'application/x-www-form-urlencoded'}
         )
-        return req.post()
+        return req
     
-class MSSExtractor(BaseExtractor):
+    @return_content
+    def extract(self):
+        return self.fetch()
+    
+class MSSExtractor(_RequestMin,BaseExtractor):
     '''MSS implementation by Jeffrey Pasternack'''
     
     NAME = 'MSS'
     SLUG = 'mss'
     FORMAT = 'html'
     
-    @return_content
-    def extract(self):
+    def request(self):
         html = self.data_instance.get_raw_html()
         req = Request(
             dict(settings.MSS_URL)['text'],
@@ -199,7 +262,11 @@ class MSSExtractor(BaseExtractor):
             data = html.encode('utf-8','ignore'),
             headers= {'Content-Type': 'text/plain;charset=UTF-8'}
         )
-        return req.post()
+        return req
+    
+    @return_content
+    def extract(self):
+        return self.fetch()
     
     @classmethod
     def formatted_result(cls, result_string):
@@ -214,7 +281,11 @@ class PythonReadabilityExtractor(BaseExtractor):
     SLUG = 'python_read'
     FORMAT = 'html'
     
+    CPU_BOUND = True
+    VERSION = '1'
+    
     def extract(self):
+        import readability
         html = self.data_instance.get_raw_html()
         doc = readability.Document(html)
         # FIXME
@@ -224,16 +295,14 @@ class PythonReadabilityExtractor(BaseExtractor):
     def formatted_result(cls, result_string):
         return TextResultFormat(html_to_text(result_string, 'utf8'))
     
-class NodeReadabilityExtractor(_FormattedResultMin,BaseExtractor):
+class NodeReadabilityExtractor(_FormattedResultMin,_RequestMin,BaseExtractor):
     '''Extractor based on node-readability'''
     
     NAME = 'Node Readability'
     SLUG = 'node_read'
     FORMAT = 'json'
     
-    @check_content_status
-    @return_content
-    def extract(self):
+    def request(self):
         html = self.data_instance.get_raw_html()
         
         req = Request(
@@ -242,7 +311,12 @@ class NodeReadabilityExtractor(_FormattedResultMin,BaseExtractor):
             data = html.encode('utf-8','ignore'),
             headers= {'Content-Type': 'text/plain;charset=UTF-8'}
         )
-        return req.post() 
+        return req
+    
+    @check_content_status
+    @return_content
+    def extract(self):
+        return self.fetch()
     
     def _content_status(self):
         js = json.loads(self._content, encoding = 'utf8')
@@ -259,60 +333,74 @@ class SeleniumReadabilityExtractor(BaseExtractor):
     SLUG = 'orig_read'
     FORMAT = 'txt'
     
-    _driver = None # lazy webdriver.Firefox()
+    # every extraction checks out its own browser from driver_pool()
+    _pool = None
+    _pool_lock = threading.Lock()
+    
     #TODO: share the modified code
     _bookmarklet_source = "(function(){readConvertLinksToFootnotes=false;readStyle='style-newspaper';readSize='size-medium';readMargin='margin-wide';_bookm=document.createElement('script');_bookm.type='text/javascript';_bookm.src='" + \
     settings.READABILITY_BOOKMARKLET + "?x='+Math.random();document.getElementsByTagName('head')[0].appendChild(_bookm);})();"
     
-    def _check_content_presence(self):
-        cls = self.__class__
-        try:
-            # this was a modification to readability.js script
-            # if it failed to extract any meaningful content
-            # we renamed the id of the content block to
-            # explicitly indicate this special case
-            cls._driver.find_element_by_id('readability-content-failed')
-        except NoSuchElementException:
-            pass
-        else:
-            raise ContentExtractorError('readability failed to extract any content')
+    @staticmethod
+    def driver_factory():
+        from selenium import webdriver
+        return webdriver.Firefox()
+    
+    @classmethod
+    def driver_pool(cls):
+        with cls._pool_lock:
+            if cls._pool is None:
+                cls._pool = DriverPool(cls.driver_factory,
+                    size = getattr(settings, 'SELENIUM_DRIVERS', 1),
+                    recycle_after = getattr(settings, 'SELENIUM_RECYCLE_AFTER', 100))
+            return cls._pool
+    
+    @staticmethod
+    def _readability_done(driver):
+        # this was a modification to readability.js script
+        # if it failed to extract any meaningful content
+        # we renamed the id of the content block to
+        # explicitly indicate this special case
+        return bool(driver.find_elements_by_id('readInner') or
+                    driver.find_elements_by_id('readability-content-failed'))
     
     def extract(self):
-        # lazy init
-        cls = self.__class__
-        if cls._driver == None:
-            # init firefox web driver
-            cls._driver = webdriver.Firefox()
-        
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.common.exceptions import TimeoutException
         url = self.data_instance.get_url_local()
-        cls._driver.get(url)
-        time.sleep(2)
-        cls._driver.execute_script(self._bookmarklet_source)
-        
-        try:
-            # find the node that contains  content
-            # and check if readability managed to extract anything meaningful
-            element = cls._driver.find_element_by_id('readInner')
-            self._check_content_presence()
-        except NoSuchElementException:
+        timeout = getattr(settings, 'SELENIUM_WAIT_TIMEOUT', 10)
+        with self.driver_pool().driver() as driver:
+            driver.get(url)
+            driver.execute_script(self._bookmarklet_source)
+            try:
+                WebDriverWait(driver, timeout, 0.1).until(self._readability_done)
+            except TimeoutException:
+                failed, elements = False, []
+            else:
+                failed = bool(driver.find_elements_by_id('readability-content-failed'))
+                elements = driver.find_elements_by_id('readInner')
+            text = elements[0].text if elements else None
+        # content errors are raised once the browser is back in the pool
+        if failed:
+            raise ContentExtractorError('readability failed to extract any content')
+        if text is None:
             raise ContentExtractorError('readability failed to produce the #readInner DOM node')
-        else:
-            return element.text.encode(self.data_instance.raw_encoding, 'ignore')
+        return text.encode(self.data_instance.raw_encoding, 'ignore')
         
     @classmethod
     def formatted_result(cls, result_string):
         return TextResultFormat(result_string)
 
-class AlchemyExtractor(BaseExtractor):
+class AlchemyExtractor(_RequestMin,BaseExtractor):
     '''Alchemy API extractor'''
     
     NAME = 'Alchemy API'
     SLUG = 'alchemy'
     FORMAT = 'json'
     
-    @check_content_status
-    @return_content
-    def extract(self):
+    RATE_LIMIT = dict(rate = 5, burst = 10, max_in_flight = 5)
+    
+    def request(self):
         html = self.data_instance.get_raw_html()
         req = Request(
             'http://access.alchemyapi.com/calls/html/HTMLGetText',
@@ -322,7 +410,12 @@ class AlchemyExtractor(BaseExtractor):
             } 
             
         )
-        return req.post()
+        return req
+    
+    @check_content_status
+    @return_content
+    def extract(self):
+        return self.fetch()
     
     def _content_status(self):
         js = json.loads(self._content, encoding = 'utf8')
@@ -334,15 +427,18 @@ class AlchemyExtractor(BaseExtractor):
         js = json.loads(result_string, encoding = 'utf8')
         return TextResultFormat(js['text'].encode('utf8','ignore'))
         
-class DiffbotExtractor(BaseExtractor):
+class DiffbotExtractor(_RequestMin,BaseExtractor):
     '''Diffbot extractor'''
     
     NAME = 'Diffbot'
     SLUG = 'diffbot'
     FORMAT = 'json'
     
-    @return_content
-    def extract(self):        
+    RATE_LIMIT = dict(rate = 5, burst = 5, max_in_flight = 5)
+    
+    _http_method = 'GET'
+    
+    def request(self):
         data = urllib.urlencode(dict(
             token = settings.DIFFBOT_API_KEY,
             url = self.data_instance.get_url(),
@@ -353,7 +449,11 @@ class DiffbotExtractor(BaseExtractor):
             'http://www.diffbot.com/api/article',
             data = data
         )
-        return req.get()
+        return req
+    
+    @return_content
+    def extract(self):
+        return self.fetch()
     
     @classmethod
     def formatted_result(cls, result_string):
@@ -363,15 +463,16 @@ class DiffbotExtractor(BaseExtractor):
             js['text'].encode('utf8','ignore')
         )
     
-class ExtractivExtractor(BaseExtractor):
+class ExtractivExtractor(_RequestMin,BaseExtractor):
     '''Extractiv extractor'''
     
     NAME = 'Extractiv'
     SLUG = 'extractiv'
     FORMAT = 'json'
     
-    @return_content
-    def extract(self):
+    RATE_LIMIT = dict(rate = 2, burst = 2, max_in_flight = 2)
+    
+    def request(self):
         html = self.data_instance.get_raw_html()
         req = Request(
             'http://rest.extractiv.com/extractiv/',
@@ -381,7 +482,11 @@ class ExtractivExtractor(BaseExtractor):
             } 
             
         )
-        return req.post()
+        return req
+    
+    @return_content
+    def extract(self):
+        return self.fetch()
     
     @classmethod
     def formatted_result(cls, result_string):
@@ -399,22 +504,29 @@ class ExtractivExtractor(BaseExtractor):
             (' '.join(content_sentences)).encode('utf8','ignore')
         )
         
-class RepustateExtractor(BaseExtractor):
+class RepustateExtractor(_RequestMin,BaseExtractor):
     '''Repustate extractor'''
     
     NAME = 'Repustate'
     SLUG = 'repustate'
     FORMAT = 'json'
     
-    @check_content_status
-    @return_content
-    def extract(self):
+    RATE_LIMIT = dict(rate = 1, burst = 1, max_in_flight = 1)
+    
+    _http_method = 'GET'
+    
+    def request(self):
         req  = Request(
             'http://api.repustate.com/v1/%s/clean-html.json' \
              % settings.REPUSTATE_API_KEY,
             data = 'url=%s' % self.data_instance.get_url()
         )
-        return req.get()
+        return req
+    
+    @check_content_status
+    @return_content
+    def extract(self):
+        return self.fetch()
     
     def _content_status(self):
         js = json.loads(self._content, encoding = 'utf8')
@@ -436,6 +548,7 @@ class ZemantaExtractor(BaseExtractor):
     def extract(self):
         html = self.data_instance.get_raw_html()
         html = html.encode(self.data_instance.raw_encoding,'ignore')
+        from .util.zemanta.client import ClientManager
         cm = ClientManager()
         
         response = cm.extract(html, self.data_instance.raw_encoding)
@@ -474,16 +587,16 @@ class NCleanerNonLexExtractor(NCleanerStdEnExtractor):
     SLUG = 'ncleaner_nonlex'
     FORMAT = 'txt'
     
-class TrendictionExtractor(BaseExtractor):
+class TrendictionExtractor(_RequestMin,BaseExtractor):
     '''Trendiction API'''
     
     NAME = 'Trendiction'
     SLUG = 'trendiction'
     FORMAT = 'json'
     
-    @check_content_status
-    @return_content
-    def extract(self):
+    _http_method = 'GET'
+    
+    def request(self):
         req  = Request(
             settings.TRENDICTION_ENDPOINT,
             data = {
@@ -493,7 +606,12 @@ class TrendictionExtractor(BaseExtractor):
                 'outf':'json',
             }
         )
-        return req.get()
+        return req
+    
+    @check_content_status
+    @return_content
+    def extract(self):
+        return self.fetch()
     
     def _content_status(self):
         js = json.loads(self._content, encoding = 'utf8')
@@ -517,10 +635,23 @@ class JustextExtractor(BaseExtractor):
     SLUG = 'justext'
     FORMAT = 'txt'
     
+    CPU_BOUND = True
+    VERSION = '1'
+    
+    _stoplist = None # lazy justext.get_stoplist('English')
+    
+    @classmethod
+    def warm_up(cls):
+        if cls._stoplist is None:
+            import justext
+            cls._stoplist = justext.get_stoplist('English')
+    
     def extract(self):
+        import justext
+        self.warm_up()
         html = self.data_instance.get_raw_html()
         html = html.encode(self.data_instance.raw_encoding,'ignore')
-        paragraphs = justext.justext(html, justext.get_stoplist('English'),
+        paragraphs = justext.justext(html, self._stoplist,
                              encoding = self.data_instance.raw_encoding)    
         good_paragraphs = []
         for para in paragraphs:
@@ -561,9 +692,31 @@ extractor_list = (
     TTRDefaultExtractor,
 )
 
+def is_request_based(extractor_cls):
+    '''True for extractors that implement request() and fetch()'''
+    return issubclass(extractor_cls, _RequestMin)
+
+# extractor classes keyed by slug, in the order of extractor_list
+extractor_registry = OrderedDict((e.SLUG, e) for e in extractor_list)
+
 def get_extractor_cls(extractor_slug):
-    '''Return the extractor class given a slug'''
-    for e in extractor_list:
-        if e.SLUG == extractor_slug: 
-            return e
+    '''Return the extractor class given a slug (None for an unknown slug)'''
+    return extractor_registry.get(extractor_slug)
+        
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(extractor_cls):
+    '''
+    Return the RateLimiter shared by every run of the given extractor class. 
+    Limits are read from settings.RATE_LIMITS (keyed by slug) or from the
+    RATE_LIMIT class attribute. An extractor without limits gets a limiter
+    that never blocks.
+    '''
+    with _rate_limiters_lock:
+        if extractor_cls.SLUG not in _rate_limiters:
+            limits = getattr(settings, 'RATE_LIMITS', {}).get(extractor_cls.SLUG,
+                                                              extractor_cls.RATE_LIMIT)
+            _rate_limiters[extractor_cls.SLUG] = RateLimiter(**(limits or {}))
+        return _rate_limiters[extractor_cls.SLUG]
     
\ No newline at end of file
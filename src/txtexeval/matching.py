@@ -0,0 +1,142 @@
+'''
+Counting the words two token sequences have in common, used by
+TextOnlyEvaluator.
+
+The count is the length of the longest common subsequence (LCS). Tokens
+are interned to integers and the LCS is computed with the bit-parallel
+algorithm of Allison and Dix: every token of the shorter sequence updates
+a bit vector (a python long) as wide as the longer one, which makes long
+documents a matter of milliseconds.
+'''
+import difflib
+import logging
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+def intern_tokens(a, b):
+    '''Map the tokens of two sequences to integers, equal tokens share one'''
+    ids = {}
+    a = [ids.setdefault(token, len(ids)) for token in a]
+    b = [ids.setdefault(token, len(ids)) for token in b]
+    return a, b
+
+def lcs_length(a, b):
+    '''Length of the longest common subsequence of two sequences'''
+    # the common prefix and suffix are matched without the bit vector
+    start = 0
+    end_a, end_b = len(a), len(b)
+    while start < end_a and start < end_b and a[start] == b[start]:
+        start += 1
+    while end_a > start and end_b > start and a[end_a - 1] == b[end_b - 1]:
+        end_a -= 1
+        end_b -= 1
+    trimmed = start + len(a) - end_a
+    a, b = intern_tokens(a[start:end_a], b[start:end_b])
+    if not a or not b:
+        return trimmed
+    if len(a) < len(b):
+        a, b = b, a
+    # bit i of masks[t] is set where a[i] == t
+    masks = {}
+    for i, token in enumerate(a):
+        masks[token] = masks.get(token, 0) | (1 << i)
+    full = (1 << len(a)) - 1
+    v = full
+    for token in b:
+        u = v & masks.get(token, 0)
+        v = ((v + u) | (v - u)) & full
+    # every zero bit is a matched token
+    return trimmed + len(a) - bin(v).count('1')
+
+def difflib_match_count(a, b, autojunk = True):
+    '''
+    Number of tokens in the matching blocks difflib.SequenceMatcher finds.
+    This is what evaluations used to report. It can be lower than the LCS,
+    and with autojunk frequent tokens of long sequences are never matched.
+    '''
+    matcher = difflib.SequenceMatcher(None, a, b, autojunk)
+    return sum(block.size for block in matcher.get_matching_blocks())
+
+def bow_match_counts(relevant_bow, retrieved_bows):
+    '''
+    Size of the multiset intersection of a bag of words with each of several
+    others, as a list of ints. The retrieved bags become rows of a count 
+    matrix over the vocabulary of relevant_bow (other words can't be 
+    shared), so all of them are intersected in one batched operation.
+    '''
+    import numpy as np
+    vocabulary = {}
+    relevant = np.zeros(len(relevant_bow), dtype = np.int64)
+    for column, (word, count) in enumerate(relevant_bow.iteritems()):
+        vocabulary[word] = column
+        relevant[column] = count
+    counts = np.zeros((len(retrieved_bows), len(vocabulary)), dtype = np.int64)
+    for row, bow in enumerate(retrieved_bows):
+        shared = [(vocabulary[word], count) for word, count in bow.iteritems()
+                  if word in vocabulary]
+        if shared:
+            columns, values = zip(*shared)
+            counts[row, list(columns)] = values
+    return [int(c) for c in np.minimum(counts, relevant).sum(axis = 1)]
+
+class LCSMatcher(object):
+    '''Exact match count (the default)'''
+
+    def count(self, relevant, retrieved, id = None):
+        return lcs_length(relevant, retrieved)
+
+class DifflibMatcher(object):
+    '''Match count of difflib.SequenceMatcher, as in earlier evaluations'''
+
+    def count(self, relevant, retrieved, id = None):
+        return difflib_match_count(relevant, retrieved)
+
+class ParityMatcher(LCSMatcher):
+    '''
+    Reports the exact match count like LCSMatcher and additionally checks it
+    against difflib. Documents whose counts differ are logged and kept in
+    diverged as (id, lcs count, difflib count).
+    '''
+
+    def __init__(self):
+        self.checked = 0
+        self.diverged = []
+
+    def count(self, relevant, retrieved, id = None):
+        exact = lcs_length(relevant, retrieved)
+        legacy = difflib_match_count(relevant, retrieved)
+        self.checked += 1
+        if exact != legacy:
+            logger.info('match count of %s differs: %d (lcs) != %d (difflib)',
+                        id, exact, legacy)
+            self.diverged.append((id, exact, legacy))
+        return exact
+
+    def merge(self, other):
+        '''Add the documents checked by another ParityMatcher'''
+        self.checked += other.checked
+        self.diverged.extend(other.diverged)
+
+    def summary(self):
+        if not self.diverged:
+            return 'parity: %d documents, no divergence from difflib' % self.checked
+        largest = max(self.diverged, key = lambda d: abs(d[1] - d[2]))
+        return 'parity: %d of %d documents diverge from difflib (largest: %s, %d != %d)' \
+            % ((len(self.diverged), self.checked) + largest)
+
+# matchers selectable through settings.MATCHER
+matcher_map = (
+    ('lcs', LCSMatcher),
+    ('difflib', DifflibMatcher),
+    ('parity', ParityMatcher),
+)
+
+def get_matcher(name = None):
+    '''Return a new matcher given its name (settings.MATCHER by default)'''
+    name = name or getattr(settings, 'MATCHER', 'lcs')
+    for matcher_name, cls in matcher_map:
+        if matcher_name == name:
+            return cls()
+    raise ValueError('unknown matcher: %s' % name)
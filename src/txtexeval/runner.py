@@ -0,0 +1,464 @@
+'''
+Runners that push every document yielded by a dataset loader through a
+result storage, either one by one or concurrently.
+'''
+import time
+import heapq
+import threading
+import Queue
+import logging
+import collections
+import multiprocessing
+import multiprocessing.pool
+
+from .util import RateLimiter, Request, common
+from .util.connection import split_url
+from .util.asynchttp import AsyncHTTPClient
+from .data import run_extractor, ExtractionOutcome
+
+logger = logging.getLogger(__name__)
+
+def _guarded_extract(extract, doc):
+    '''
+    Call extract(doc) on a worker thread. Errors outside of run_extractor 
+    (e.g. of the storage) become failed outcomes, a dead worker would leave
+    the runner waiting for its outcome forever.
+    '''
+    try:
+        return extract(doc)
+    except Exception as e:
+        logger.exception('extraction of %s failed', doc.id)
+        return ExtractionOutcome(None, 'Unknown error: %r' % e)
+
+class _OrderedStore(object):
+    '''Store outcomes in the order the documents were submitted in'''
+    
+    def __init__(self, storage):
+        self.storage = storage
+        self.stored = 0
+        self._pending = {}
+        
+    def put(self, index, doc, outcome):
+        self._pending[index] = (doc, outcome)
+        while self.stored in self._pending:
+            doc, outcome = self._pending.pop(self.stored)
+            self.storage.store_result(doc, outcome)
+            self.stored += 1
+
+class BaseRunner(object):
+    '''
+    Runners take care of scheduling extraction jobs. A runner must leave the
+    storage in the same state a plain loop over push_result would, no matter
+    how the work is actually distributed.
+    
+    Every extraction is wrapped in the given RateLimiter, so the same limits 
+    hold regardless of the runner.
+    '''
+
+    def __init__(self, storage, limiter = None):
+        self.storage = storage
+        self.limiter = limiter or RateLimiter()
+        
+    def _extract(self, doc):
+        with self.limiter:
+            return self.storage.extract_result(doc)
+
+    def run(self, loader):
+        raise NotImplementedError
+
+class SerialRunner(BaseRunner):
+    '''Extract one document at a time in the calling thread'''
+
+    def run(self, loader):
+        for doc in loader:
+            self.storage.store_result(doc, self._extract(doc))
+
+class ThreadedRunner(BaseRunner):
+    '''
+    Extract documents on a pool of worker threads.
+
+    Workers only call storage.extract_result, outcomes are stored by the
+    calling thread in the order the loader yielded the documents. This way
+    the failure list in summary.yaml is identical to the one of a serial run.
+    '''
+
+    def __init__(self, storage, workers, limiter = None):
+        super(ThreadedRunner, self).__init__(storage, limiter)
+        if workers < 1:
+            raise ValueError('at least one worker is required')
+        self.workers = workers
+
+    def _work(self, tasks, done):
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            index, doc = task
+            done.put((index, doc, _guarded_extract(self._extract, doc)))
+
+    def _store_ready(self, done, ordered, block):
+        # store finished outcomes that are next in line 
+        # (a timed get keeps the main thread responsive to Ctrl-C)
+        try:
+            while True:
+                ordered.put(*done.get(block, 1))
+                block = False
+        except Queue.Empty:
+            pass
+
+    def run(self, loader):
+        # bounded task queue keeps the loader from running too far ahead
+        tasks = Queue.Queue(self.workers * 2)
+        done = Queue.Queue()
+        threads = []
+        for i in range(self.workers):
+            t = threading.Thread(target = self._work, args = (tasks, done),
+                                 name = 'extractor-%d' % i)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        logger.debug('started %d extraction threads', self.workers)
+
+        ordered = _OrderedStore(self.storage)
+        submitted = 0
+        for doc in loader:
+            tasks.put((submitted, doc))
+            submitted += 1
+            self._store_ready(done, ordered, False)
+
+        for t in threads:
+            tasks.put(None)
+        while ordered.stored < submitted:
+            self._store_ready(done, ordered, True)
+        for t in threads:
+            t.join()
+            
+class _AsyncJob(object):
+    '''Extraction of a single document by an AsyncRunner'''
+    
+    def __init__(self, index, doc, extractor, request, breaker):
+        self.index = index
+        self.doc = doc
+        self.extractor = extractor
+        self.request = request
+        self.breaker = breaker
+        self.attempt = 0
+        self.started = time.time()
+        
+class AsyncRunner(BaseRunner):
+    '''
+    Extract documents with non-blocking HTTP requests from a single thread.
+
+    Only extractors that send a single Request are supported (see
+    extractor.is_request_based). The request is built by the extractor, sent
+    by an AsyncHTTPClient and the response is handed back to the extractor,
+    so extract() applies the usual return_content and check_content_status
+    checks. Outcomes are stored in loader order like with ThreadedRunner.
+    
+    Requests go through the same retry policy and per endpoint circuit 
+    breakers as blocking ones: transient failures are sent again after the
+    backoff and requests to an endpoint whose breaker is open wait, without
+    holding up the requests to other endpoints.
+    '''
+    
+    def __init__(self, storage, max_in_flight, limiter = None, timeout = 60):
+        super(AsyncRunner, self).__init__(storage, limiter)
+        if max_in_flight < 1:
+            raise ValueError('at least one request in flight is required')
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        
+    def _dispatch(self, client, ordered, waiting, index, doc):
+        extractor = self.storage.extractor_cls(doc)
+        try:
+            request = extractor.prepared_request()
+            breaker = common.circuit_breakers.get(split_url(request[1])[0])
+        except Exception:
+            # building the request failed - extract_result runs into the same
+            # error and reports it the way a blocking run would
+            self.limiter.release()
+            ordered.put(index, doc, self.storage.extract_result(doc, extractor))
+        else:
+            self._send(client, ordered, waiting, _AsyncJob(index, doc, extractor, request, breaker))
+            
+    def _send(self, client, ordered, waiting, job):
+        # called with the limiter acquired
+        wait, probe = job.breaker.try_call()
+        if wait:
+            self.limiter.release()
+            heapq.heappush(waiting, (time.time() + wait, job.index, job))
+            return
+        
+        def done(status, headers, content, error):
+            self.limiter.release()
+            job.breaker.record(error is None or not common.is_transient(error), probe)
+            policy = common.retry_policy
+            if error is not None and common.is_transient(error) and \
+               job.attempt + 1 < policy.max_attempts:
+                delay = policy.delay(job.attempt)
+                logger.debug('attempt %d failed with %r - retrying in %.2fs',
+                             job.attempt + 1, error, delay)
+                job.attempt += 1
+                heapq.heappush(waiting, (time.time() + delay, job.index, job))
+                return
+            job.extractor.feed_response(Request.response(status, headers, content, error))
+            outcome = self.storage.extract_result(job.doc, job.extractor)
+            # the latency includes the time the requests were in flight
+            ordered.put(job.index, job.doc, outcome._replace(latency = time.time() - job.started))
+            
+        client.fetch(*(job.request + (done,)))
+            
+    def run(self, loader):
+        client = AsyncHTTPClient(self.timeout)
+        ordered = _OrderedStore(self.storage)
+        # (time, index, job) of requests waiting for a backoff or an open
+        # circuit breaker, they go before new documents
+        waiting = []
+        docs = iter(loader)
+        index = 0
+        exhausted = False
+        while not exhausted or client.in_flight or waiting:
+            while waiting and waiting[0][0] <= time.time() \
+                  and client.in_flight < self.max_in_flight and self.limiter.try_acquire():
+                self._send(client, ordered, waiting, heapq.heappop(waiting)[2])
+            # waiting requests count against max_in_flight, so documents are
+            # not read ahead while an endpoint is paused
+            while not exhausted and client.in_flight + len(waiting) < self.max_in_flight \
+                  and self.limiter.try_acquire():
+                try:
+                    doc = next(docs)
+                except StopIteration:
+                    exhausted = True
+                    self.limiter.release()
+                    break
+                self._dispatch(client, ordered, waiting, index, doc)
+                index += 1
+            client.poll()
+
+# state of a ProcessRunner or FanOutRunner worker process: extractor classes
+# keyed by slug
+_worker_extractors = {}
+
+def _init_process_worker(*extractor_classes):
+    for extractor_cls in extractor_classes:
+        _worker_extractors[extractor_cls.SLUG] = extractor_cls
+        extractor_cls.warm_up()
+
+def _process_extract(doc, slug):
+    return run_extractor(_worker_extractors[slug](doc))
+
+def _guarded_process_extract(doc, slug):
+    # a pool callback only runs for results, never for exceptions
+    return _guarded_extract(lambda doc: _process_extract(doc, slug), doc)
+    
+class ProcessRunner(BaseRunner):
+    '''
+    Extract documents on a pool of worker processes. Meant for CPU_BOUND 
+    extractors that would otherwise be held back by the GIL. 
+    
+    Workers stay alive for the whole run and call extractor_cls.warm_up() 
+    once, so parsers and stoplists are loaded only once per process. 
+    Documents are shipped to the workers, ExtractionOutcomes come back and 
+    are stored by the calling process in loader order.
+    '''
+    
+    # documents submitted ahead of the one stored next, per worker
+    pending_per_worker = 4
+    
+    def __init__(self, storage, workers, limiter = None):
+        super(ProcessRunner, self).__init__(storage, limiter)
+        if workers < 1:
+            raise ValueError('at least one worker is required')
+        self.workers = workers
+        
+    def run(self, loader):
+        # documents in submission order with their cached outcome or the
+        # AsyncResult of a worker; at most pending_per_worker * workers of 
+        # them are kept, so memory doesn't grow with the dataset
+        pending = collections.deque()
+        max_pending = self.workers * self.pending_per_worker
+        def store_head(block):
+            doc, outcome = pending[0]
+            if isinstance(outcome, multiprocessing.pool.AsyncResult):
+                if not block and not outcome.ready():
+                    return False
+                # a timed wait keeps the main process responsive to Ctrl-C
+                while not outcome.ready():
+                    outcome.wait(1)
+                outcome = outcome.get()
+            pending.popleft()
+            self.storage.store_result(doc, outcome)
+            return True
+        
+        pool = multiprocessing.Pool(self.workers, _init_process_worker,
+                                    (self.storage.extractor_cls,))
+        try:
+            for doc in loader:
+                outcome = self.storage.cached_outcome(doc)
+                if outcome is None:
+                    # only the rate is enforced, requests in flight are  
+                    # bound by the number of processes
+                    self.limiter.acquire()
+                    self.limiter.release()
+                    outcome = pool.apply_async(_process_extract, 
+                                               (doc, self.storage.extractor_cls.SLUG))
+                pending.append((doc, outcome))
+                while pending and store_head(len(pending) >= max_pending):
+                    pass
+            while pending:
+                store_head(True)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+class _Lane(object):
+    '''One extractor inside a FanOutRunner'''
+    
+    def __init__(self, storage, limiter = None, filter = None):
+        self.storage = storage
+        self.limiter = limiter or RateLimiter()
+        self.filter = filter
+        self.ordered = _OrderedStore(storage)
+        self.submitted = 0
+        self.cpu_bound = storage.extractor_cls.CPU_BOUND
+        # with several workers: the task queue of the lane's own worker thread
+        # and the number of documents in the process pool 
+        self.tasks = None
+        self.in_pool = 0
+            
+    def accepts(self, doc):
+        return self.filter is None or self.filter.accepts(doc)
+    
+    def extract(self, doc):
+        with self.limiter:
+            return self.storage.extract_result(doc)
+    
+class FanOutRunner(object):
+    '''
+    Run several extractors in a single pass over the dataset. Every document
+    is loaded once and handed to each extractor whose DocumentFilter accepts
+    it. With more than one worker the (document, extractor) jobs share one 
+    thread pool, except for CPU_BOUND extractors, which share a pool of 
+    worker processes like with ProcessRunner, and extractors that are not
+    CONCURRENT, which get a worker thread of their own so they never hold
+    up the shared threads.
+    
+    Each extractor keeps its own storage, rate limiter and filter and its
+    outcomes are stored in loader order, so every storage ends up exactly as
+    after a separate single extractor run.
+    '''
+    
+    def __init__(self, storages, workers = 1, limiters = None, filters = None):
+        if workers < 1:
+            raise ValueError('at least one worker is required')
+        limiters = limiters or [None] * len(storages)
+        filters = filters or [None] * len(storages)
+        self.lanes = [_Lane(*l) for l in zip(storages, limiters, filters)]
+        self.workers = workers
+        
+    def _jobs(self, loader):
+        for doc in loader:
+            for lane in self.lanes:
+                if lane.accepts(doc):
+                    yield lane, lane.submitted, doc
+                    lane.submitted += 1
+                    
+    def _work(self, tasks, done):
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            lane, index, doc = task
+            done.put((lane, index, doc, _guarded_extract(lane.extract, doc)))
+            
+    def _store_ready(self, done, block):
+        try:
+            while True:
+                lane, index, doc, outcome = done.get(block, 1)
+                if lane.cpu_bound:
+                    lane.in_pool -= 1
+                lane.ordered.put(index, doc, outcome)
+                block = False
+        except Queue.Empty:
+            pass
+            
+    def _submit(self, pool, lane, index, doc, done):
+        # hand a document of a CPU_BOUND lane to the process pool
+        outcome = lane.storage.cached_outcome(doc)
+        if outcome is not None:
+            return lane.ordered.put(index, doc, outcome)
+        while lane.in_pool >= self.workers * ProcessRunner.pending_per_worker:
+            self._store_ready(done, True)
+        # only the rate is enforced, see ProcessRunner
+        lane.limiter.acquire()
+        lane.limiter.release()
+        lane.in_pool += 1
+        pool.apply_async(_guarded_process_extract, (doc, lane.storage.extractor_cls.SLUG),
+                         callback = lambda outcome: done.put((lane, index, doc, outcome)))
+            
+    def run(self, loader):
+        if self.workers == 1:
+            for lane, index, doc in self._jobs(loader):
+                lane.ordered.put(index, doc, lane.extract(doc))
+            return
+        
+        tasks = Queue.Queue(self.workers * 2)
+        done = Queue.Queue()
+        threads = []
+        def start(tasks, name):
+            t = threading.Thread(target = self._work, args = (tasks, done), name = name)
+            t.daemon = True
+            t.start()
+            threads.append((t, tasks))
+        for i in range(self.workers):
+            start(tasks, 'extractor-%d' % i)
+        for lane in self.lanes:
+            if not lane.cpu_bound and not lane.storage.extractor_cls.CONCURRENT:
+                lane.tasks = Queue.Queue(self.workers * 2)
+                start(lane.tasks, 'extractor-%s' % lane.storage.extractor_cls.SLUG)
+        process_classes = tuple(lane.storage.extractor_cls for lane in self.lanes 
+                                if lane.cpu_bound)
+        pool = None
+        if process_classes:
+            pool = multiprocessing.Pool(self.workers, _init_process_worker, process_classes)
+            
+        try:
+            for lane, index, doc in self._jobs(loader):
+                if lane.cpu_bound:
+                    self._submit(pool, lane, index, doc, done)
+                else:
+                    (lane.tasks or tasks).put((lane, index, doc))
+                self._store_ready(done, False)
+                
+            for t, queue in threads:
+                queue.put(None)
+            while [l for l in self.lanes if l.ordered.stored < l.submitted]:
+                self._store_ready(done, True)
+            if pool:
+                pool.close()
+        except:
+            if pool:
+                pool.terminate()
+            raise
+        finally:
+            if pool:
+                pool.join()
+        for t, queue in threads:
+            t.join()
+
+def get_runner(storage, workers = 1, limiter = None, use_async = False):
+    '''
+    Return a runner suitable for the given number of workers. With use_async
+    workers is the number of requests kept in flight, CPU_BOUND extractors
+    get worker processes instead of threads.
+    '''
+    if use_async:
+        return AsyncRunner(storage, workers, limiter)
+    if workers > 1 and storage.extractor_cls.CPU_BOUND:
+        return ProcessRunner(storage, workers, limiter)
+    if workers > 1:
+        return ThreadedRunner(storage, workers, limiter)
+    return SerialRunner(storage, limiter)
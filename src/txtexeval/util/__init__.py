@@ -1,4 +1,5 @@
 from .common import Request
 from .common import get_local_path
 from .common import check_local_path
-from .common import html_to_text
\ No newline at end of file
+from .common import html_to_text
+from .ratelimit import RateLimiter
@@ -0,0 +1,252 @@
+'''
+Non-blocking HTTP client built on asyncore. A single thread can keep
+thousands of requests in flight, each on its own connection.
+'''
+import sys
+import ssl
+import time
+import socket
+import httplib
+import asyncore
+import logging
+from cStringIO import StringIO
+
+from .connection import ConnectionError, HTTPError, split_url, follow_redirect
+from .connection import _MAX_REDIRECTS
+
+logger = logging.getLogger(__name__)
+
+_SSL_WANT = (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE)
+
+def _ragged_eof(error):
+    # the server closed the connection without a TLS close_notify; it ends
+    # the stream like a plain close does (OpenSSL 3 reports it as an error)
+    return error.args[0] == ssl.SSL_ERROR_EOF or 'unexpected eof' in str(error).lower()
+
+class _BufferSocket(object):
+    # just enough of the socket interface for httplib.HTTPResponse
+
+    def __init__(self, data):
+        self._data = data
+
+    def makefile(self, *args, **kwargs):
+        return StringIO(self._data)
+
+def _parse_response(data, method):
+    # return (HTTPResponse, content) for a complete response read from a
+    # connection that was closed by the server
+    r = httplib.HTTPResponse(_BufferSocket(data), method = method)
+    try:
+        r.begin()
+        content = r.read()
+    except (httplib.HTTPException, ValueError) as e:
+        raise ConnectionError(e)
+    return r, content
+
+class _Channel(asyncore.dispatcher):
+    '''A single request/response exchange over a fresh connection'''
+
+    def __init__(self, client, address, scheme, host, raw_request, method, callback):
+        asyncore.dispatcher.__init__(self, map = client._map)
+        self._method = method
+        self._callback = callback
+        self._out = raw_request
+        self._in = []
+        self._tls = scheme == 'https'
+        self._host = host
+        self._ssl_context = client.ssl_context if self._tls else None
+        self._handshaking = False
+        self._done = False
+        self.started = time.time()
+        family, address = address
+        self.create_socket(family, socket.SOCK_STREAM)
+        try:
+            self.connect(address)
+        except socket.error:
+            self.close()
+            raise
+
+    def _finish(self, response = None, error = None):
+        if self._done:
+            return
+        self._done = True
+        self.close()
+        self._callback(response, error)
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError as e:
+            if e.args[0] in _SSL_WANT:
+                return
+            raise
+        self._handshaking = False
+
+    def handle_connect(self):
+        if self._tls:
+            # wrapping keeps the file descriptor, only the map entry changes;
+            # the certificate and host name are verified during the handshake
+            sock = self._ssl_context.wrap_socket(self.socket, server_hostname = self._host,
+                                                 do_handshake_on_connect = False)
+            self.del_channel()
+            self.set_socket(sock)
+            self._handshaking = True
+
+    def writable(self):
+        return not self.connected or self._handshaking or bool(self._out)
+
+    def readable(self):
+        return True
+
+    def handle_write(self):
+        if self._handshaking:
+            return self._handshake()
+        try:
+            sent = self.send(self._out[:65536])
+        except ssl.SSLError as e:
+            if e.args[0] in _SSL_WANT:
+                return
+            raise
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        if self._handshaking:
+            return self._handshake()
+        try:
+            data = self.recv(65536)
+            while self._tls and data and self.socket.pending():
+                self._in.append(data)
+                data = self.recv(65536)
+        except ssl.SSLError as e:
+            if e.args[0] in _SSL_WANT:
+                return
+            if _ragged_eof(e):
+                return self.handle_close()
+            raise
+        if data:
+            self._in.append(data)
+
+    def handle_close(self):
+        data = ''.join(self._in)
+        if not data:
+            return self._finish(error = ConnectionError('connection closed without a response'))
+        try:
+            response = _parse_response(data, self._method)
+        except ConnectionError as e:
+            return self._finish(error = e)
+        self._finish(response)
+
+    def handle_error(self):
+        error = sys.exc_info()[1]
+        self._finish(error = ConnectionError(error))
+
+    def handle_expt(self):
+        self._finish(error = ConnectionError('socket exception'))
+
+class AsyncHTTPClient(object):
+    '''
+    Issue HTTP requests without blocking. Call fetch() to queue a request and
+    poll() repeatedly to drive the network I/O. Callbacks are invoked from
+    poll() with (status, headers, content, error) where error is a
+    ConnectionError (or HTTPError) instance or None. An exception raised by
+    a callback is raised again from poll().
+
+    Redirects are followed and status codes are checked exactly like
+    ConnectionPool.request does it. Every exchange uses its own connection
+    with "Connection: close", so the end of the response is the end of the
+    stream.
+
+    timeout     - seconds a single exchange may take before it is aborted
+    ssl_context - ssl.SSLContext of https connections (the default context
+                  verifies certificates and host names like httplib does)
+    '''
+
+    def __init__(self, timeout = 60, ssl_context = None):
+        self.timeout = timeout
+        self.ssl_context = ssl_context or ssl.create_default_context()
+        self._map = {}
+        self._dns = {}
+        self._errors = []
+        self.in_flight = 0
+
+    def _resolve(self, host, port):
+        # the blocking lookup is done only once per host; return the address
+        # family and socket address of the first result (IPv4 or IPv6)
+        if (host, port) not in self._dns:
+            family, socktype, proto, name, address = \
+                socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+            self._dns[(host, port)] = family, address
+        return self._dns[(host, port)]
+
+    def _raw_request(self, key, method, path, body, headers):
+        scheme, host, port = key
+        default_port = 443 if scheme == 'https' else 80
+        if ':' in host:
+            host = '[%s]' % host # IPv6 literal
+        host_header = host if port == default_port else '%s:%d' % (host, port)
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % host_header]
+        for name, value in headers.iteritems():
+            if name.lower() not in ('host', 'connection', 'content-length'):
+                lines.append('%s: %s' % (name, value))
+        lines.append('Connection: close')
+        lines.append('Accept-Encoding: identity')
+        if body is not None:
+            lines.append('Content-Length: %d' % len(body))
+        return '\r\n'.join(lines) + '\r\n\r\n' + (body or '')
+
+    def fetch(self, method, url, body, headers, callback):
+        self.in_flight += 1
+        self._start(method, url, body, headers or {}, callback, 0)
+
+    def _start(self, method, url, body, headers, callback, redirects):
+        def done(response, error):
+            if error is None:
+                r, content = response
+                try:
+                    redirect = follow_redirect(r.status, r.reason, r.getheader('location'),
+                                               method, url, headers)
+                except HTTPError as e:
+                    error = e
+                else:
+                    if redirect and redirects >= _MAX_REDIRECTS:
+                        error = HTTPError(r.status, 'too many redirects')
+                    elif redirect:
+                        return self._start(*(redirect + (callback, redirects + 1)))
+            self.in_flight -= 1
+            # asyncore would pass an exception to handle_error of the already
+            # finished channel, where it gets lost
+            try:
+                if error is None:
+                    callback(r.status, r.msg, content, None)
+                else:
+                    callback(None, None, None, error)
+            except Exception:
+                self._errors.append(sys.exc_info())
+
+        try:
+            key, path = split_url(url)
+            address = self._resolve(key[1], key[2])
+            raw = self._raw_request(key, method, path, body, headers)
+            _Channel(self, address, key[0], key[1], raw, method, done)
+        except ConnectionError as e:
+            done(None, e)
+        except (socket.error, ValueError) as e:
+            done(None, ConnectionError(e))
+
+    def _expire(self):
+        now = time.time()
+        for channel in self._map.values():
+            if now - channel.started > self.timeout:
+                channel._finish(error = ConnectionError('timed out'))
+
+    def poll(self, timeout = 0.05):
+        '''Run one round of network I/O and wait at most timeout seconds'''
+        if self._map:
+            # poll() has no limit on the number of file descriptors
+            asyncore.loop(timeout, use_poll = True, map = self._map, count = 1)
+            self._expire()
+        elif timeout and not self._errors:
+            time.sleep(timeout)
+        if self._errors:
+            error_type, error, tb = self._errors.pop(0)
+            raise error_type, error, tb
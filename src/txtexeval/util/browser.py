@@ -0,0 +1,89 @@
+import threading
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+class _Driver(object):
+    '''A browser together with the number of pages it has loaded'''
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.pages = 0
+
+class DriverPool(object):
+    '''
+    Pool of webdriver instances shared by extraction threads.
+
+    Browsers are started lazily, at most size of them are alive at once and
+    a thread that asks for one while all are busy waits until one is handed
+    back. A browser is restarted after it has loaded recycle_after pages to
+    keep its memory usage in check and discarded right away if it raises
+    while in use.
+
+    factory       - callable that starts a new webdriver (e.g. webdriver.Firefox)
+    size          - maximum number of browsers running at the same time
+    recycle_after - pages loaded before a browser is restarted (None never)
+    '''
+
+    def __init__(self, factory, size = 1, recycle_after = None):
+        if size < 1:
+            raise ValueError('size must be at least 1')
+        self.factory = factory
+        self.size = size
+        self.recycle_after = recycle_after
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self.started = 0 # number of browsers started so far
+
+    def _quit(self, d):
+        try:
+            d.driver.quit()
+        except Exception as e:
+            logger.debug('failed to quit webdriver: %r', e)
+
+    def _get(self):
+        self._slots.acquire()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        try:
+            d = _Driver(self.factory())
+        except:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.started += 1
+        return d
+
+    def _put(self, d, broken = False):
+        d.pages += 1
+        if broken or (self.recycle_after and d.pages >= self.recycle_after):
+            self._quit(d)
+        else:
+            with self._lock:
+                self._idle.append(d)
+        self._slots.release()
+
+    @contextmanager
+    def driver(self):
+        '''Check out a browser for loading a single page'''
+        d = self._get()
+        try:
+            yield d.driver
+        except:
+            self._put(d, broken = True)
+            raise
+        self._put(d)
+
+    def clear(self):
+        '''Quit all idle browsers'''
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for d in idle:
+            self._quit(d)
+
+    def idle_count(self):
+        with self._lock:
+            return len(self._idle)
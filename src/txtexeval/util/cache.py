@@ -0,0 +1,131 @@
+import os
+import time
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+class BlobCache(object):
+    '''
+    Size bounded key/value store for byte strings kept in a single SQLite
+    file.
+
+    Every lookup refreshes the last use time of an entry; once the content
+    of all entries exceeds max_size bytes the least recently used ones are
+    evicted until the cache is back at low_water * max_size. Lookups only 
+    read, the use times they refresh are written together with the next 
+    put or flush. Every write is committed right away, so the write lock
+    is never held for long and several processes can share one file. The
+    total size is kept in the file as well and updated in the transaction 
+    of each write, so every process evicts against the same total. 
+    Instances can be shared by several threads.
+    
+    A file shared by several processes relies on SQLite's file locking, 
+    which is unreliable on network file systems such as NFS - keep it on a
+    local disk.
+    '''
+
+    def __init__(self, path, max_size, low_water = 0.9, clock = time.time):
+        if max_size <= 0:
+            raise ValueError('max_size must be positive')
+        self.path = path
+        self.max_size = max_size
+        self.low_water = low_water
+        self._clock = clock
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(path, timeout = 30, check_same_thread = False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS entries '
+                         '(key TEXT PRIMARY KEY, content BLOB, size INTEGER, used REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+        # single row holding the size of all entries (files written before
+        # it existed get it computed once)
+        self._db.execute('CREATE TABLE IF NOT EXISTS total (size INTEGER)')
+        self._db.execute('INSERT INTO total SELECT COALESCE(SUM(size), 0) FROM entries '
+                         'WHERE NOT EXISTS (SELECT 1 FROM total)')
+        self._db.commit()
+        # key -> last use time not written yet
+        self._used = {}
+
+    @property
+    def size(self):
+        '''Size of all entries in bytes'''
+        with self._lock:
+            return self._size()
+        
+    def _size(self):
+        return self._db.execute('SELECT size FROM total').fetchone()[0]
+
+    def _write_used(self):
+        if self._used:
+            self._db.executemany('UPDATE entries SET used = ? WHERE key = ?',
+                                 [(used, key) for key, used in self._used.iteritems()])
+            self._used = {}
+
+    def get(self, key):
+        '''Return the content stored under key or None'''
+        with self._lock:
+            row = self._db.execute('SELECT content FROM entries WHERE key = ?',
+                                   (key,)).fetchone()
+            if row is None:
+                return None
+            self._used[key] = self._clock()
+            return str(row[0])
+
+    def put(self, key, content):
+        with self._lock:
+            try:
+                # the first write takes the write lock, the total read below
+                # includes the writes of other processes
+                self._db.execute('UPDATE total SET size = size + ? - COALESCE('
+                                 '(SELECT size FROM entries WHERE key = ?), 0)',
+                                 (len(content), key))
+                self._db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                                 (key, sqlite3.Binary(content), len(content), self._clock()))
+                self._write_used()
+                size = self._size()
+                if size > self.max_size:
+                    self._evict(size)
+                self._db.commit()
+            except:
+                self._db.rollback()
+                raise
+
+    def _evict(self, size):
+        target = size - int(self.low_water * self.max_size)
+        freed = 0
+        keys = []
+        for key, size in self._db.execute('SELECT key, size FROM entries ORDER BY used'):
+            if freed >= target:
+                break
+            keys.append((key,))
+            freed += size
+        self._db.executemany('DELETE FROM entries WHERE key = ?', keys)
+        self._db.execute('UPDATE total SET size = size - ?', (freed,))
+        logger.debug('evicted %d cache entries (%d bytes)', len(keys), freed)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM entries WHERE key = ?',
+                                    (key,)).fetchone() is not None
+
+    def flush(self):
+        '''Write the use times refreshed by lookups'''
+        with self._lock:
+            try:
+                self._write_used()
+                self._db.commit()
+            except:
+                self._db.rollback()
+                raise
+
+    def close(self):
+        self.flush()
+        self._db.close()
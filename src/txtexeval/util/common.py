@@ -1,21 +1,41 @@
 import os
+import socket
 import urllib
-import urllib2
 
 from BeautifulSoup import BeautifulSoup
 
 import settings
+from .connection import ConnectionPool, ConnectionError, HTTPError, split_url
+from .retry import RetryPolicy, CircuitBreakers
 
 # urllib wrappers
 
+# keep-alive connections shared by all requests in the process
+connection_pool = ConnectionPool(
+    maxsize = getattr(settings, 'HTTP_POOL_SIZE', 10),
+    idle_timeout = getattr(settings, 'HTTP_POOL_IDLE_TIMEOUT', 30)
+)
+
+# transient failures are retried, endpoints that keep failing are paused;
+# the zemanta thrift client uses them as well
+retry_policy = RetryPolicy(**getattr(settings, 'RETRY_POLICY', {}))
+circuit_breakers = CircuitBreakers(**getattr(settings, 'CIRCUIT_BREAKER', {}))
+
+def is_transient(error):
+    '''True for network errors and HTTP errors with a retryable status code'''
+    if isinstance(error, HTTPError):
+        return error.code in retry_policy.statuses
+    return isinstance(error, ConnectionError)
+
 class _Response(object):
     
     def __init__(self, status_code = None, headers = None, 
-                 content = None, err_msg = None):
+                 content = None, err_msg = None, timed_out = False):
         self.status_code = status_code
         self.headers = headers
         self.content = content
         self._err_msg = err_msg
+        self.timed_out = timed_out
         
     def success(self):
         if self._err_msg: 
@@ -37,6 +57,8 @@ class _Response(object):
 
 class Request(object):
     
+    _user_agent = 'Python-urllib/txtexeval'
+    
     def __init__(self, url, data, **kwargs):
         self.url = url   
         self.kwargs = kwargs     
@@ -44,24 +66,57 @@ class Request(object):
             self.data = urllib.urlencode(data)
         else:
             self.data = data
+            
+    def prepare(self, method):
+        '''Return the (method, url, body, headers) tuple sent over the wire'''
+        headers = {'User-Agent': self._user_agent}
+        headers.update(self.kwargs.get('headers', {}))
+        if method == 'GET':
+            return method, '%s?%s' % (self.url, self.data), None, headers
+        if not [h for h in headers if h.lower() == 'content-type']:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        return method, self.url, self.data, headers
+    
+    @staticmethod
+    def response(status = None, headers = None, content = None, error = None):
+        '''Wrap a transport result or exception into a _Response'''
+        if isinstance(error, HTTPError):
+            return _Response(error.code, err_msg = str(error))
+        elif error is not None:
+            # ConnectionError wraps the socket error it was raised for
+            timed_out = any(isinstance(a, socket.timeout) for a in error.args)
+            return _Response(err_msg = '<urlopen error %s>' % error, timed_out = timed_out)
+        return _Response(status, headers, content)
+    
+    def send(self, method):
+        prepared = self.prepare(method)
+        try:
+            breaker = circuit_breakers.get(split_url(prepared[1])[0])
+        except ConnectionError as e:
+            return self.response(error = e)
+        
+        def attempt():
+            probe = breaker.before_call()
+            try:
+                result = connection_pool.request(*prepared)
+            except ConnectionError as e:
+                breaker.record(not is_transient(e), probe)
+                raise
+            breaker.record(True, probe)
+            return result
         
-    def post(self):
-        request = urllib2.Request(self.url, self.data, **self.kwargs)
         try: 
-            r = urllib2.urlopen(request)
-        except urllib2.URLError as e:
-            return _Response(err_msg = str(e))
+            status, headers, content = retry_policy.call(attempt, is_transient)
+        except ConnectionError as e:
+            return self.response(error = e)
         else:
-            return _Response(r.code, r.headers, r.read())
+            return self.response(status, headers, content)
+        
+    def post(self):
+        return self.send('POST')
             
     def get(self):
-        request = urllib2.Request('%s?%s' % (self.url, self.data), **self.kwargs)
-        try: 
-            r = urllib2.urlopen(request)
-        except urllib2.URLError as e:
-            return _Response(err_msg = str(e))
-        else:
-            return _Response(r.code, r.headers, r.read())
+        return self.send('GET')
         
 # dataset helpers
 
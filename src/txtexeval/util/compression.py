@@ -0,0 +1,118 @@
+'''
+Compression of stored documents and results. Compressed files carry the
+suffix of their codec (e.g. 100.html.gz), compressed strings are recognized
+by their magic number, so readers never need to know how data was written.
+'''
+import os
+import zlib
+import errno
+
+CODECS = ('gzip', 'zstd')
+
+SUFFIXES = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+_MAGIC = (
+    ('\x1f\x8b', 'gzip'),
+    ('\x28\xb5\x2f\xfd', 'zstd'),
+)
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstd compression requires the zstandard package')
+    return zstandard
+
+def check_codec(codec):
+    if codec is not None and codec not in CODECS:
+        raise ValueError('unknown compression codec: %s' % codec)
+    return codec
+
+def compress(data, codec, level = None):
+    '''Compress a string with the given codec (None leaves it as it is)'''
+    if check_codec(codec) is None:
+        return data
+    if codec == 'gzip':
+        # 16 + MAX_WBITS writes a gzip header instead of the zlib one
+        compressor = zlib.compressobj(6 if level is None else level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    return _zstandard().ZstdCompressor(level = 3 if level is None else level).compress(data)
+
+def codec_of(data):
+    '''Return the codec a string was compressed with or None'''
+    for magic, codec in _MAGIC:
+        if data.startswith(magic):
+            return codec
+    return None
+
+def decompress(data):
+    '''Decompress a string written by compress, other strings are returned as they are'''
+    codec = codec_of(data)
+    if codec == 'gzip':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    elif codec == 'zstd':
+        return _zstandard().ZstdDecompressor().decompress(data)
+    return data
+
+def compressed_path(path, codec):
+    return path + SUFFIXES[codec] if codec else path
+
+def candidate_paths(path, codec = None):
+    '''Paths a file may be stored under, the one of the given codec first'''
+    paths = [path] + [path + SUFFIXES[c] for c in CODECS]
+    if codec:
+        paths.insert(0, paths.pop(paths.index(compressed_path(path, codec))))
+    return paths
+
+def read_file(path, codec = None):
+    '''
+    Read and decompress the file stored under path or one of its compressed
+    variants, trying the variant of codec first. Raises IOError if none of
+    them exists.
+    '''
+    for candidate in candidate_paths(path, codec):
+        try:
+            with open(candidate, 'rb') as f:
+                data = f.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+        return decompress(data)
+    raise IOError(errno.ENOENT, 'no such file', path)
+
+def write_file(path, data, codec = None, level = None):
+    '''Write data to path plus the suffix of codec and return the path written'''
+    path = compressed_path(path, check_codec(codec))
+    with open(path, 'wb') as f:
+        f.write(compress(data, codec, level))
+    return path
+
+def strip_suffix(name):
+    '''Return a file name without the suffix of a codec'''
+    for codec in CODECS:
+        if name.endswith(SUFFIXES[codec]):
+            return name[:-len(SUFFIXES[codec])]
+    return name
+
+def recompress_file(path, codec, level = None):
+    '''
+    Rewrite a (possibly compressed) file with another codec, None stores it
+    uncompressed. Returns the new path.
+    '''
+    plain = strip_suffix(path)
+    with open(path, 'rb') as f:
+        data = decompress(f.read())
+    new_path = compressed_path(plain, codec)
+    if new_path == path:
+        return path
+    tmp_path = new_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(compress(data, codec, level))
+    os.rename(tmp_path, new_path)
+    os.remove(path)
+    return new_path
@@ -0,0 +1,179 @@
+import time
+import socket
+import httplib
+import urlparse
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+class ConnectionError(Exception):
+    '''Raised for any failure on the way to a complete HTTP response'''
+    pass
+
+class HTTPError(ConnectionError):
+    '''Raised for a complete response with a status code we do not accept'''
+
+    def __init__(self, code, msg):
+        super(HTTPError, self).__init__(code, msg)
+        self.code = code
+        self.msg = msg
+
+    def __str__(self):
+        # same message urllib2.HTTPError produces
+        return 'HTTP Error %s: %s' % (self.code, self.msg)
+
+_REDIRECT_CODES = (301, 302, 303, 307)
+# requests that can be repeated without side effects (RFC 2616 9.1.2)
+_IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE')
+_MAX_REDIRECTS = 10 # same as urllib2
+
+def split_url(url):
+    '''Return ((scheme, host, port), path) for an http or https url'''
+    parts = urlparse.urlsplit(url)
+    scheme = parts.scheme or 'http'
+    if scheme not in ('http', 'https'):
+        raise ConnectionError('unknown url type: %s' % scheme)
+    port = parts.port or (443 if scheme == 'https' else 80)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    return (scheme, parts.hostname, port), path
+
+def follow_redirect(status, reason, location, method, url, headers):
+    '''
+    Decide what to do with a complete response. Return the next 
+    (method, url, body, headers) for a redirect, None for a 2xx response
+    and raise HTTPError otherwise. Redirects are handled like urllib2 does
+    it - the request is turned into a GET and the body is dropped.
+    '''
+    if status in _REDIRECT_CODES and location:
+        if status == 307 and method not in ('GET', 'HEAD'):
+            raise HTTPError(status, reason)
+        headers = dict((h, v) for h, v in (headers or {}).iteritems()
+                       if h.lower() not in ('content-type', 'content-length'))
+        return 'GET', urlparse.urljoin(url, location), None, headers
+    if not 200 <= status < 300:
+        raise HTTPError(status, reason)
+    return None
+
+class ConnectionPool(object):
+    '''
+    Pool of persistent (keep-alive) HTTP connections.
+
+    Idle connections are kept per (scheme, host, port), so sockets are reused
+    across documents and across extractors that talk to the same host. A
+    connection is used by one thread at a time - it is taken out of the pool
+    for the duration of a request and put back once the response body has
+    been read.
+
+    maxsize      - maximum number of idle connections kept per host
+    idle_timeout - idle connections older than this (seconds) are closed
+    timeout      - socket timeout for new connections (None for the default)
+    '''
+
+    def __init__(self, maxsize = 10, idle_timeout = 30, timeout = None):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {} # key -> list of (connection, last used)
+        self._lock = threading.Lock()
+
+    def _new_connection(self, key):
+        scheme, host, port = key
+        cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        if self.timeout is None:
+            return cls(host, port)
+        return cls(host, port, timeout = self.timeout)
+
+    def _get(self, key):
+        # return (connection, reused flag)
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    return conn, True
+                conn.close()
+        return self._new_connection(key), False
+
+    def _put(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def evict_idle(self):
+        '''Close every connection that has been idle for too long'''
+        now = time.time()
+        with self._lock:
+            for key, idle in self._idle.items():
+                fresh = []
+                for conn, last_used in idle:
+                    if now - last_used <= self.idle_timeout:
+                        fresh.append((conn, last_used))
+                    else:
+                        conn.close()
+                self._idle[key] = fresh
+
+    def clear(self):
+        '''Close all idle connections'''
+        with self._lock:
+            for idle in self._idle.itervalues():
+                for conn, last_used in idle:
+                    conn.close()
+            self._idle = {}
+
+    def idle_count(self, scheme, host, port):
+        with self._lock:
+            return len(self._idle.get((scheme, host, port), []))
+
+    def _send(self, key, method, path, body, headers):
+        # perform a single request/response exchange; a reused connection the
+        # server has already closed is retried once on a fresh connection. 
+        # Once the request went out the server may be processing it, so it is
+        # only sent again if that is harmless - and never after a timeout
+        conn, reused = self._get(key)
+        while True:
+            sent = False
+            try:
+                conn.request(method, path, body, headers)
+                sent = True
+                r = conn.getresponse()
+                content = r.read()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if reused and not isinstance(e, socket.timeout) and \
+                   (not sent or method in _IDEMPOTENT_METHODS):
+                    logger.debug('stale connection to %s:%s - reconnecting', key[1], key[2])
+                    conn, reused = self._new_connection(key), False
+                    continue
+                raise ConnectionError(e)
+            break
+
+        if r.will_close:
+            conn.close()
+        else:
+            self._put(key, conn)
+        return r, content
+
+    def request(self, method, url, body = None, headers = None):
+        '''
+        Issue a request and return a tuple (status code, headers, content).
+        Redirects are followed the way urllib2 does it. Raise HTTPError for
+        any other non 2xx status code and ConnectionError for network errors.
+        '''
+        headers = headers or {}
+        for i in range(_MAX_REDIRECTS + 1):
+            key, path = split_url(url)
+            r, content = self._send(key, method, path, body, headers)
+            redirect = follow_redirect(r.status, r.reason, r.getheader('location'),
+                                       method, url, headers)
+            if redirect:
+                method, url, body, headers = redirect
+                continue
+            return r.status, r.msg, content
+        raise HTTPError(r.status, 'too many redirects')
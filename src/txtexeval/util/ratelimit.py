@@ -0,0 +1,124 @@
+import time
+import threading
+
+# limiters held by the current thread through the context manager
+_held = threading.local()
+
+def held_limiter():
+    '''Return the innermost RateLimiter the current thread is inside of, or None'''
+    limiters = getattr(_held, 'limiters', None)
+    return limiters[-1] if limiters else None
+
+class RateLimiter(object):
+    '''
+    Token bucket rate limiter with an optional cap on the number of
+    requests in flight.
+
+    rate          - requests per second that are sustained in the long run
+                    (None means no rate limit)
+    burst         - size of the bucket i.e. number of requests that can be
+                    issued back to back after an idle period
+    max_in_flight - maximum number of requests running at the same time
+                    (None means no limit)
+
+    A limiter is meant to be shared by every thread that talks to the same
+    service. Use it as a context manager around a single request; retries of
+    that request call throttle() on the limiter (see held_limiter), so each
+    attempt counts against the rate.
+    '''
+
+    def __init__(self, rate = None, burst = 1, max_in_flight = None,
+                 clock = time.time, sleep = time.sleep):
+        if rate is not None and rate <= 0:
+            raise ValueError('rate must be positive')
+        if burst < 1:
+            raise ValueError('burst must be at least 1')
+        if max_in_flight is not None and max_in_flight < 1:
+            raise ValueError('max_in_flight must be at least 1')
+
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self._clock = clock
+        self._sleep = sleep
+
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._last = clock()
+        if max_in_flight:
+            self._slots = threading.BoundedSemaphore(max_in_flight)
+        else:
+            self._slots = None
+
+    def _reserve(self):
+        # take a token from the bucket and return the number of seconds the
+        # caller has to wait before the token becomes valid; the bucket may
+        # go negative, which queues callers fairly without holding the lock
+        with self._lock:
+            now = self._clock()
+            elapsed = max(0., now - self._last)
+            self._tokens = min(float(self.burst), self._tokens + elapsed * self.rate)
+            self._last = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.
+            return -self._tokens / self.rate
+
+    def try_acquire(self):
+        '''
+        Non-blocking acquire for event loops. Return True if a request may 
+        start right now (call release() once it is done) and False otherwise.
+        '''
+        if self._slots and not self._slots.acquire(False):
+            return False
+        if self.rate:
+            with self._lock:
+                now = self._clock()
+                elapsed = max(0., now - self._last)
+                self._tokens = min(float(self.burst), self._tokens + elapsed * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+            if self._slots:
+                self._slots.release()
+            return False
+        return True
+
+    def acquire(self):
+        if self._slots:
+            self._slots.acquire()
+        if self.rate:
+            wait = self._reserve()
+            if wait > 0:
+                self._sleep(wait)
+
+    def release(self):
+        if self._slots:
+            self._slots.release()
+
+    def throttle(self):
+        '''
+        Wait for a token of the rate limit without taking another in-flight
+        slot, for further attempts of a request that already holds one.
+        '''
+        if self.rate:
+            wait = self._reserve()
+            if wait > 0:
+                self._sleep(wait)
+
+    def __enter__(self):
+        self.acquire()
+        if not hasattr(_held, 'limiters'):
+            _held.limiters = []
+        _held.limiters.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _held.limiters.pop()
+        self.release()
+        return False
+
+    def __repr__(self):
+        return 'RateLimiter(rate=%r, burst=%r, max_in_flight=%r)' \
+            % (self.rate, self.burst, self.max_in_flight)
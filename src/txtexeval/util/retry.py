@@ -0,0 +1,179 @@
+import time
+import random
+import threading
+import logging
+from collections import deque
+
+from .ratelimit import held_limiter
+
+logger = logging.getLogger(__name__)
+
+class RetryPolicy(object):
+    '''
+    Retry a call with jittered exponential backoff.
+
+    max_attempts - total number of attempts (1 disables retries)
+    backoff      - base delay in seconds, attempt n waits a random time
+                   between 0 and backoff * 2**n ("full jitter")
+    max_backoff  - upper bound of a single delay
+    statuses     - HTTP status codes worth retrying
+    '''
+
+    def __init__(self, max_attempts = 3, backoff = 0.5, max_backoff = 30,
+                 statuses = (429, 500, 502, 503, 504),
+                 sleep = time.sleep, random = random.random):
+        if max_attempts < 1:
+            raise ValueError('max_attempts must be at least 1')
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = frozenset(statuses)
+        self._sleep = sleep
+        self._random = random
+
+    def delay(self, attempt):
+        '''Seconds to wait after the given (zero based) failed attempt'''
+        return self._random() * min(self.max_backoff, self.backoff * 2 ** attempt)
+
+    def call(self, func, retryable):
+        '''
+        Call func until it succeeds, raises an exception for which
+        retryable(exception) is False or the attempts are used up, in which
+        case the last exception is raised. Attempts after the first wait
+        for the rate limit of the RateLimiter the caller holds, if any.
+        '''
+        for attempt in range(self.max_attempts):
+            if attempt:
+                limiter = held_limiter()
+                if limiter is not None:
+                    limiter.throttle()
+            try:
+                return func()
+            except Exception as e:
+                if attempt + 1 >= self.max_attempts or not retryable(e):
+                    raise
+                delay = self.delay(attempt)
+                logger.debug('attempt %d failed with %r - retrying in %.2fs',
+                             attempt + 1, e, delay)
+                self._sleep(delay)
+
+    def __repr__(self):
+        return 'RetryPolicy(max_attempts=%r, backoff=%r, max_backoff=%r)' \
+            % (self.max_attempts, self.backoff, self.max_backoff)
+
+class CircuitBreaker(object):
+    '''
+    Pause calls to an endpoint whose error rate spikes.
+
+    The outcomes of the last window calls are tracked. Once at least
+    min_calls of them are known and the share of failures reaches error_rate
+    the breaker opens: callers are held in before_call() for cooldown
+    seconds, then a single probe call is let through. A successful probe
+    closes the breaker, a failed one opens it again.
+
+    before_call() returns True to the caller admitted as the probe, which
+    passes it on to record(). Outcomes of calls that started before the
+    breaker opened are ignored while it is not closed.
+    '''
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, window = 20, min_calls = 10, error_rate = 0.5, cooldown = 30,
+                 clock = time.time, sleep = time.sleep):
+        if not 0 < error_rate <= 1:
+            raise ValueError('error_rate must be in (0, 1]')
+        self.window = window
+        self.min_calls = min(min_calls, window)
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen = window)
+        self._failures = 0
+        self._probing = False
+        self.state = self.CLOSED
+        self.opened_at = None
+
+    def _wait_time(self):
+        # seconds the caller has to wait, 0 lets the call through
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0, False
+            if self.state == self.OPEN:
+                remaining = self.opened_at + self.cooldown - self._clock()
+                if remaining > 0:
+                    return remaining, False
+                self.state = self.HALF_OPEN
+            if not self._probing:
+                self._probing = True
+                return 0, True
+            # somebody else is probing the endpoint
+            return min(1., self.cooldown), False
+
+    def try_call(self):
+        '''
+        Non-blocking before_call for event loops. Return (seconds to wait, 
+        probe flag) - the call may start right away if the wait is 0.
+        '''
+        return self._wait_time()
+
+    def before_call(self):
+        '''Block while the breaker is open, return True if the call is the probe'''
+        while True:
+            wait, probe = self._wait_time()
+            if not wait:
+                return probe
+            self._sleep(wait)
+
+    def record(self, success, probe = False):
+        '''Record the outcome of a call, probe is what before_call returned'''
+        with self._lock:
+            if probe:
+                self._probing = False
+                if success:
+                    logger.info('circuit breaker closed')
+                    self._reset()
+                else:
+                    self._open()
+                return
+            if self.state != self.CLOSED:
+                # a call that started before the breaker opened
+                return
+            if len(self._outcomes) == self.window:
+                self._failures -= not self._outcomes[0]
+            self._outcomes.append(success)
+            self._failures += not success
+            if len(self._outcomes) >= self.min_calls and \
+               self._failures >= self.error_rate * len(self._outcomes):
+                logger.warning('circuit breaker opened: %d of the last %d calls failed',
+                               self._failures, len(self._outcomes))
+                self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = self._clock()
+
+    def _reset(self):
+        self.state = self.CLOSED
+        self.opened_at = None
+        self._outcomes.clear()
+        self._failures = 0
+
+class CircuitBreakers(object):
+    '''Registry of circuit breakers keyed by endpoint, created on demand'''
+
+    def __init__(self, **options):
+        self.options = options
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._breakers:
+                self._breakers[key] = CircuitBreaker(**self.options)
+            return self._breakers[key]
+
+    def clear(self):
+        with self._lock:
+            self._breakers = {}
@@ -1,41 +1,180 @@
+import time
+import threading
+import logging
 from collections import namedtuple
 
 from thrift import Thrift
 from thrift.transport import TSocket, TTransport
 from thrift.protocol import TBinaryProtocol
 
-# this is the code thrift generates for us 
+# this is the code thrift generates for us
 # gen-py directory was renamed to thriftgen
 from .thriftgen.ceservice import ExtractorService
 from .thriftgen.ceservice import ttypes
+from .. import common
 
 import settings
-#from ..common import execute_only_once
-credentials = dict(settings.ZEMANTA_THRIFT) 
+credentials = dict(settings.ZEMANTA_THRIFT)
+
+logger = logging.getLogger(__name__)
 
 Response = namedtuple('Response', 'text error')
 
-class ClientManager(object):
-    
-    __internal_state = {} # Borg design pattern (singleton)
-    
-    def __init__(self, extractor = None):
-        self.__dict__ = self.__internal_state
-        self.set_client()
-          
-    def set_client(self):
-        self._transport = TTransport.TBufferedTransport(
-            TSocket.TSocket(credentials['host'], credentials['port'])
-        )
-        self._protocol = TBinaryProtocol.TBinaryProtocol(self._transport)
-        self._client = ExtractorService.Client(self._protocol)
-        self._transport.open()
-        
+class _Connection(object):
+    '''An open transport together with the client that talks over it'''
+
+    def __init__(self, transport, client):
+        self.transport = transport
+        self.client = client
+        self.last_used = time.time()
+
+    def close(self):
+        try:
+            self.transport.close()
+        except Exception:
+            pass
+
+class ClientPool(object):
+    '''
+    Thread-safe pool of open ExtractorService connections.
+
+    A connection is used by one thread at a time - it is taken out of the
+    pool for the duration of a call and put back afterwards. Connections that
+    have been idle for longer than ping_after seconds are checked with the
+    ping RPC before they are handed out and a call that fails on a dropped
+    connection is retried once on a fresh one.
+
+    maxsize    - maximum number of idle connections kept open
+    framed     - use the framed transport instead of the buffered one
+                 (must match the server)
+    protocol   - 'binary' or 'compact' (must match the server)
+    timeout    - socket timeout in seconds (None for no timeout)
+    ping_after - idle time in seconds after which a connection is pinged
+                 before reuse (0 pings on every checkout)
+    '''
+
+    def __init__(self, host, port, maxsize = 4, framed = False,
+                 protocol = 'binary', timeout = None, ping_after = 10):
+        if protocol not in ('binary', 'compact'):
+            raise ValueError('unknown thrift protocol: %s' % protocol)
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        self.framed = framed
+        self.protocol = protocol
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _protocol_factory(self):
+        if self.protocol == 'compact':
+            from thrift.protocol import TCompactProtocol
+            return TCompactProtocol.TCompactProtocol
+        return TBinaryProtocol.TBinaryProtocol
+
+    def _connect(self):
+        sock = TSocket.TSocket(self.host, self.port)
+        if self.timeout is not None:
+            sock.setTimeout(self.timeout * 1000.)
+        if self.framed:
+            transport = TTransport.TFramedTransport(sock)
+        else:
+            transport = TTransport.TBufferedTransport(sock)
+        client = ExtractorService.Client(self._protocol_factory()(transport))
+        transport.open()
+        return _Connection(transport, client)
+
+    def _healthy(self, conn):
+        try:
+            conn.client.ping('')
+        except Thrift.TException as e:
+            logger.debug('thrift connection failed the ping check: %r', e)
+            return False
+        return True
+
+    def _get(self):
+        # return (connection, reused flag)
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn = self._idle.pop()
+            if time.time() - conn.last_used < self.ping_after or self._healthy(conn):
+                return conn, True
+            conn.close()
+        return self._connect(), False
+
+    def _put(self, conn):
+        conn.last_used = time.time()
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        '''Close all idle connections'''
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def idle_count(self):
+        with self._lock:
+            return len(self._idle)
+
+    def call(self, method, *args):
+        '''
+        Invoke an ExtractorService method on a pooled connection. Application
+        level exceptions (TAppException) are raised to the caller and leave
+        the connection in the pool, transport errors raise
+        TTransport.TTransportException.
+        '''
+        conn, reused = self._get()
+        while True:
+            try:
+                result = getattr(conn.client, method)(*args)
+            except ttypes.TAppException:
+                self._put(conn)
+                raise
+            except TTransport.TTransportException:
+                conn.close()
+                if reused:
+                    logger.debug('stale thrift connection to %s:%s - reconnecting',
+                                 self.host, self.port)
+                    conn, reused = self._connect(), False
+                    continue
+                raise
+            except Exception:
+                # the connection may be left in the middle of a message
+                conn.close()
+                raise
+            self._put(conn)
+            return result
+
+    def _extract(self, encoded_htmldata, encoding):
+        # transport errors are retried and counted by the circuit breaker of
+        # the endpoint, TAppException means the service is up and running
+        breaker = common.circuit_breakers.get(('thrift', self.host, self.port))
+        def attempt():
+            probe = breaker.before_call()
+            try:
+                response = self.call('extract', '', '', encoded_htmldata, encoding)
+            except Exception as e:
+                breaker.record(not isinstance(e, TTransport.TTransportException), probe)
+                raise
+            breaker.record(True, probe)
+            return response
+        return common.retry_policy.call(attempt, 
+            lambda e: isinstance(e, TTransport.TTransportException))
+
     def extract(self, encoded_htmldata, encoding):
+        '''Return a Response with the extracted text or an error message'''
         error = None
         text = ''
         try:
-            response = self._client.extract('', '', encoded_htmldata, encoding)
+            response = self._extract(encoded_htmldata, encoding)
         except ttypes.TAppException as e:
             error = '%r' % e
         except Thrift.TException as e:
@@ -47,6 +186,25 @@ class ClientManager(object):
                 text = response.body.encode('utf8')
             else:
                 error = 'ExtractorService.extract returned a response but the success flag was set to False'
-        finally:
-            self._transport.close()
-        return Response(text, error)
\ No newline at end of file
+        return Response(text, error)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    '''Return the process wide pool configured from settings.ZEMANTA_THRIFT'''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            options = dict(credentials)
+            _pool = ClientPool(options.pop('host'), options.pop('port'), **options)
+        return _pool
+
+class ClientManager(object):
+    '''Thin handle on the shared ClientPool, safe to use from any thread'''
+
+    def __init__(self, extractor = None):
+        self._pool = get_pool()
+
+    def extract(self, encoded_htmldata, encoding):
+        return self._pool.extract(encoded_htmldata, encoding)
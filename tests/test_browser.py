@@ -0,0 +1,154 @@
+import threading
+
+import unittest2
+
+import settings
+from txtexeval.data import ExtractionOutcome
+from txtexeval.extractor import SeleniumReadabilityExtractor, ExtractorError
+from txtexeval.runner import ThreadedRunner
+from txtexeval.util.browser import DriverPool
+
+class FakeElement(object):
+
+    def __init__(self, text):
+        self.text = text
+
+class FakeDriver(object):
+    '''
+    Webdriver stand-in: readability renders the page a few polls after the
+    bookmarklet is executed. Urls containing "fail" produce the failure
+    marker and urls containing "hang" never finish.
+    '''
+
+    lock = threading.Lock()
+    alive = 0
+    max_alive = 0
+    shared = False # set if two threads used one driver at the same time
+
+    def __init__(self):
+        cls = self.__class__
+        with cls.lock:
+            cls.alive += 1
+            cls.max_alive = max(cls.max_alive, cls.alive)
+        self.url = None
+        self.owner = None
+        self.quitted = False
+
+    def get(self, url):
+        if self.owner is not None:
+            self.__class__.shared = True
+        self.owner = threading.current_thread()
+        self.url = url
+        self.polls = 0
+        self.executed = False
+
+    def execute_script(self, source):
+        self.executed = True
+
+    def find_elements_by_id(self, id):
+        self.polls += 1
+        ready = self.executed and self.polls > 2 and 'hang' not in self.url
+        if ready and 'fail' in self.url and id == 'readability-content-failed':
+            return [FakeElement('')]
+        if ready and id == 'readInner':
+            # the page is done once readability produced its output
+            self.owner = None
+            return [FakeElement(u'text of %s' % self.url)]
+        return []
+
+    def quit(self):
+        with self.__class__.lock:
+            self.__class__.alive -= 1
+        self.quitted = True
+
+class FakeDocument(object):
+
+    raw_encoding = 'utf-8'
+
+    def __init__(self, id):
+        self.id = id
+
+    def get_url_local(self):
+        return 'file:///%s.html' % self.id
+
+class FakeReadabilityExtractor(SeleniumReadabilityExtractor):
+    _pool = None
+
+class Storage(object):
+
+    extractor_cls = FakeReadabilityExtractor
+
+    def __init__(self):
+        self.stored = []
+
+    def extract_result(self, document):
+        try:
+            return ExtractionOutcome(self.extractor_cls(document).extract(), None)
+        except ExtractorError as e:
+            return ExtractionOutcome(None, str(e))
+
+    def store_result(self, document, outcome):
+        self.stored.append((document.id, outcome))
+
+class TestDriverPool(unittest2.TestCase):
+
+    def test_recycle(self):
+        pool = DriverPool(FakeDriver, 1, recycle_after = 3)
+        drivers = []
+        for i in range(7):
+            with pool.driver() as driver:
+                drivers.append(driver)
+        self.assertEqual(pool.started, 3)
+        self.assertEqual([d.quitted for d in drivers], [True] * 6 + [False])
+        self.assertTrue(drivers[0] is drivers[2])
+
+    def test_broken_driver_discarded(self):
+        pool = DriverPool(FakeDriver, 2)
+        with self.assertRaises(ValueError):
+            with pool.driver() as driver:
+                raise ValueError
+        self.assertTrue(driver.quitted)
+        self.assertEqual(pool.idle_count(), 0)
+        with pool.driver() as other:
+            self.assertFalse(other is driver)
+
+class TestSeleniumExtractor(unittest2.TestCase):
+
+    def setUp(self):
+        FakeDriver.alive = FakeDriver.max_alive = 0
+        FakeDriver.shared = False
+        FakeReadabilityExtractor._pool = DriverPool(FakeDriver, 3, recycle_after = 4)
+
+    def test_concurrent_extraction(self):
+        ids = ['doc%02d' % i for i in range(20)] + ['fail']
+        storage = Storage()
+        ThreadedRunner(storage, 6).run([FakeDocument(id) for id in ids])
+        results = dict(storage.stored)
+        self.assertEqual(results['doc07'].result, 'text of file:///doc07.html')
+        self.assertEqual(results['fail'].error, 'readability failed to extract any content')
+        pool = FakeReadabilityExtractor._pool
+        self.assertFalse(FakeDriver.shared)
+        self.assertTrue(FakeDriver.max_alive <= 3)
+        self.assertTrue(pool.started >= 21 / 4)
+        self.assertTrue(pool.idle_count() <= 3)
+
+    def test_timeout(self):
+        orig = settings.__dict__.get('SELENIUM_WAIT_TIMEOUT')
+        settings.SELENIUM_WAIT_TIMEOUT = 0.3
+        try:
+            with self.assertRaises(ExtractorError) as cm:
+                FakeReadabilityExtractor(FakeDocument('hang')).extract()
+        finally:
+            if orig is None:
+                del settings.SELENIUM_WAIT_TIMEOUT
+            else:
+                settings.SELENIUM_WAIT_TIMEOUT = orig
+        self.assertTrue('#readInner' in str(cm.exception))
+        # a slow page does not cost the browser
+        self.assertEqual(FakeReadabilityExtractor._pool.idle_count(), 1)
+
+def main():
+    unittest2.main(exit = False, verbosity = 2)
+
+if __name__ == '__main__':
+    main()
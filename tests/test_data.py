@@ -0,0 +1,607 @@
+import os
+import shutil
+import pickle
+import marshal
+import tempfile
+from StringIO import StringIO
+
+import yaml
+import unittest2
+
+import settings
+from txtexeval.data import LocalDatasetLoader, LocalResultStorage
+from txtexeval.data import ExtractionSummary, ExtractionJournal, DataError
+from txtexeval.data import PackedResultStorage, convert_results, MetaIndex
+from txtexeval.data import iter_meta_yaml, FailureIndex, failure_category
+from txtexeval.data import close_extraction_cache, get_extraction_cache, compress_dataset
+from txtexeval.data import CorpusPack, PackedDatasetLoader, get_dataset_loader_cls
+from txtexeval.data import Shard, merge_shards, run_extractor
+from txtexeval.extractor import JustextExtractor, PythonReadabilityExtractor
+from txtexeval.extractor import ExtractorError, ContentExtractorError
+from txtexeval.runner import FanOutRunner, SerialRunner, ProcessRunner, get_runner
+
+HTML = '''<html><head><title>Document %(id)s</title></head><body>
+<div>menu | home | about</div>
+<p>%(text)s</p>
+</body></html>'''
+
+TEXT = ('This is the first paragraph of a rather long news article that talks '
+        'about text extraction and evaluation of many different algorithms. ') * 5
+
+def create_dataset(root, name, ids):
+    '''Create a minimal dataset, documents with an id ending in 3 are empty'''
+    for folder in ('raw', 'clean', 'result'):
+        os.makedirs(os.path.join(root, 'datasets', name, folder))
+    meta = []
+    for id in ids:
+        text = '' if id.endswith('3') else TEXT
+        with open(os.path.join(root, 'datasets', name, 'raw', id + '.html'), 'w') as f:
+            f.write(HTML % dict(id = id, text = text))
+        with open(os.path.join(root, 'datasets', name, 'clean', id + '.txt'), 'w') as f:
+            f.write(text)
+        meta.append(dict(id = id, url = None, raw = id + '.html', clean = id + '.txt',
+                         raw_encoding = 'utf-8', clean_encoding = 'utf-8', meta = {}))
+    with open(os.path.join(root, 'datasets', name, 'meta.yaml'), 'w') as f:
+        f.write(yaml.dump(meta, default_flow_style = False))
+
+class DatasetTestCase(unittest2.TestCase):
+    '''Creates a dataset in a temporary PATH_LOCAL_DATA'''
+
+    ids = ['%02d' % i for i in range(15)]
+
+    def setUp(self):
+        self._orig_path = settings.PATH_LOCAL_DATA
+        self.root = tempfile.mkdtemp()
+        settings.PATH_LOCAL_DATA = self.root
+        create_dataset(self.root, 'testset', self.ids)
+        close_extraction_cache()
+
+    def tearDown(self):
+        close_extraction_cache()
+        settings.PATH_LOCAL_DATA = self._orig_path
+        shutil.rmtree(self.root)
+
+    def result_files(self, slug):
+        path = os.path.join(self.root, 'datasets', 'testset', 'result', slug)
+        files = {}
+        for name in os.listdir(path):
+            with open(os.path.join(path, name)) as f:
+                files[name] = f.read()
+        return files
+
+    def summary(self):
+        '''Failures in summary.yaml, cache statistics differ from run to run'''
+        with open(os.path.join(self.root, 'datasets', 'testset', 'result', 'summary.yaml')) as f:
+            summary = yaml.load(f.read())
+        summary.pop(ExtractionSummary.CACHE_STATS_KEY, None)
+        return summary
+
+class TestLoader(DatasetTestCase):
+
+    def test_iteration(self):
+        loader = LocalDatasetLoader('testset')
+        self.assertEqual(len(loader), 15)
+        self.assertEqual([d.id for d in loader], self.ids)
+
+    def test_skip_existing(self):
+        storage = LocalResultStorage('testset', PythonReadabilityExtractor)
+        for doc in LocalDatasetLoader('testset'):
+            if doc.id < '05':
+                storage.push_result(doc)
+        loader = LocalDatasetLoader('testset', skip_existing = 'python_read')
+        self.assertEqual([d.id for d in loader], self.ids[5:])
+        self.assertEqual((len(loader), loader.count_accepted()), (15, 10))
+        
+    def test_skip_existing_packed(self):
+        storage = PackedResultStorage('testset', PythonReadabilityExtractor)
+        for doc in LocalDatasetLoader('testset'):
+            if doc.id >= '10':
+                storage.push_result(doc)
+        storage.flush()
+        orig = getattr(settings, 'RESULT_STORAGE', 'files')
+        settings.RESULT_STORAGE = 'packed'
+        try:
+            loader = LocalDatasetLoader('testset', skip_existing = 'python_read')
+            self.assertEqual([d.id for d in loader], self.ids[:10])
+        finally:
+            settings.RESULT_STORAGE = orig
+
+class TestMetaIndex(DatasetTestCase):
+    
+    def meta_path(self, name):
+        return os.path.join(self.root, 'datasets', 'testset', name)
+    
+    def test_compiled_once(self):
+        self.assertEqual(len(MetaIndex('testset')), 15)
+        self.assertTrue(os.path.exists(self.meta_path('meta.idx')))
+        compile = MetaIndex.compile
+        MetaIndex.compile = None
+        try:
+            index = MetaIndex('testset')
+            self.assertEqual([r.id for r in index], self.ids)
+        finally:
+            MetaIndex.compile = compile
+        record = list(index)[4]
+        self.assertEqual((record.raw, record.clean_encoding), ('04.html', 'utf-8'))
+        
+    def test_invalidated(self):
+        MetaIndex('testset')
+        create_dataset(self.root, 'other', ['a', 'b'])
+        shutil.copy(self.meta_path('../other/meta.yaml'), self.meta_path('meta.yaml'))
+        self.assertEqual([d.id for d in LocalDatasetLoader('testset')], ['a', 'b'])
+        # a new timestamp alone keeps the records, only the header is updated
+        os.utime(self.meta_path('meta.yaml'), (1, 1))
+        compile = MetaIndex.compile
+        MetaIndex.compile = None
+        try:
+            self.assertEqual([r.id for r in MetaIndex('testset')], ['a', 'b'])
+            self.assertEqual(MetaIndex('testset')._header[2], 1)
+        finally:
+            MetaIndex.compile = compile
+        
+    def test_old_header(self):
+        with open(self.meta_path('meta.idx'), 'wb') as f:
+            marshal.dump((MetaIndex._magic, MetaIndex._version, 1), f)
+        self.assertEqual(len(MetaIndex('testset')), 15)
+
+    def test_streaming_parse(self):
+        meta = [dict(id = i, url = None, raw = '%d.html' % i, meta = {'a': [1, 2]}, 
+                     text = 'line\n- not an item\n') for i in range(50)]
+        block = yaml.dump(meta, default_flow_style = False)
+        self.assertEqual(list(iter_meta_yaml(StringIO(block))), meta)
+        flow = yaml.dump(meta, default_flow_style = True)
+        self.assertEqual(list(iter_meta_yaml(StringIO(flow))), meta)
+        self.assertEqual(list(iter_meta_yaml(StringIO(''))), [])
+        
+    def test_compact_documents(self):
+        doc = list(LocalDatasetLoader('testset'))[0]
+        self.assertFalse(hasattr(doc, '__dict__'))
+        html = doc.get_raw_html()
+        self.assertTrue(doc.get_raw_html() is html)
+        copy = pickle.loads(pickle.dumps(doc, 2))
+        self.assertEqual((copy.id, copy.raw_filename, copy._raw_html), ('00', '00.html', None))
+        self.assertEqual(copy.get_raw_html(), html)
+
+class TestFanOut(DatasetTestCase):
+
+    extractors = (JustextExtractor, PythonReadabilityExtractor)
+
+    def run_single(self):
+        for ex in self.extractors:
+            storage = LocalResultStorage('testset', ex)
+            SerialRunner(storage).run(LocalDatasetLoader('testset'))
+            storage.dump_summary()
+        return [self.result_files(ex.SLUG) for ex in self.extractors], self.summary()
+
+    def run_fan_out(self, workers):
+        summary = ExtractionSummary('testset')
+        storages = [LocalResultStorage('testset', ex, summary) for ex in self.extractors]
+        FanOutRunner(storages, workers).run(LocalDatasetLoader('testset'))
+        for storage in storages:
+            storage.dump_summary()
+        return [self.result_files(ex.SLUG) for ex in self.extractors], self.summary()
+
+    def test_same_as_single_runs(self):
+        files, summary = self.run_single()
+        self.assertEqual(len(files[1]), 15)
+        for workers in (1, 4):
+            result_dir = os.path.join(self.root, 'datasets', 'testset', 'result')
+            shutil.rmtree(result_dir)
+            os.mkdir(result_dir)
+            self.assertEqual((files, summary), self.run_fan_out(workers))
+
+class TestProcessRunner(DatasetTestCase):
+    
+    def run_extraction(self, runner_cls, *args):
+        result_dir = os.path.join(self.root, 'datasets', 'testset', 'result')
+        shutil.rmtree(result_dir)
+        os.mkdir(result_dir)
+        storage = LocalResultStorage('testset', PythonReadabilityExtractor)
+        runner_cls(storage, *args).run(LocalDatasetLoader('testset'))
+        storage.dump_summary()
+        return self.result_files('python_read'), self.summary()
+        
+    def test_same_as_serial(self):
+        serial = self.run_extraction(SerialRunner)
+        self.assertEqual(len(serial[0]), 15)
+        self.assertEqual(serial, self.run_extraction(ProcessRunner, 3))
+        
+    def test_bounded_read_ahead(self):
+        storage = LocalResultStorage('testset', PythonReadabilityExtractor)
+        stored = []
+        store_result = storage.store_result
+        storage.store_result = lambda doc, outcome: (stored.append(doc.id), 
+                                                     store_result(doc, outcome))
+        ahead = []
+        def docs():
+            for doc in LocalDatasetLoader('testset'):
+                ahead.append(len(ahead) - len(stored))
+                yield doc
+        runner = ProcessRunner(storage, 2)
+        runner.pending_per_worker = 2
+        runner.run(docs())
+        self.assertEqual(stored, self.ids)
+        self.assertTrue(max(ahead) <= 4, ahead)
+        
+    def test_selected_for_cpu_bound(self):
+        storage = LocalResultStorage('testset', PythonReadabilityExtractor)
+        self.assertTrue(isinstance(get_runner(storage, 2), ProcessRunner))
+        self.assertFalse(isinstance(get_runner(storage, 1), ProcessRunner))
+
+class FailingReadabilityExtractor(PythonReadabilityExtractor):
+    '''python_read that fails on empty documents'''
+    
+    def extract(self):
+        if self.data_instance.id.endswith('3'):
+            raise ContentExtractorError('empty document')
+        return super(FailingReadabilityExtractor, self).extract()
+        
+class TestJournal(DatasetTestCase):
+    
+    def interrupted_run(self, stop_after):
+        def docs():
+            for i, doc in enumerate(LocalDatasetLoader('testset')):
+                if i == stop_after:
+                    raise KeyboardInterrupt
+                yield doc
+        storage = LocalResultStorage('testset', FailingReadabilityExtractor)
+        with self.assertRaises(KeyboardInterrupt):
+            SerialRunner(storage).run(docs())
+        # the process dies before the journal is closed
+        storage._journal.sync()
+        
+    def test_summary_from_journal(self):
+        storage = LocalResultStorage('testset', FailingReadabilityExtractor)
+        SerialRunner(storage).run(LocalDatasetLoader('testset'))
+        storage.dump_summary()
+        self.assertEqual(self.summary()['python_read'], 
+            [{'id': id, 'reason': "Content extractor related error: ContentExtractorError('empty document',)",
+              'category': 'content-error'} for id in ('03', '13')])
+        records = list(ExtractionJournal('testset', 'python_read').records())
+        self.assertTrue('run' in records[0])
+        self.assertEqual([r['id'] for r in records[1:]], self.ids)
+        self.assertTrue(all(r['latency'] >= 0 for r in records[1:]))
+        
+    def test_resume(self):
+        self.interrupted_run(7)
+        # failures are known although the summary was never written
+        self.assertEqual(ExtractionSummary('testset').get_failed_ids('python_read'), set(['03']))
+        
+        loader = LocalDatasetLoader('testset', resume = 'python_read')
+        self.assertEqual([d.id for d in loader], self.ids[7:])
+        storage = LocalResultStorage('testset', FailingReadabilityExtractor, 
+                                     journal_mode = 'resume')
+        SerialRunner(storage).run(loader)
+        storage.dump_summary()
+        self.assertEqual([f['id'] for f in self.summary()['python_read']], ['03', '13'])
+        self.assertTrue(all(type(f['id']) is str for f in self.summary()['python_read']))
+        self.assertEqual(len(self.result_files('python_read')), 13)
+        journal = ExtractionJournal('testset', 'python_read')
+        self.assertEqual(len(journal.last_run_ids()), 15)
+        
+    def test_damaged_tail(self):
+        self.interrupted_run(4)
+        journal = ExtractionJournal('testset', 'python_read')
+        with open(journal.path, 'a') as f:
+            f.write('{"id": "04", "o')
+        self.assertEqual(journal.last_run_ids(), set(self.ids[:4]))
+        
+    def test_resume_damaged_tail(self):
+        self.interrupted_run(4)
+        journal = ExtractionJournal('testset', 'python_read')
+        with open(journal.path, 'a') as f:
+            f.write('{"id": "03", "o')
+        loader = LocalDatasetLoader('testset', resume = 'python_read')
+        self.assertEqual([d.id for d in loader], self.ids[4:])
+        storage = LocalResultStorage('testset', FailingReadabilityExtractor, 
+                                     journal_mode = 'resume')
+        SerialRunner(storage).run(loader)
+        storage.dump_summary()
+        # the first new record is not glued onto the partial one
+        self.assertEqual(journal.last_run_ids(), set(self.ids))
+        with open(journal.path) as f:
+            self.assertFalse('"o{' in f.read())
+        self.assertEqual([f['id'] for f in self.summary()['python_read']], ['03', '13'])
+
+class TestFailureIndex(DatasetTestCase):
+    
+    def category(self, error):
+        '''Category of the failure run_extractor records for the error'''
+        class Extractor(object):
+            def extract(self):
+                raise error
+        return failure_category(run_extractor(Extractor()).error)
+    
+    def test_categories(self):
+        self.assertEqual(self.category(ExtractorError('<urlopen error timed out>', timeout = True)), 'timeout')
+        self.assertEqual(self.category(ExtractorError('<urlopen error [Errno 111] Connection refused>')), 'network')
+        self.assertEqual(self.category(ExtractorError('HTTP Error 503: Service Unavailable', 503)), 'server-error')
+        self.assertEqual(self.category(ExtractorError('HTTP Error 504: Gateway Timeout', 504)), 'server-error')
+        self.assertEqual(self.category(ExtractorError('HTTP Error 404: Not Found', 404)), 'client-error')
+        self.assertEqual(self.category(ContentExtractorError('failed')), 'content-error')
+        self.assertEqual(self.category(KeyError('x')), 'unknown')
+        # errors of the zemanta client only carry a message
+        self.assertEqual(failure_category("Extractor related error: ExtractorError(\"TTransportException('timed out',)\",)"), 'timeout')
+        self.assertEqual(failure_category(None), 'unknown')
+        
+    def test_retry_subset(self):
+        summary = ExtractionSummary('testset')
+        summary.add_fail('01', "Extractor related error (HTTP 503): ExtractorError('HTTP Error 503: x',)", 'python_read')
+        summary.add_fail('02', "Content extractor related error: ContentExtractorError('x',)", 'python_read')
+        summary.add_fail('04', "Extractor related error: ExtractorError('timed out',)", 'python_read')
+        summary.serialize()
+        self.assertEqual(summary.short_summary('python_read'), 
+            'extraction summary: 3 failed (network: 0, client-error: 0, server-error: 1, '
+            'content-error: 1, timeout: 1, unknown: 0)')
+        loader = LocalDatasetLoader('testset', load_failed = 'python_read')
+        self.assertEqual([d.id for d in loader], ['01', '02', '04'])
+        loader = LocalDatasetLoader('testset', load_failed = 'python_read',
+                                    failed_categories = ['server-error', 'timeout'])
+        self.assertEqual([d.id for d in loader], ['01', '04'])
+        # summaries written before categories existed
+        index = FailureIndex([{'id': '01', 'reason': "Unknown error: ValueError()"}])
+        self.assertEqual(index.counts()['unknown'], 1)
+        self.assertTrue('01' in index)
+
+class TestPackedStorage(DatasetTestCase):
+    
+    def test_same_as_files(self):
+        files = LocalResultStorage('testset', FailingReadabilityExtractor)
+        SerialRunner(files).run(LocalDatasetLoader('testset'))
+        files.dump_summary()
+        summary = self.summary()
+        
+        packed = PackedResultStorage('testset', FailingReadabilityExtractor)
+        packed.batch_size = 4
+        SerialRunner(packed).run(LocalDatasetLoader('testset'))
+        packed.dump_summary()
+        self.assertEqual(summary, self.summary())
+        
+        # a fresh storage sees the committed results
+        packed = PackedResultStorage('testset', FailingReadabilityExtractor)
+        for doc in LocalDatasetLoader('testset'):
+            if doc.id.endswith('3'):
+                with self.assertRaises(DataError):
+                    packed.fetch_result(doc)
+            else:
+                self.assertEqual(packed.fetch_result(doc), files.fetch_result(doc))
+                
+    def test_convert(self):
+        files = LocalResultStorage('testset', PythonReadabilityExtractor)
+        SerialRunner(files).run(LocalDatasetLoader('testset'))
+        expected = self.result_files('python_read')
+        self.assertEqual(convert_results('testset', PythonReadabilityExtractor, 
+                                         LocalResultStorage, PackedResultStorage), 15)
+        shutil.rmtree(os.path.join(self.root, 'datasets', 'testset', 'result', 'python_read'))
+        self.assertEqual(convert_results('testset', PythonReadabilityExtractor, 
+                                         PackedResultStorage, LocalResultStorage), 15)
+        self.assertEqual(self.result_files('python_read'), expected)
+
+class NoReadabilityExtractor(PythonReadabilityExtractor):
+    '''python_read that must be served from the cache'''
+    
+    def extract(self):
+        raise AssertionError('extractor called for %s' % self.data_instance.id)
+
+class TestExtractionCache(DatasetTestCase):
+    
+    def setUp(self):
+        super(TestExtractionCache, self).setUp()
+        self._orig_size = getattr(settings, 'EXTRACTION_CACHE_SIZE', None)
+        settings.EXTRACTION_CACHE_SIZE = 1
+        create_dataset(self.root, 'otherset', self.ids)
+        
+    def tearDown(self):
+        close_extraction_cache()
+        if self._orig_size is None:
+            settings.__dict__.pop('EXTRACTION_CACHE_SIZE', None)
+        else:
+            settings.EXTRACTION_CACHE_SIZE = self._orig_size
+        super(TestExtractionCache, self).tearDown()
+        
+    def run_extraction(self, dataset, extractor_cls, runner_cls = SerialRunner, *args):
+        storage = LocalResultStorage(dataset, extractor_cls)
+        runner_cls(storage, *args).run(LocalDatasetLoader(dataset))
+        storage.dump_summary()
+        return storage
+        
+    def test_shared_across_datasets(self):
+        storage = self.run_extraction('testset', PythonReadabilityExtractor)
+        self.assertEqual((storage.cache_hits, storage.cache_misses), (0, 15))
+        self.assertEqual(ExtractionSummary('testset').get_cache_stats('python_read'), (0, 15))
+        files = self.result_files('python_read')
+        # otherset holds the same documents
+        storage = self.run_extraction('otherset', NoReadabilityExtractor)
+        self.assertEqual((storage.cache_hits, storage.cache_misses), (15, 0))
+        self.assertEqual(ExtractionSummary('otherset').get_cache_stats('python_read'), (15, 0))
+        path = os.path.join(self.root, 'datasets', 'otherset', 'result', 'python_read')
+        self.assertEqual(sorted(os.listdir(path)), sorted(files))
+        with open(os.path.join(path, '07.html')) as f:
+            self.assertEqual(f.read(), files['07.html'])
+        
+    def test_process_runner(self):
+        self.run_extraction('testset', PythonReadabilityExtractor, ProcessRunner, 2)
+        files = self.result_files('python_read')
+        shutil.rmtree(os.path.join(self.root, 'datasets', 'testset', 'result', 'python_read'))
+        storage = self.run_extraction('testset', NoReadabilityExtractor, ProcessRunner, 2)
+        self.assertEqual(storage.cache_hits, 15)
+        self.assertEqual(files, self.result_files('python_read'))
+        
+    def test_follows_settings(self):
+        cache = get_extraction_cache()
+        self.assertEqual(os.path.dirname(cache.path), self.root)
+        other = tempfile.mkdtemp()
+        settings.PATH_LOCAL_DATA = other
+        try:
+            self.assertEqual(os.path.dirname(get_extraction_cache().path), other)
+        finally:
+            close_extraction_cache()
+            settings.PATH_LOCAL_DATA = self.root
+            shutil.rmtree(other)
+        
+    def test_version(self):
+        self.run_extraction('testset', PythonReadabilityExtractor)
+        class NewReadabilityExtractor(PythonReadabilityExtractor):
+            VERSION = '2'
+        storage = self.run_extraction('otherset', NewReadabilityExtractor)
+        self.assertEqual((storage.cache_hits, storage.cache_misses), (0, 15))
+
+class TestCompressedDataset(DatasetTestCase):
+    
+    def setUp(self):
+        super(TestCompressedDataset, self).setUp()
+        self._orig_compression = getattr(settings, 'COMPRESSION', None)
+        
+    def tearDown(self):
+        if self._orig_compression is None:
+            settings.__dict__.pop('COMPRESSION', None)
+        else:
+            settings.COMPRESSION = self._orig_compression
+        super(TestCompressedDataset, self).tearDown()
+        
+    def read_all(self, storage_cls):
+        storage = storage_cls('testset', PythonReadabilityExtractor)
+        return [(doc.get_raw_html(), doc.get_clean(), storage.fetch_result(doc))
+                for doc in LocalDatasetLoader('testset')]
+        
+    def test_transparent_reads(self):
+        for storage_cls in (LocalResultStorage, PackedResultStorage):
+            storage = storage_cls('testset', PythonReadabilityExtractor)
+            SerialRunner(storage).run(LocalDatasetLoader('testset'))
+            storage.dump_summary()
+        plain = [self.read_all(cls) for cls in (LocalResultStorage, PackedResultStorage)]
+        files, before, after = compress_dataset('testset', 'gzip')
+        self.assertEqual(files, 3 * 15 + 1)
+        self.assertTrue(after < before)
+        raw = os.listdir(os.path.join(self.root, 'datasets', 'testset', 'raw'))
+        self.assertTrue(all(name.endswith('.html.gz') for name in raw))
+        self.assertEqual(plain, [self.read_all(cls) for cls in (LocalResultStorage, PackedResultStorage)])
+        self.assertEqual(LocalResultStorage.existing_ids('testset', PythonReadabilityExtractor),
+                         set(self.ids))
+        compress_dataset('testset', None)
+        self.assertEqual(sorted(self.result_files('python_read')), 
+                         ['%s.html' % id for id in self.ids])
+        
+    def test_new_results_compressed(self):
+        settings.COMPRESSION = {'testset': 'gzip'}
+        storage = LocalResultStorage('testset', PythonReadabilityExtractor)
+        SerialRunner(storage).run(LocalDatasetLoader('testset'))
+        storage.dump_summary()
+        self.assertEqual(sorted(self.result_files('python_read')),
+                         ['%s.html.gz' % id for id in self.ids])
+        doc = iter(LocalDatasetLoader('testset')).next()
+        self.assertTrue('<p>' in storage.fetch_result(doc))
+
+class TestCorpusPack(DatasetTestCase):
+    
+    def documents(self, loader):
+        return [(doc.id, doc.get_raw_html(), doc.get_clean()) for doc in loader]
+    
+    def test_same_as_files(self):
+        compress_dataset('testset', 'gzip')
+        self.assertEqual(CorpusPack.build('testset'), 15)
+        files = self.documents(LocalDatasetLoader('testset'))
+        loader = get_dataset_loader_cls('packed')('testset')
+        self.assertTrue(isinstance(loader, PackedDatasetLoader))
+        self.assertEqual(len(loader), 15)
+        self.assertEqual(files, self.documents(loader))
+        doc = pickle.loads(pickle.dumps(list(loader)[7], pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(doc.get_clean(), files[7][2])
+        
+    def test_process_runner(self):
+        CorpusPack.build('testset')
+        storage = LocalResultStorage('testset', PythonReadabilityExtractor)
+        SerialRunner(storage).run(LocalDatasetLoader('testset'))
+        storage.dump_summary()
+        files = self.result_files('python_read')
+        shutil.rmtree(os.path.join(self.root, 'datasets', 'testset', 'result', 'python_read'))
+        storage = LocalResultStorage('testset', PythonReadabilityExtractor)
+        ProcessRunner(storage, 2).run(PackedDatasetLoader('testset'))
+        storage.dump_summary()
+        self.assertEqual(files, self.result_files('python_read'))
+        
+    def test_out_of_date(self):
+        with self.assertRaises(DataError):
+            PackedDatasetLoader('testset')
+        CorpusPack.build('testset')
+        create_dataset(self.root, 'otherset', self.ids[:3])
+        shutil.copy(os.path.join(self.root, 'datasets', 'otherset', 'meta.yaml'),
+                    os.path.join(self.root, 'datasets', 'testset', 'meta.yaml'))
+        with self.assertRaises(DataError):
+            PackedDatasetLoader('testset')
+        # a rebuilt pack is picked up
+        CorpusPack.build('testset')
+        self.assertEqual(len(list(PackedDatasetLoader('testset'))), 3)
+
+class TestShards(DatasetTestCase):
+    
+    shards = [Shard(i, 3) for i in (1, 2, 3)]
+    
+    def run_shards(self, storage_cls, extractor_cls, shards, **kwargs):
+        journal_mode = 'append' if kwargs else 'new'
+        for shard in shards:
+            storage = storage_cls('testset', extractor_cls, journal_mode = journal_mode,
+                                  shard = shard)
+            SerialRunner(storage).run(LocalDatasetLoader('testset', shard = shard, **kwargs))
+            storage.dump_summary()
+    
+    def test_partition(self):
+        self.assertEqual(Shard.parse('2/3'), (2, 3))
+        self.assertEqual(str(Shard(2, 3)), '2/3')
+        for value in ('0/3', '4/3', '2', 'a/b'):
+            with self.assertRaises(ValueError):
+                Shard.parse(value)
+        parts = [[id for id in self.ids if shard.accepts(id)] for shard in self.shards]
+        self.assertEqual(sorted(sum(parts, [])), self.ids)
+        self.assertTrue(all(parts))
+        
+    def test_merge_same_as_single_run(self):
+        storage = LocalResultStorage('testset', FailingReadabilityExtractor)
+        SerialRunner(storage).run(LocalDatasetLoader('testset'))
+        storage.dump_summary()
+        files, summary = self.result_files('python_read'), self.summary()
+        shutil.rmtree(os.path.join(self.root, 'datasets', 'testset', 'result'))
+        os.mkdir(os.path.join(self.root, 'datasets', 'testset', 'result'))
+        self.run_shards(LocalResultStorage, FailingReadabilityExtractor, self.shards)
+        self.assertEqual(merge_shards('testset'), 3)
+        self.assertEqual(files, self.result_files('python_read'))
+        merged = self.summary()
+        self.assertEqual(sorted(merged.pop('python_read')), sorted(summary.pop('python_read')))
+        self.assertEqual(merged, summary)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, 'datasets', 'testset', 'result'))),
+                         ['python_read', 'summary.yaml'])
+        
+    def test_merge_crashed_shard(self):
+        self.run_shards(LocalResultStorage, FailingReadabilityExtractor, self.shards[1:])
+        # the first shard crashes before dumping its summary
+        storage = LocalResultStorage('testset', FailingReadabilityExtractor,
+                                     shard = self.shards[0])
+        SerialRunner(storage).run(LocalDatasetLoader('testset', shard = self.shards[0]))
+        storage._journal.close()
+        self.assertEqual(merge_shards('testset'), 3)
+        self.assertEqual(ExtractionSummary('testset').get_failed_ids('python_read'),
+                         set(['03', '13']))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, 'datasets', 'testset', 'result'))),
+                         ['python_read', 'summary.yaml'])
+        
+    def test_retry_failed_shard(self):
+        failing = ['03', '13']
+        self.run_shards(PackedResultStorage, FailingReadabilityExtractor, self.shards)
+        merge_shards('testset')
+        self.assertEqual(PackedResultStorage.existing_ids('testset', PythonReadabilityExtractor),
+                         set(self.ids) - set(failing))
+        # only the shard holding 03 is retried, with an extractor that succeeds
+        shard = [shard for shard in self.shards if shard.accepts('03')]
+        self.run_shards(PackedResultStorage, PythonReadabilityExtractor, shard,
+                        load_failed = 'python_read')
+        merge_shards('testset')
+        expected = set(id for id in failing if not shard[0].accepts(id))
+        self.assertEqual(ExtractionSummary('testset').get_failed_ids('python_read'), expected)
+        self.assertEqual(PackedResultStorage.existing_ids('testset', PythonReadabilityExtractor),
+                         set(self.ids) - expected)
+
+def main():
+    unittest2.main(exit = False, verbosity = 2)
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,32 @@
 # -*- coding: utf-8 -*-
+import os
 import re
 import math
+import time
+import pickle
+import sqlite3
+import random
 
 import unittest2
 
+import settings
+
 from txtexeval.util import html_to_text
 from txtexeval.evaluation import _tokenize_text, _bow
 from txtexeval.evaluation import TextOnlyEvaluator
 from txtexeval.evaluation import TextBasedResults, Result
 from txtexeval.evaluation import BaseResultFormat, TextResultFormat, \
                                  CleanEvalFormat,GoogleNewsFormat
+from txtexeval.evaluation import GoldTokenCache, get_gold_cache, EvaluationManifest
+from txtexeval.evaluation import BowEvaluator
+from txtexeval.matching import lcs_length, difflib_match_count, ParityMatcher
+from txtexeval.matching import bow_match_counts
+from txtexeval.data import LocalDatasetLoader, LocalResultStorage
+from txtexeval.extractor import PythonReadabilityExtractor, JustextExtractor
+from txtexeval.runner import SerialRunner
+
+from evaluate_manage import single_evaluation, parallel_evaluation, bow_evaluation
+from test_data import DatasetTestCase
                                  
                                  
 class TestHelpers(unittest2.TestCase):        
@@ -294,6 +311,300 @@ class TestTextBasedResults(unittest2.TestCase):
         except AssertionError:
             self.fail()
 
+def dp_lcs_length(a, b):
+    # textbook dynamic programming LCS
+    row = [0] * (len(b) + 1)
+    for x in a:
+        prev = 0
+        for j, y in enumerate(b):
+            prev, row[j + 1] = row[j + 1], prev + 1 if x == y else max(row[j + 1], row[j])
+    return row[-1]
+
+class TestMatching(unittest2.TestCase):
+    
+    def test_same_as_dp(self):
+        rnd = random.Random(7)
+        for i in range(200):
+            words = ['w%d' % w for w in range(rnd.randint(1, 8))]
+            a = [rnd.choice(words) for w in range(rnd.randint(0, 40))]
+            b = [rnd.choice(words) for w in range(rnd.randint(0, 40))]
+            self.assertEqual(lcs_length(a, b), dp_lcs_length(a, b), (a, b))
+            
+    def test_no_autojunk(self):
+        # "the" makes up more than 1% of a long sequence, difflib never matches it
+        rnd = random.Random(3)
+        a = [rnd.choice(['the', 'w%d' % i]) for i in range(2000)]
+        b = [w for w in a if rnd.random() < 0.8]
+        self.assertEqual(lcs_length(a, b), len(b))
+        self.assertTrue(difflib_match_count(a, b) < len(b))
+        
+    def test_long_document(self):
+        rnd = random.Random(5)
+        words = ['w%d' % i for i in range(3000)]
+        a = [rnd.choice(words) for i in range(20000)]
+        b = [w for w in a if rnd.random() < 0.5] + [rnd.choice(words) for i in range(5000)]
+        started = time.time()
+        self.assertTrue(lcs_length(a, b) >= len(b) - 5000)
+        self.assertTrue(time.time() - started < 5)
+        
+    def test_parity(self):
+        matcher = ParityMatcher()
+        ret = dummy_format_factory(['a', 'b', 'c', 'x', 'a', 'b'])
+        rel = dummy_format_factory(['a', 'b', 'x', 'c', 'a', 'b'])
+        result = TextOnlyEvaluator(ret, rel, 'doc', matcher).get_eval_results()
+        self.assertAlmostEqual(result.precision, 5 / 6.)
+        self.assertEqual(matcher.checked, 1)
+        self.assertEqual(matcher.diverged, [])
+        self.assertEqual(matcher.summary(), 'parity: 1 documents, no divergence from difflib')
+        # difflib's autojunk heuristic misses the matches of a frequent word
+        rnd = random.Random(3)
+        rel = [rnd.choice(['the', 'w%d' % i]) for i in range(2000)]
+        ret = [w for w in rel if rnd.random() < 0.8]
+        legacy = difflib_match_count(rel, ret)
+        result = TextOnlyEvaluator(dummy_format_factory(ret), dummy_format_factory(rel),
+                                   'doc2', matcher).get_eval_results()
+        self.assertEqual(result.precision, 1.)
+        self.assertEqual(matcher.checked, 2)
+        self.assertEqual(matcher.diverged, [('doc2', len(ret), legacy)])
+        self.assertEqual(matcher.summary(), 'parity: 1 of 2 documents diverge from difflib '
+                         '(largest: doc2, %d != %d)' % (len(ret), legacy))
+
+class EvaluationTestCase(DatasetTestCase):
+    '''Stored results of the test dataset to evaluate'''
+    
+    extractors = (PythonReadabilityExtractor, JustextExtractor)
+    
+    def setUp(self):
+        super(EvaluationTestCase, self).setUp()
+        # justext keeps no paragraph of the test documents, python_read 
+        # results are removed for some of them
+        for extractor_cls in self.extractors:
+            storage = LocalResultStorage('testset', extractor_cls)
+            SerialRunner(storage).run(LocalDatasetLoader('testset'))
+            storage.dump_summary()
+        for id in ('04', '11'):
+            os.remove(os.path.join(self.root, 'datasets', 'testset', 'result', 'python_read', id + '.html'))
+            
+class TestParallelEvaluation(EvaluationTestCase):
+    
+    def test_same_as_serial(self):
+        serial = TextBasedResults()
+        for extractor_cls in self.extractors:
+            single_evaluation(extractor_cls, serial, 'cleaneval', 'testset')
+        parallel = TextBasedResults()
+        matcher = ParityMatcher()
+        parallel_evaluation(self.extractors, parallel, 'cleaneval', 'testset', 3, 'parity', matcher)
+        self.assertEqual(len(parallel.text_eval_results['python_read']), 13)
+        self.assertEqual(parallel.text_eval_results['justext'], [])
+        self.assertEqual(pickle.dumps(serial.__dict__), pickle.dumps(parallel.__dict__))
+        self.assertEqual(matcher.checked, 13)
+
+class TestGoldTokenCache(EvaluationTestCase):
+    
+    def setUp(self):
+        super(TestGoldTokenCache, self).setUp()
+        self._orig_size = getattr(settings, 'GOLD_CACHE_SIZE', None)
+        settings.GOLD_CACHE_SIZE = 1
+        
+    def tearDown(self):
+        if self._orig_size is None:
+            settings.__dict__.pop('GOLD_CACHE_SIZE', None)
+        else:
+            settings.GOLD_CACHE_SIZE = self._orig_size
+        super(TestGoldTokenCache, self).tearDown()
+        
+    def evaluate(self, gold):
+        results = TextBasedResults()
+        for extractor_cls in self.extractors + (PythonReadabilityExtractor,):
+            single_evaluation(extractor_cls, results, 'cleaneval', 'testset', gold = gold)
+        gold.close()
+        return pickle.dumps(results.__dict__)
+        
+    def test_parsed_once(self):
+        uncached = self.evaluate(GoldTokenCache('cleaneval'))
+        gold = get_gold_cache('cleaneval')
+        self.assertEqual(self.evaluate(gold), uncached)
+        # the documents with results share two distinct clean texts
+        self.assertEqual(gold.parsed, 2)
+        gold = get_gold_cache('cleaneval')
+        self.assertEqual(self.evaluate(gold), uncached)
+        self.assertEqual(gold.parsed, 0)
+        # without a store every document is tokenized once per run
+        gold = GoldTokenCache('cleaneval')
+        self.evaluate(gold)
+        self.assertEqual(gold.parsed, 13)
+        # other dataset types are tokenized on their own
+        gold = get_gold_cache('gnews')
+        for doc in LocalDatasetLoader('testset'):
+            gold.word_seq(doc)
+        self.assertEqual(gold.parsed, 2)
+        gold.close()
+        
+    def test_parallel(self):
+        serial = TextBasedResults()
+        for extractor_cls in self.extractors:
+            single_evaluation(extractor_cls, serial, 'cleaneval', 'testset')
+        parallel = TextBasedResults()
+        parallel_evaluation(self.extractors, parallel, 'cleaneval', 'testset', 3)
+        self.assertEqual(pickle.dumps(serial.__dict__), pickle.dumps(parallel.__dict__))
+        # the workers stored the sequences
+        gold = get_gold_cache('cleaneval')
+        self.evaluate(gold)
+        self.assertEqual(gold.parsed, 0)
+        
+    def test_store_not_locked(self):
+        # workers share the store, looking up and storing sequences must 
+        # not leave a write transaction open
+        gold = get_gold_cache('cleaneval')
+        docs = list(LocalDatasetLoader('testset'))
+        gold.word_seq(docs[0])
+        gold.word_seq(docs[1])
+        db = sqlite3.connect(os.path.join(self.root, 'gold-cache.sqlite'), timeout = 0)
+        db.execute('BEGIN IMMEDIATE')
+        db.rollback()
+        db.close()
+        gold.close()
+        
+    def test_token_format(self):
+        doc = list(LocalDatasetLoader('testset'))[0]
+        gold = GoldTokenCache('cleaneval')
+        self.assertEqual(gold.format(doc).get_word_seq(), 
+                         CleanEvalFormat.from_document(doc).get_word_seq())
+        self.assertEqual(gold.format(doc).get_bow(), 
+                         CleanEvalFormat.from_document(doc).get_bow())
+
+class TestEvaluationManifest(EvaluationTestCase):
+    
+    setup = ('cleaneval', 'LCSMatcher', GoldTokenCache.VERSION)
+    
+    def setUp(self):
+        super(TestEvaluationManifest, self).setUp()
+        os.mkdir(os.path.join(self.root, 'results-cache'))
+        
+    def evaluate(self, manifest = None, workers = 1):
+        results = TextBasedResults()
+        if manifest is not None:
+            manifest.load()
+        if workers > 1:
+            parallel_evaluation(self.extractors, results, 'cleaneval', 'testset', workers,
+                                manifest = manifest)
+        else:
+            for extractor_cls in self.extractors:
+                single_evaluation(extractor_cls, results, 'cleaneval', 'testset',
+                                  manifest = manifest)
+        if manifest is not None:
+            manifest.save()
+        return pickle.dumps(results.__dict__)
+    
+    def change_result(self, id):
+        path = os.path.join(self.root, 'datasets', 'testset', 'result', 'python_read', id + '.html')
+        with open(path, 'w') as f:
+            f.write('<p>only a short sentence of the article</p>')
+    
+    def test_incremental(self):
+        self.evaluate(EvaluationManifest('testset', self.setup))
+        self.change_result('07')
+        manifest = EvaluationManifest('testset', self.setup)
+        incremental = self.evaluate(manifest)
+        self.assertEqual(manifest.reused, 12)
+        self.assertEqual(incremental, self.evaluate())
+        # the changed document is recorded as well
+        manifest = EvaluationManifest('testset', self.setup)
+        self.assertEqual(self.evaluate(manifest), incremental)
+        self.assertEqual(manifest.reused, 13)
+        
+    def test_parallel(self):
+        self.evaluate(EvaluationManifest('testset', self.setup), 3)
+        self.change_result('07')
+        self.change_result('08')
+        manifest = EvaluationManifest('testset', self.setup)
+        self.assertEqual(self.evaluate(manifest, 3), self.evaluate())
+        self.assertEqual(manifest.reused, 11)
+        manifest = EvaluationManifest('testset', self.setup)
+        self.evaluate(manifest)
+        self.assertEqual(manifest.reused, 13)
+        
+    def test_other_setup(self):
+        self.evaluate(EvaluationManifest('testset', self.setup))
+        manifest = EvaluationManifest('testset', ('cleaneval', 'DifflibMatcher', '1'))
+        self.evaluate(manifest)
+        self.assertEqual(manifest.reused, 0)
+        # the entries of each setup are kept apart
+        manifest = EvaluationManifest('testset', self.setup)
+        self.evaluate(manifest)
+        self.assertEqual(manifest.reused, 13)
+        
+    def test_no_reuse(self):
+        self.evaluate(EvaluationManifest('testset', self.setup))
+        self.change_result('07')
+        # like --full -u justext: python_read keeps its entries
+        manifest = EvaluationManifest('testset', self.setup, reuse = False)
+        manifest.load()
+        single_evaluation(JustextExtractor, TextBasedResults(), 'cleaneval', 'testset',
+                          manifest = manifest)
+        manifest.save()
+        manifest = EvaluationManifest('testset', self.setup)
+        self.evaluate(manifest)
+        self.assertEqual(manifest.reused, 12)
+        
+    def test_subset(self):
+        self.evaluate(EvaluationManifest('testset', self.setup))
+        self.evaluate(EvaluationManifest('testset', ('cleaneval', 'DifflibMatcher', '1')))
+        manifest = EvaluationManifest('testset', self.setup)
+        manifest.load()
+        # workers only get the entries they look up
+        subset = manifest.subset(['python_read'])
+        self.assertEqual(subset._entries.keys(), ['python_read'])
+        self.assertEqual(len(subset._entries['python_read']), 13)
+        self.assertEqual(subset._others, {})
+        manifest = EvaluationManifest('testset', self.setup, reuse = False)
+        manifest.load()
+        self.assertEqual(manifest.subset(['python_read'])._entries, {})
+
+class TestBowEvaluator(unittest2.TestCase):
+    
+    def test_match_counts(self):
+        rnd = random.Random(11)
+        words = ['w%d' % i for i in range(30)]
+        rel = [rnd.choice(words) for i in range(300)]
+        rets = [[rnd.choice(words) for i in range(rnd.randint(0, 300))] for j in range(10)]
+        expected = [sum(min(rel.count(w), ret.count(w)) for w in set(ret)) for ret in rets]
+        self.assertEqual(bow_match_counts(_bow(rel), [_bow(ret) for ret in rets]), expected)
+        self.assertEqual(bow_match_counts({}, [_bow(rets[0])]), [0])
+        self.assertEqual(bow_match_counts(_bow(rel), []), [])
+        
+    def test_batch(self):
+        rel = dummy_format_factory(['a', 'b', 'c', 'a', 'd'])
+        rets = [dummy_format_factory(seq) for seq in 
+                (['d', 'c', 'b', 'a'], ['x', 'y'], [], ['a', 'a', 'a', 'x'])]
+        batch = BowEvaluator.batch_results(rel, rets, 'doc')
+        for ret, result in zip(rets, batch):
+            single = BowEvaluator(ret, rel, 'doc').get_eval_results()
+            self.assertEqual(repr(single.__dict__), repr(result.__dict__))
+        # word order is ignored, bow never scores lower than the text evaluator
+        self.assertEqual((batch[0].precision, batch[0].recall), (1, 0.8))
+        self.assertTrue(TextOnlyEvaluator(rets[0], rel).get_eval_results().precision < 1)
+        self.assertTrue(batch[1].missmatch)
+        self.assertTrue(batch[2].retrieved_empty)
+        self.assertEqual(batch[3].precision, 0.5)
+        
+    def test_empty_relevant(self):
+        r = BowEvaluator(dummy_format_factory(['one']), dummy_format_factory([])).get_eval_results()
+        self.assertTrue(r.relevant_empty)
+
+class TestBowEvaluation(EvaluationTestCase):
+    
+    def test_bow_evaluation(self):
+        results = TextBasedResults()
+        bow_evaluation(self.extractors, results, 'cleaneval', 'testset')
+        self.assertEqual(results.text_eval_results['justext'], [])
+        text = TextBasedResults()
+        single_evaluation(PythonReadabilityExtractor, text, 'cleaneval', 'testset')
+        bow = results.text_eval_results['python_read']
+        self.assertEqual([r.id for r in bow], [r.id for r in text.text_eval_results['python_read']])
+        for bow_result, text_result in zip(bow, text.text_eval_results['python_read']):
+            self.assertTrue(bow_result.precision >= text_result.precision)
+
 def main():
     unittest2.main(exit = False, verbosity = 2)
     
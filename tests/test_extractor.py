@@ -0,0 +1,61 @@
+import os
+import sys
+import subprocess
+
+import unittest2
+
+from txtexeval.extractor import extractor_list, extractor_registry, get_extractor_cls
+from txtexeval.extractor import PythonReadabilityExtractor
+
+# modules only the extractors that use them may import
+HEAVY_MODULES = ('readability', 'justext', 'selenium', 'thrift', 'lxml')
+
+# import time budgets of the manage scripts in seconds (plot_manage needs
+# matplotlib); wall-clock time depends on the machine, so they are only 
+# checked when the TXTEXEVAL_BENCHMARK environment variable is set
+STARTUP_TARGETS = (
+    ('extract_manage', 0.5),
+    ('evaluate_manage', 0.5),
+    ('plot_manage', 1.5),
+)
+
+_probe = '''
+import sys, time
+started = time.time()
+import %s
+print time.time() - started
+print ' '.join(sorted(set(name.split('.')[0] for name in sys.modules)))
+'''
+
+def import_probe(module):
+    '''Import a module in a fresh interpreter, return (seconds, top level modules)'''
+    env = dict(os.environ, MPLBACKEND = 'Agg')
+    env['PYTHONPATH'] = os.pathsep.join(p for p in sys.path if p)
+    output = subprocess.check_output([sys.executable, '-c', _probe % module], env = env)
+    elapsed, modules = output.splitlines()[-2:]
+    return float(elapsed), set(modules.split())
+
+class TestRegistry(unittest2.TestCase):
+
+    def test_lookup(self):
+        self.assertEqual(list(extractor_registry.values()), list(extractor_list))
+        self.assertTrue(get_extractor_cls('python_read') is PythonReadabilityExtractor)
+        self.assertEqual(get_extractor_cls('unknown'), None)
+
+    def test_startup(self):
+        for module, target in STARTUP_TARGETS:
+            elapsed, modules = import_probe(module)
+            self.assertEqual(modules.intersection(HEAVY_MODULES), set(), module)
+    
+    @unittest2.skipUnless(os.environ.get('TXTEXEVAL_BENCHMARK'), 
+                          'set TXTEXEVAL_BENCHMARK to check the import time budgets')
+    def test_startup_time(self):
+        for module, target in STARTUP_TARGETS:
+            elapsed, modules = import_probe(module)
+            self.assertTrue(elapsed < target, '%s took %.2fs' % (module, elapsed))
+
+def main():
+    unittest2.main(exit = False, verbosity = 2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+import os
+import time
+import random
+import threading
+
+import unittest2
+
+from txtexeval.data import ExtractionOutcome
+from txtexeval.util import Request, common
+from txtexeval.util.connection import split_url
+from txtexeval.extractor import BaseExtractor, ExtractorError, _RequestMin, return_content
+from txtexeval.runner import SerialRunner, ThreadedRunner, AsyncRunner, FanOutRunner, get_runner
+
+from txtexeval.util.retry import RetryPolicy, CircuitBreaker, CircuitBreakers
+
+from test_util import ThreadedHTTPServer, KeepAliveHandler
+
+class DummyDocument(object):
+
+    def __init__(self, id):
+        self.id = id
+
+class DummyStorage(object):
+    '''Records the order of stored outcomes, odd ids fail'''
+    
+    extractor_cls = BaseExtractor
+
+    def __init__(self, delay = 0):
+        self.delay = delay
+        self.stored = []
+        self.threads = set()
+
+    def extract_result(self, document):
+        self.threads.add(threading.current_thread().name)
+        if self.delay:
+            time.sleep(random.random() * self.delay)
+        if document.id % 2:
+            return ExtractionOutcome(None, 'failed %d' % document.id)
+        return ExtractionOutcome('result %d' % document.id, None)
+
+    def store_result(self, document, outcome):
+        # latencies differ from run to run
+        self.stored.append((document.id, outcome._replace(latency = None)))
+
+    def push_result(self, document):
+        self.store_result(document, self.extract_result(document))
+
+class SerializedExtractor(BaseExtractor):
+    
+    SLUG = 'serialized'
+    CONCURRENT = False
+    
+class PidExtractor(BaseExtractor):
+    '''Extracts the id of the process it runs in'''
+    
+    SLUG = 'pid'
+    CPU_BOUND = True
+    
+    def extract(self):
+        return str(os.getpid())
+    
+class PidStorage(DummyStorage):
+    
+    extractor_cls = PidExtractor
+    
+    def cached_outcome(self, document):
+        return None
+
+class EchoExtractor(_RequestMin, BaseExtractor):
+    '''Posts the document id to the test server, ids divisible by 3 fail'''
+    
+    SLUG = 'echo'
+    FORMAT = 'txt'
+    url = None
+    
+    def request(self):
+        path = '/error' if self.data_instance.id % 3 == 0 else '/post'
+        return Request(self.url + path, {'id': self.data_instance.id})
+    
+    @return_content
+    def extract(self):
+        return self.fetch()
+    
+class FlakyExtractor(EchoExtractor):
+    '''The first two requests for every document fail with 503'''
+    
+    _http_method = 'GET'
+    
+    def request(self):
+        return Request(self.url + '/flaky-async', {'id': self.data_instance.id})
+    
+class DownExtractor(EchoExtractor):
+    '''Every request fails'''
+    
+    def request(self):
+        return Request(self.url + '/error', {'id': self.data_instance.id})
+
+class HTTPStorage(DummyStorage):
+    
+    extractor_cls = EchoExtractor
+    
+    def extract_result(self, document, extractor = None):
+        extractor = extractor or self.extractor_cls(document)
+        try:
+            return ExtractionOutcome(extractor.extract(), None)
+        except ExtractorError as e:
+            return ExtractionOutcome(None, str(e))
+
+class TestRunners(unittest2.TestCase):
+
+    def setUp(self):
+        self.docs = [DummyDocument(i) for i in range(50)]
+        # a single attempt per request
+        self._retry_policy = common.retry_policy
+        common.retry_policy = RetryPolicy(max_attempts = 1)
+        common.circuit_breakers.clear()
+        
+    def tearDown(self):
+        common.retry_policy = self._retry_policy
+        common.circuit_breakers.clear()
+
+    def test_threaded_same_as_serial(self):
+        serial = DummyStorage()
+        SerialRunner(serial).run(self.docs)
+        threaded = DummyStorage(delay = 0.005)
+        ThreadedRunner(threaded, 8).run(iter(self.docs))
+        self.assertEqual(serial.stored, threaded.stored)
+        self.assertTrue(len(threaded.threads) > 1)
+
+    def test_threaded_storage_error(self):
+        class BrokenStorage(DummyStorage):
+            def extract_result(self, document):
+                if document.id == 7:
+                    raise IOError('storage gone')
+                return DummyStorage.extract_result(self, document)
+        storage = BrokenStorage()
+        ThreadedRunner(storage, 4).run(iter(self.docs))
+        self.assertEqual(len(storage.stored), 50)
+        self.assertTrue('storage gone' in storage.stored[7][1].error)
+
+    def test_threaded_empty_loader(self):
+        storage = DummyStorage()
+        ThreadedRunner(storage, 4).run([])
+        self.assertEqual(storage.stored, [])
+
+    def serve(self):
+        server = ThreadedHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        t = threading.Thread(target = server.serve_forever)
+        t.daemon = True
+        t.start()
+        EchoExtractor.url = 'http://127.0.0.1:%d' % server.server_port
+        self.addCleanup(common.connection_pool.clear)
+        self.addCleanup(server.shutdown)
+        
+    def test_async_same_as_serial(self):
+        self.serve()
+        serial = HTTPStorage()
+        SerialRunner(serial).run(self.docs)
+        nonblocking = HTTPStorage()
+        AsyncRunner(nonblocking, 10).run(self.docs)
+        self.assertEqual(serial.stored, nonblocking.stored)
+        self.assertEqual(serial.stored[1][1].result, 'id=1 application/x-www-form-urlencoded')
+        self.assertEqual(serial.stored[0][1].error, 'HTTP Error 503: Service Unavailable')
+
+    def test_async_retry(self):
+        self.serve()
+        common.retry_policy = RetryPolicy(max_attempts = 3, backoff = 0.01)
+        # two of three attempts fail, the breakers must not open
+        self.addCleanup(setattr, common, 'circuit_breakers', common.circuit_breakers)
+        common.circuit_breakers = CircuitBreakers(window = 1000, min_calls = 1000)
+        storage = HTTPStorage()
+        storage.extractor_cls = FlakyExtractor
+        AsyncRunner(storage, 10).run(self.docs)
+        self.assertEqual([outcome for id, outcome in storage.stored], 
+                         [ExtractionOutcome('flaky', None)] * 50)
+        
+    def test_async_circuit_breaker(self):
+        self.serve()
+        self.addCleanup(setattr, common, 'circuit_breakers', common.circuit_breakers)
+        common.circuit_breakers = CircuitBreakers(window = 4, min_calls = 4, cooldown = 0.05)
+        storage = HTTPStorage()
+        storage.extractor_cls = DownExtractor
+        started = time.time()
+        AsyncRunner(storage, 1).run(self.docs[:10])
+        # after four failures the remaining documents are sent one probe per
+        # cooldown
+        self.assertTrue(time.time() - started >= 6 * 0.05)
+        self.assertEqual(len(storage.stored), 10)
+        breaker = common.circuit_breakers.get(split_url(EchoExtractor.url)[0])
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        
+    def test_async_storage_error(self):
+        class BrokenStorage(HTTPStorage):
+            def store_result(self, document, outcome):
+                if document.id == 7:
+                    raise IOError('disk full')
+                HTTPStorage.store_result(self, document, outcome)
+        self.serve()
+        storage = BrokenStorage()
+        with self.assertRaises(IOError):
+            AsyncRunner(storage, 10).run(self.docs)
+        self.assertEqual([id for id, outcome in storage.stored], range(7))
+        
+    def test_fan_out_lanes(self):
+        shared = DummyStorage(delay = 0.005)
+        serialized = DummyStorage(delay = 0.005)
+        serialized.extractor_cls = SerializedExtractor
+        processes = PidStorage()
+        FanOutRunner([shared, serialized, processes], 4).run(iter(self.docs))
+        expected = DummyStorage()
+        SerialRunner(expected).run(self.docs)
+        self.assertEqual(shared.stored, expected.stored)
+        self.assertEqual(serialized.stored, expected.stored)
+        # a serialized extractor keeps to its own thread, the others share
+        self.assertEqual(serialized.threads, set(['extractor-serialized']))
+        self.assertTrue(len(shared.threads) > 1)
+        self.assertFalse('extractor-serialized' in shared.threads)
+        # CPU_BOUND extractors run in worker processes
+        pids = set(outcome.result for id, outcome in processes.stored)
+        self.assertEqual(len(processes.stored), 50)
+        self.assertFalse(str(os.getpid()) in pids)
+        
+    def test_get_runner(self):
+        self.assertTrue(isinstance(get_runner(DummyStorage()), SerialRunner))
+        self.assertTrue(isinstance(get_runner(DummyStorage(), 3), ThreadedRunner))
+        self.assertTrue(isinstance(get_runner(DummyStorage(), 3, use_async = True), AsyncRunner))
+        with self.assertRaises(ValueError):
+            ThreadedRunner(DummyStorage(), 0)
+
+def main():
+    unittest2.main(exit = False, verbosity = 2)
+
+if __name__ == '__main__':
+    main()
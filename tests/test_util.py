@@ -0,0 +1,488 @@
+import os
+import shutil
+import ssl
+import socket
+import tempfile
+import time
+import threading
+import BaseHTTPServer
+import SocketServer
+
+import unittest2
+
+from txtexeval.util import RateLimiter, Request
+from txtexeval.util.connection import ConnectionPool, ConnectionError
+from txtexeval.util.retry import RetryPolicy, CircuitBreaker
+from txtexeval.util.asynchttp import AsyncHTTPClient
+from txtexeval.util.cache import BlobCache
+from txtexeval.util import compression
+from txtexeval.util import common
+
+class FakeClock(object):
+    '''Clock whose sleep just advances the time'''
+
+    def __init__(self):
+        self.now = 0.
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+class TestRateLimiter(unittest2.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def limiter(self, **kwargs):
+        return RateLimiter(clock = self.clock.time, sleep = self.clock.sleep, **kwargs)
+
+    def test_no_limits(self):
+        l = self.limiter()
+        for i in range(100):
+            with l:
+                pass
+        self.assertEqual(self.clock.slept, [])
+
+    def test_burst_then_rate(self):
+        l = self.limiter(rate = 5, burst = 10)
+        for i in range(20):
+            l.acquire()
+            l.release()
+        # first ten go through, the rest are spaced 0.2s apart
+        self.assertEqual(len(self.clock.slept), 10)
+        self.assertAlmostEqual(self.clock.now, 2.0)
+
+    def test_refill_after_idle(self):
+        l = self.limiter(rate = 2, burst = 2)
+        for i in range(2):
+            l.acquire()
+        self.clock.now += 10
+        for i in range(2):
+            l.acquire()
+        self.assertEqual(self.clock.slept, [])
+
+    def test_max_in_flight(self):
+        l = RateLimiter(max_in_flight = 2)
+        l.acquire()
+        l.acquire()
+        acquired = []
+        t = threading.Thread(target = lambda: acquired.append(l.acquire()))
+        t.start()
+        t.join(0.1)
+        self.assertEqual(acquired, [])
+        l.release()
+        t.join(1)
+        self.assertEqual(len(acquired), 1)
+
+    def test_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            RateLimiter(rate = 0)
+        with self.assertRaises(ValueError):
+            RateLimiter(burst = 0)
+        with self.assertRaises(ValueError):
+            RateLimiter(max_in_flight = 0)
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1 # one write per response keeps Nagle out of the way
+    
+    def _reply(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    flaky_hits = {}
+    
+    def do_GET(self):
+        if self.path.startswith('/flaky'):
+            # the first two requests for a path fail
+            hits = self.flaky_hits[self.path] = self.flaky_hits.get(self.path, 0) + 1
+            self._reply(503 if hits <= 2 else 200, 'flaky')
+        elif self.path.startswith('/redirect'):
+            self.send_response(302)
+            self.send_header('Location', '/echo?redirected')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.path.startswith('/error'):
+            self._reply(503, 'down')
+        else:
+            self._reply(200, '%s %d' % (self.path, self.client_address[1]))
+            
+    slow_hits = []
+    
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.path.startswith('/slow'):
+            self.slow_hits.append(body)
+            time.sleep(0.5)
+        if self.path.startswith('/error'):
+            return self._reply(503, 'down')
+        self._reply(200, '%s %s' % (body, self.headers['Content-Type']))
+        
+    def log_message(self, *args):
+        pass
+    
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    
+    daemon_threads = True
+    request_queue_size = 128
+    
+class TestRequest(unittest2.TestCase):
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadedHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        t = threading.Thread(target = cls.server.serve_forever)
+        t.daemon = True
+        t.start()
+        cls.url = 'http://127.0.0.1:%d' % cls.server.server_port
+        
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        common.connection_pool.clear()
+        
+    def setUp(self):
+        # a single attempt per request unless a test says otherwise
+        self._retry_policy = common.retry_policy
+        common.retry_policy = RetryPolicy(max_attempts = 1)
+        common.circuit_breakers.clear()
+        
+    def tearDown(self):
+        common.retry_policy = self._retry_policy
+        common.circuit_breakers.clear()
+        
+    def test_get_reuses_connection(self):
+        r1 = Request(self.url + '/echo', {'a': 1}).get()
+        r2 = Request(self.url + '/echo', {'a': 2}).get()
+        self.assertTrue(r1.success())
+        self.assertEqual(r1.status_code, 200)
+        path1, port1 = r1.content.split()
+        path2, port2 = r2.content.split()
+        self.assertEqual(path1, '/echo?a=1')
+        # same client port means the same socket was used
+        self.assertEqual(port1, port2)
+        
+    def test_post(self):
+        r = Request(self.url + '/post', {'rawHtml': '<p>'}).post()
+        self.assertTrue(r.success())
+        self.assertEqual(r.content, 'rawHtml=%3Cp%3E application/x-www-form-urlencoded')
+        r = Request(self.url + '/post', 'text', headers = {'Content-Type': 'text/plain'}).post()
+        self.assertEqual(r.content, 'text text/plain')
+        
+    def test_redirect(self):
+        r = Request(self.url + '/redirect', '').get()
+        self.assertTrue(r.success())
+        self.assertTrue(r.content.startswith('/echo?redirected'))
+        
+    def test_http_error(self):
+        r = Request(self.url + '/error', '').get()
+        self.assertFalse(r.success())
+        self.assertEqual(r.err_msg, 'HTTP Error 503: Service Unavailable')
+        
+    def test_connection_refused(self):
+        s = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        port = s.server_port
+        s.server_close()
+        r = Request('http://127.0.0.1:%d/' % port, '').get()
+        self.assertFalse(r.success())
+        self.assertTrue(r.err_msg.startswith('<urlopen error'))
+        self.assertEqual(r.status_code, None)
+        self.assertFalse(r.timed_out)
+        r = Request.response(error = ConnectionError(socket.timeout('timed out')))
+        self.assertEqual(r.err_msg, '<urlopen error timed out>')
+        self.assertTrue(r.timed_out)
+        
+    def test_async_client(self):
+        client = AsyncHTTPClient()
+        responses = {}
+        def callback(name):
+            def wrap(*args):
+                responses[name] = Request.response(*args)
+            return wrap
+        client.fetch('GET', self.url + '/redirect', None, {}, callback('redirect'))
+        client.fetch('GET', self.url + '/error', None, {}, callback('error'))
+        client.fetch('POST', self.url + '/post', 'a=1', 
+                     {'Content-Type': 'text/plain'}, callback('post'))
+        while client.in_flight:
+            client.poll()
+        self.assertTrue(responses['redirect'].content.startswith('/echo?redirected'))
+        self.assertEqual(responses['error'].err_msg, 'HTTP Error 503: Service Unavailable')
+        self.assertEqual(responses['error'].status_code, 503)
+        self.assertEqual(responses['post'].content, 'a=1 text/plain')
+        self.assertEqual(responses['post'].status_code, 200)
+    
+    def test_stale_connection(self):
+        pool = ConnectionPool()
+        pool.request('GET', self.url + '/echo')
+        # the idle connection breaks before the request is sent
+        [(conn, last_used)] = pool._idle.values()[0]
+        conn.sock.close()
+        self.assertEqual(pool.request('POST', self.url + '/post', 'a', 
+                                      {'Content-Type': 'text/plain'})[2], 'a text/plain')
+        
+    def test_timeout_not_resent(self):
+        pool = ConnectionPool(timeout = 0.1)
+        pool.request('GET', self.url + '/echo')
+        del KeepAliveHandler.slow_hits[:]
+        with self.assertRaises(ConnectionError):
+            pool.request('POST', self.url + '/slow', 'once', {})
+        time.sleep(0.1)
+        self.assertEqual(KeepAliveHandler.slow_hits, ['once'])
+    
+    def test_idle_eviction(self):
+        pool = ConnectionPool(maxsize = 1, idle_timeout = 0)
+        pool.request('GET', self.url + '/echo')
+        pool.request('GET', self.url + '/echo')
+        port = self.server.server_port
+        self.assertEqual(pool.idle_count('http', '127.0.0.1', port), 1)
+        pool.idle_timeout = -1
+        pool.evict_idle()
+        self.assertEqual(pool.idle_count('http', '127.0.0.1', port), 0)
+
+    def test_retry_transient(self):
+        common.retry_policy = RetryPolicy(max_attempts = 3, backoff = 0.01)
+        r = Request(self.url + '/flaky/a', '').get()
+        self.assertTrue(r.success())
+        common.retry_policy = RetryPolicy(max_attempts = 2, backoff = 0.01)
+        r = Request(self.url + '/flaky/b', '').get()
+        self.assertEqual(r.err_msg, 'HTTP Error 503: Service Unavailable')
+        # a redirect or a 404 is not worth retrying
+        self.assertFalse(common.is_transient(common.HTTPError(404, 'Not Found')))
+
+# self-signed certificate (and key) for localhost
+CERTFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'localhost.pem')
+
+class TestAsyncTransport(unittest2.TestCase):
+    
+    def serve(self, server):
+        t = threading.Thread(target = server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.addCleanup(server.shutdown)
+        return server.server_port
+    
+    def fetch(self, client, url):
+        result = []
+        client.fetch('GET', url, None, {}, lambda *args: result.append(args))
+        while client.in_flight:
+            client.poll()
+        return result[0]
+    
+    def test_tls_verified(self):
+        server = ThreadedHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        server.socket = ssl.wrap_socket(server.socket, certfile = CERTFILE, server_side = True)
+        port = self.serve(server)
+        # the self-signed certificate is not trusted by default
+        status, headers, content, error = self.fetch(AsyncHTTPClient(), 
+                                                     'https://localhost:%d/echo' % port)
+        self.assertTrue('CERTIFICATE_VERIFY_FAILED' in str(error), error)
+        context = ssl.create_default_context(cafile = CERTFILE)
+        status, headers, content, error = self.fetch(AsyncHTTPClient(ssl_context = context), 
+                                                     'https://localhost:%d/echo' % port)
+        self.assertEqual((status, error), (200, None))
+        # the certificate is issued for localhost only
+        status, headers, content, error = self.fetch(AsyncHTTPClient(ssl_context = context), 
+                                                     'https://127.0.0.1:%d/echo' % port)
+        self.assertTrue(isinstance(error, ConnectionError))
+        self.assertTrue('127.0.0.1' in str(error), error)
+    
+    @unittest2.skipUnless(socket.has_ipv6, 'no IPv6 support')
+    def test_ipv6(self):
+        class IPv6Server(ThreadedHTTPServer):
+            address_family = socket.AF_INET6
+        try:
+            server = IPv6Server(('::1', 0), KeepAliveHandler)
+        except socket.error:
+            self.skipTest('no IPv6 loopback')
+        port = self.serve(server)
+        status, headers, content, error = self.fetch(AsyncHTTPClient(), 
+                                                     'http://[::1]:%d/echo' % port)
+        self.assertEqual((status, error), (200, None))
+        self.assertTrue(content.startswith('/echo'))
+
+class TestRetry(unittest2.TestCase):
+    
+    def setUp(self):
+        self.clock = FakeClock()
+        
+    def test_backoff(self):
+        policy = RetryPolicy(max_attempts = 5, backoff = 0.5, max_backoff = 3,
+                             sleep = self.clock.sleep, random = lambda: 1.)
+        calls = []
+        def fail():
+            calls.append(1)
+            raise ValueError(len(calls))
+        with self.assertRaises(ValueError) as cm:
+            policy.call(fail, lambda e: True)
+        self.assertEqual(cm.exception.args, (5,))
+        self.assertEqual(self.clock.slept, [0.5, 1, 2, 3])
+        
+    def test_attempts_rate_limited(self):
+        # backoff of 0 leaves only the waits for the rate limit
+        policy = RetryPolicy(max_attempts = 3, backoff = 0, sleep = self.clock.sleep)
+        limiter = RateLimiter(rate = 2, max_in_flight = 1, clock = self.clock.time,
+                              sleep = self.clock.sleep)
+        calls = []
+        def fail():
+            calls.append(self.clock.now)
+            raise ValueError
+        with limiter:
+            with self.assertRaises(ValueError):
+                policy.call(fail, lambda e: True)
+        self.assertEqual(calls, [0, 0.5, 1.])
+        # without a held limiter attempts are not throttled
+        calls = []
+        with self.assertRaises(ValueError):
+            policy.call(fail, lambda e: True)
+        self.assertEqual(len(set(calls)), 1)
+        
+    def test_not_retryable(self):
+        policy = RetryPolicy(sleep = self.clock.sleep)
+        calls = []
+        def fail():
+            calls.append(1)
+            raise KeyError
+        with self.assertRaises(KeyError):
+            policy.call(fail, lambda e: isinstance(e, ValueError))
+        self.assertEqual(len(calls), 1)
+        
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(window = 10, min_calls = 4, error_rate = 0.5, cooldown = 30,
+                                 clock = self.clock.time, sleep = self.clock.sleep)
+        for success in (True, False, True, False):
+            breaker.before_call()
+            breaker.record(success)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(self.clock.slept, [])
+        # dispatch is paused until the cooldown is over, the probe fails
+        self.assertTrue(breaker.before_call())
+        self.assertEqual(self.clock.now, 30)
+        breaker.record(False, True)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        # the next probe succeeds and the breaker closes
+        self.assertTrue(breaker.before_call())
+        self.assertEqual(self.clock.now, 60)
+        breaker.record(True, True)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertFalse(breaker.before_call())
+        self.assertEqual(self.clock.now, 60)
+        
+    def test_late_outcome(self):
+        breaker = CircuitBreaker(window = 10, min_calls = 4, error_rate = 0.5, cooldown = 30,
+                                 clock = self.clock.time, sleep = self.clock.sleep)
+        for success in (False, False, False, False):
+            breaker.record(success)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        # calls that started before the breaker opened finish late
+        breaker.record(True)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.clock.now = 30
+        self.assertTrue(breaker.before_call())
+        breaker.record(False)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        # the probe is still running, nobody else gets through
+        self.assertEqual(breaker._wait_time(), (1., False))
+        breaker.record(True, True)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+class TestBlobCache(unittest2.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache', 'test.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_lru_eviction(self):
+        cache = BlobCache(self.path, 100, clock = self.clock.time)
+        for key in 'abc':
+            self.clock.now += 1
+            cache.put(key, key * 30)
+        # a is used again, b is now the least recently used entry
+        self.clock.now += 1
+        self.assertEqual(cache.get('a'), 'a' * 30)
+        self.assertEqual(cache.get('x'), None)
+        self.clock.now += 1
+        cache.put('d', 'd' * 30)
+        self.assertEqual(cache.size, 90)
+        self.assertEqual([key in cache for key in 'abcd'], [True, False, True, True])
+        cache.put('d', 'd' * 10)
+        self.assertEqual(cache.size, 70)
+        cache.close()
+        # the entries survive the process
+        cache = BlobCache(self.path, 100)
+        self.assertEqual((len(cache), cache.size), (3, 70))
+        cache.close()
+
+    def test_shared_file(self):
+        # lookups don't hold the write lock, another connection can write
+        first = BlobCache(self.path, 1000, clock = self.clock.time)
+        second = BlobCache(self.path, 1000, clock = self.clock.time)
+        second._db.execute('PRAGMA busy_timeout = 100')
+        first.put('a', 'aaa')
+        self.assertEqual(second.get('a'), 'aaa')
+        self.clock.now += 5
+        self.assertEqual(first.get('a'), 'aaa')
+        second.put('b', 'bbb')
+        self.assertEqual(first.get('b'), 'bbb')
+        # the refreshed use time is written on flush
+        first.flush()
+        self.assertEqual(second._db.execute('SELECT used FROM entries WHERE key = ?', 
+                                            ('a',)).fetchone()[0], 5)
+        first.close()
+        second.close()
+        
+    def test_shared_size(self):
+        # both writers evict against the size of the shared file
+        first = BlobCache(self.path, 100, clock = self.clock.time)
+        second = BlobCache(self.path, 100, clock = self.clock.time)
+        for key in 'abcdef':
+            self.clock.now += 1
+            (first if key in 'ace' else second).put(key, key * 30)
+            self.assertTrue(first.size <= 100)
+        self.assertEqual((first.size, second.size), (90, 90))
+        self.assertEqual([key in first for key in 'abcdef'], [False] * 3 + [True] * 3)
+        first.close()
+        second.close()
+
+class TestCompression(unittest2.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_file_variants(self):
+        data = '<html><body>%s</body></html>' % ('text ' * 1000)
+        path = os.path.join(self.dir, 'doc.html')
+        self.assertEqual(compression.write_file(path, data), path)
+        self.assertEqual(compression.read_file(path), data)
+        gz_path = compression.recompress_file(path, 'gzip')
+        self.assertEqual(gz_path, path + '.gz')
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.getsize(gz_path) < len(data) / 5)
+        # the compressed variant is found and decoded under the plain name
+        self.assertEqual(compression.read_file(path), data)
+        self.assertEqual(compression.read_file(path, 'gzip'), data)
+        self.assertEqual(compression.recompress_file(gz_path, None), path)
+        self.assertEqual(compression.read_file(path), data)
+        with self.assertRaises(IOError):
+            compression.read_file(os.path.join(self.dir, 'missing.html'))
+        with self.assertRaises(ValueError):
+            compression.compress(data, 'lzma')
+
+def main():
+    unittest2.main(exit = False, verbosity = 2)
+
+if __name__ == '__main__':
+    main()
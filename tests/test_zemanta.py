@@ -0,0 +1,140 @@
+import time
+import socket
+import threading
+
+import unittest2
+from thrift.transport import TSocket, TTransport
+from thrift.protocol import TBinaryProtocol, TCompactProtocol
+from thrift.server import TServer
+
+from txtexeval.util import common
+from txtexeval.util.retry import RetryPolicy
+from txtexeval.util.zemanta.client import ClientPool
+from txtexeval.util.zemanta.thriftgen.ceservice import ExtractorService, ttypes
+
+class Handler(object):
+    '''Upper cases the html, the "bad" encoding raises TAppException'''
+
+    def __init__(self):
+        self.connections = set()
+        self.pings = 0
+
+    def ping(self, param):
+        self.pings += 1
+        return param
+
+    def extract(self, url, title, htmldata, encoding):
+        # the threaded server runs every connection in its own thread
+        self.connections.add(threading.current_thread().name)
+        if encoding == 'bad':
+            raise ttypes.TAppException(code = ttypes.ExceptionCode.PARSING_FAILED,
+                                       msg = 'cannot parse')
+        return ttypes.extract_RET(success = True, body = htmldata.decode(encoding).upper())
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_server(handler, framed = False, compact = False):
+    port = free_port()
+    transport_factory = TTransport.TFramedTransportFactory() if framed \
+        else TTransport.TBufferedTransportFactory()
+    protocol_factory = TCompactProtocol.TCompactProtocolFactory() if compact \
+        else TBinaryProtocol.TBinaryProtocolFactory()
+    server = TServer.TThreadedServer(ExtractorService.Processor(handler),
+                                     TSocket.TServerSocket('127.0.0.1', port),
+                                     transport_factory, protocol_factory, daemon = True)
+    t = threading.Thread(target = server.serve)
+    t.daemon = True
+    t.start()
+    # wait until the server is listening
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except socket.error:
+            time.sleep(0.01)
+    return port
+
+class TestClientPool(unittest2.TestCase):
+
+    def setUp(self):
+        self.handler = Handler()
+        self.port = start_server(self.handler)
+        self.pool = ClientPool('127.0.0.1', self.port, timeout = 5)
+        self._retry_policy = common.retry_policy
+        common.retry_policy = RetryPolicy(max_attempts = 1)
+        common.circuit_breakers.clear()
+
+    def tearDown(self):
+        self.pool.clear()
+        common.retry_policy = self._retry_policy
+        common.circuit_breakers.clear()
+
+    def test_connection_reused(self):
+        for i in range(5):
+            self.assertEqual(self.pool.extract('doc %d' % i, 'utf-8'), ('DOC %d' % i, None))
+        self.assertEqual(len(self.handler.connections), 1)
+        self.assertEqual(self.pool.idle_count(), 1)
+        self.assertEqual(self.handler.pings, 0)
+
+    def test_concurrent(self):
+        results = {}
+        def work(i):
+            results[i] = self.pool.extract('doc %d' % i, 'utf-8')
+        threads = [threading.Thread(target = work, args = (i,)) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, dict((i, ('DOC %d' % i, None)) for i in range(20)))
+        self.assertTrue(self.pool.idle_count() <= self.pool.maxsize)
+
+    def test_app_exception(self):
+        response = self.pool.extract('doc', 'bad')
+        self.assertEqual(response.text, '')
+        self.assertTrue('cannot parse' in response.error)
+        # the connection is still usable
+        self.assertEqual(self.pool.idle_count(), 1)
+        self.assertEqual(self.pool.extract('doc', 'utf-8'), ('DOC', None))
+        self.assertEqual(len(self.handler.connections), 1)
+
+    def test_reconnect(self):
+        self.pool.extract('doc', 'utf-8')
+        # the connection is dropped while it sits in the pool
+        self.pool._idle[0].transport.close()
+        self.assertEqual(self.pool.extract('doc', 'utf-8'), ('DOC', None))
+        self.assertEqual(len(self.handler.connections), 2)
+
+    def test_ping_check(self):
+        self.pool.ping_after = 0
+        self.pool.extract('doc', 'utf-8')
+        self.pool.extract('doc', 'utf-8')
+        self.assertEqual(self.handler.pings, 1)
+
+    def test_refused(self):
+        pool = ClientPool('127.0.0.1', free_port())
+        response = pool.extract('doc', 'utf-8')
+        self.assertTrue('TTransportException' in response.error)
+
+class TestFramedCompact(unittest2.TestCase):
+
+    def test_extract(self):
+        handler = Handler()
+        port = start_server(handler, framed = True, compact = True)
+        pool = ClientPool('127.0.0.1', port, framed = True, protocol = 'compact', timeout = 5)
+        try:
+            self.assertEqual(pool.extract('doc', 'utf-8'), ('DOC', None))
+            self.assertEqual(pool.extract('doc', 'utf-8'), ('DOC', None))
+        finally:
+            pool.clear()
+        self.assertEqual(len(handler.connections), 1)
+
+def main():
+    unittest2.main(exit = False, verbosity = 2)
+
+if __name__ == '__main__':
+    main()